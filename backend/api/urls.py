@@ -3,6 +3,7 @@ from rest_framework_simplejwt.views import TokenRefreshView
 from apps.users.views import register, login, UserProfileView
 from drf_spectacular.views import SpectacularAPIView, SpectacularRedocView, SpectacularSwaggerView
 from core.health_checks import health_check, detailed_health_check, readiness_check, liveness_check
+from core.metrics import metrics_view
 
 # API v1 endpoints
 urlpatterns_v1 = [
@@ -34,6 +35,8 @@ urlpatterns = [
     path('health/detailed/', detailed_health_check, name='health-detailed'),
     path('health/ready/', readiness_check, name='health-ready'),
     path('health/live/', liveness_check, name='health-live'),
+    # Prometheus metrics
+    path('metrics/', metrics_view, name='metrics'),
     # API Documentation
     path('schema/', SpectacularAPIView.as_view(), name='schema'),
     path('docs/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
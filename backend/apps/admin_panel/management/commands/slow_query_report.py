@@ -0,0 +1,73 @@
+import glob
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.slow_queries import SlowQueryRecorder
+
+
+class Command(BaseCommand):
+    help = 'Aggregate the slow query log of all workers into a top-N report'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', help='Slow query log (defaults to the slow_query_file handler)')
+        parser.add_argument('--limit', type=int, default=20, help='Number of query shapes to show')
+        parser.add_argument(
+            '--order-by', default='total_ms', choices=['total_ms', 'max_ms', 'mean_ms', 'count'],
+            help='Ranking of query shapes'
+        )
+        parser.add_argument('--route', help='Only include queries from this route (URL name)')
+        parser.add_argument('--json', action='store_true', help='Output the report as JSON')
+
+    def handle(self, *args, **options):
+        filename = options['file'] or self.get_log_filename()
+        # Include rotated files (slow_queries.log.1, ...)
+        paths = sorted(glob.glob(f"{filename}*"))
+        if not paths:
+            raise CommandError(f"No slow query log found at {filename}")
+
+        recorder = SlowQueryRecorder(max_fingerprints=100000)
+        for capture in self.read_captures(paths):
+            if options['route'] and capture.get('route') != options['route']:
+                continue
+            recorder.aggregate(capture)
+
+        report = recorder.get_report(limit=options['limit'], order_by=options['order_by'])
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2, default=str))
+            return
+
+        if not report:
+            self.stdout.write('No slow queries recorded')
+            return
+
+        for rank, entry in enumerate(report, 1):
+            self.stdout.write(self.style.WARNING(
+                f"#{rank} {entry['fingerprint']}  count={entry['count']}  total={entry['total_ms']:.1f}ms  "
+                f"mean={entry['mean_ms']:.1f}ms  max={entry['max_ms']:.1f}ms"
+            ))
+            self.stdout.write(f"  {entry['normalized'][:300]}")
+            self.stdout.write(f"  routes: {', '.join(f'{route}={count}' for route, count in entry['routes'].items())}")
+            for frame in entry.get('last_stack', [])[:3]:
+                self.stdout.write(f"  at {frame}")
+            for line in entry.get('last_plan', []):
+                self.stdout.write(f"  plan: {line}")
+            self.stdout.write('')
+
+    def get_log_filename(self):
+        try:
+            return settings.LOGGING['handlers']['slow_query_file']['filename']
+        except KeyError:
+            raise CommandError('No slow_query_file logging handler configured; pass --file')
+
+    def read_captures(self, paths):
+        for path in paths:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if 'fingerprint' in record and 'duration_ms' in record:
+                        yield record
@@ -33,4 +33,11 @@ urlpatterns = [
     
     # Settings
     path('settings/', views.admin_settings, name='admin_settings'),
+    
+    # Request profiles
+    path('profiles/', views.admin_profiles, name='admin_profiles'),
+    path('profiles/<str:profile_id>/', views.admin_profile_download, name='admin_profile_download'),
+    
+    # Slow queries
+    path('slow-queries/', views.admin_slow_queries, name='admin_slow_queries'),
 ]
@@ -5,9 +5,10 @@ from rest_framework.response import Response
 from django.db.models import Count, Sum, Avg
 from django.utils import timezone
 from datetime import timedelta
+import os
 from decimal import Decimal
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import HttpResponse, FileResponse
 
 from apps.products.models import Product, Category
 from apps.orders.models import Order
@@ -15,6 +16,29 @@ from apps.users.models import User
 from apps.products.serializers import ProductListSerializer, ProductDetailSerializer, ProductCreateUpdateSerializer, CategorySerializer, CategoryCreateUpdateSerializer
 from apps.orders.serializers import OrderSerializer, OrderCreateUpdateSerializer
 from apps.users.serializers import UserProfileSerializer, UserCreateUpdateSerializer
+from core.profiling import list_profiles, get_profile_path
+from core.slow_queries import get_recorder
+from core.throttling import throttle_cost
+
+
+MAX_LIST_LIMIT = 500
+
+
+def get_limit(request, default):
+    """Parse the ``limit`` query parameter; return (limit, error response)"""
+    try:
+        limit = int(request.query_params.get('limit', default))
+    except (TypeError, ValueError):
+        return None, Response(
+            {'error': 'limit must be an integer'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if limit < 1:
+        return None, Response(
+            {'error': 'limit must be at least 1'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    return min(limit, MAX_LIST_LIMIT), None
 
 
 def custom_admin_panel(request):
@@ -179,6 +203,7 @@ class AdminCategoryDetail(generics.RetrieveUpdateDestroyAPIView):
         return CategorySerializer
 
 
+@throttle_cost(20)
 @api_view(['GET'])
 @permission_classes([IsAuthenticated, IsAdminUser])
 def admin_analytics(request):
@@ -370,3 +395,65 @@ def admin_settings(request):
             'message': 'Settings updated successfully',
             'settings': settings_data
         })
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsAdminUser])
+def admin_profiles(request):
+    """List recent request profiles"""
+    profiles = list_profiles()
+    
+    route = request.query_params.get('route')
+    if route:
+        profiles = [profile for profile in profiles if profile.get('route') == route]
+    
+    limit, error = get_limit(request, 50)
+    if error:
+        return error
+    
+    return Response({
+        'count': len(profiles),
+        'results': profiles[:limit],
+    })
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsAdminUser])
+def admin_profile_download(request, profile_id):
+    """Download a request profile"""
+    path = get_profile_path(profile_id)
+    if path is None:
+        return Response(
+            {'error': 'Profile not found'},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=os.path.basename(path))
+
+
+@api_view(['GET', 'DELETE'])
+@permission_classes([IsAuthenticated, IsAdminUser])
+def admin_slow_queries(request):
+    """Top slow query shapes recorded by this worker"""
+    recorder = get_recorder()
+    
+    if request.method == 'DELETE':
+        recorder.reset()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+    
+    order_by = request.query_params.get('order_by', 'total_ms')
+    if order_by not in ('total_ms', 'max_ms', 'mean_ms', 'count'):
+        return Response(
+            {'error': 'order_by must be one of total_ms, max_ms, mean_ms, count'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    limit, error = get_limit(request, 20)
+    if error:
+        return error
+    
+    return Response({
+        'threshold_ms': recorder.threshold * 1000,
+        'pid': os.getpid(),
+        'results': recorder.get_report(limit=limit, order_by=order_by),
+    })
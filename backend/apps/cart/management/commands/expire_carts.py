@@ -0,0 +1,91 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.cart.models import Cart
+from apps.cart.storage import DatabaseCartStore, get_cart_store, get_config
+from core.cache_utils import CacheManager
+
+
+class Command(BaseCommand):
+    help = 'Deactivate carts idle beyond CART_STORAGE EXPIRE_AFTER and delete inactive carts, in batches'
+
+    def add_arguments(self, parser):
+        config = get_config()
+        parser.add_argument(
+            '--expire-after', type=float, default=config['EXPIRE_AFTER'],
+            help='Deactivate active carts not changed for this many seconds'
+        )
+        parser.add_argument(
+            '--delete-after', type=float, default=config['DELETE_INACTIVE_AFTER'],
+            help='Delete inactive carts not changed for this many seconds'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=config['EXPIRE_BATCH_SIZE'],
+            help='Carts deactivated or deleted per statement'
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=config['EXPIRE_BATCH_SLEEP'],
+            help='Seconds to pause between batches, to leave room for live traffic'
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Only count the carts that would be affected')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        expire_before = now - timedelta(seconds=options['expire_after'])
+        delete_before = now - timedelta(seconds=options['delete_after'])
+
+        store = get_cart_store()
+        if not isinstance(store, DatabaseCartStore) and not options['dry_run']:
+            # Carts changed in Redis are not idle; write them back first
+            while store.flush_due(min_age=0) >= store.flush_batch_size:
+                pass
+
+        # Item changes do not touch the cart row, so check the items too
+        idle = Cart.objects.filter(is_active=True, updated_at__lt=expire_before).exclude(
+            items__updated_at__gte=expire_before
+        )
+        inactive = Cart.objects.filter(is_active=False, updated_at__lt=delete_before)
+
+        if options['dry_run']:
+            self.stdout.write(f'Would expire {idle.count()} carts and delete {inactive.count()} inactive carts')
+            return
+
+        expired = self.expire(store, idle, options['batch_size'], options['sleep'])
+        deleted = self.delete(inactive, options['batch_size'], options['sleep'])
+        self.stdout.write(self.style.SUCCESS(f'Expired {expired} carts, deleted {deleted} inactive carts'))
+
+    def expire(self, store, idle, batch_size, sleep):
+        """Deactivate idle carts one batch at a time"""
+        total = 0
+        while True:
+            batch = list(idle.order_by('id').values_list('id', 'user_id')[:batch_size])
+            if not batch:
+                return total
+            # Re-check idleness in case a cart was used since it was selected
+            total += idle.filter(id__in=[cart_id for cart_id, _ in batch]).update(is_active=False)
+            # QuerySet.update() sends no signals
+            user_ids = [user_id for _, user_id in batch]
+            CacheManager.invalidate_user_carts(user_ids)
+            if not isinstance(store, DatabaseCartStore):
+                for user_id in user_ids:
+                    store.discard_user(user_id)
+            if len(batch) < batch_size:
+                return total
+            time.sleep(sleep)
+
+    def delete(self, inactive, batch_size, sleep):
+        """Delete inactive carts and their items one batch at a time"""
+        total = 0
+        while True:
+            ids = list(inactive.order_by('id').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return total
+            # DELETE ... WHERE cart_id IN (...) for the items, then the carts
+            inactive.filter(id__in=ids).delete()
+            total += len(ids)
+            if len(ids) < batch_size:
+                return total
+            time.sleep(sleep)
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from apps.cart.storage import DatabaseCartStore, get_cart_store
+
+
+class Command(BaseCommand):
+    help = 'Write carts held in Redis back to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--min-age', type=float, default=0,
+            help='Only flush carts dirty for at least this many seconds (default: all dirty carts)'
+        )
+
+    def handle(self, *args, **options):
+        store = get_cart_store()
+        if isinstance(store, DatabaseCartStore):
+            self.stdout.write('Carts are stored in the database; nothing to flush')
+            return
+
+        total = 0
+        while True:
+            flushed = store.flush_due(min_age=options['min_age'])
+            total += flushed
+            if flushed < store.flush_batch_size:
+                break
+        self.stdout.write(self.style.SUCCESS(f'Flushed {total} carts'))
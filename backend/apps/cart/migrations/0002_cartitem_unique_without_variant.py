@@ -0,0 +1,37 @@
+# Generated by Django 4.2.7 on 2026-10-19 11:57
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def merge_duplicate_items(apps, schema_editor):
+    """Merge items without a variant added twice to the same cart"""
+    CartItem = apps.get_model('cart', 'CartItem')
+    duplicates = (
+        CartItem.objects.filter(variant__isnull=True)
+        .values('cart_id', 'product_id')
+        .annotate(count=Count('id'), total=Sum('quantity'))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates:
+        items = CartItem.objects.filter(
+            cart_id=duplicate['cart_id'], product_id=duplicate['product_id'], variant__isnull=True
+        ).order_by('added_at', 'id')
+        keep = items.first()
+        items.exclude(id=keep.id).delete()
+        CartItem.objects.filter(id=keep.id).update(quantity=duplicate['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_items, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(condition=models.Q(('variant__isnull', True)), fields=('cart', 'product'), name='cart_item_unique_without_variant'),
+        ),
+    ]
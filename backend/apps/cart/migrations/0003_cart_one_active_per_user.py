@@ -0,0 +1,34 @@
+# Generated by Django 4.2.7 on 2026-10-19 12:00
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def deactivate_duplicate_carts(apps, schema_editor):
+    """Keep only the newest active cart of each user active"""
+    Cart = apps.get_model('cart', 'Cart')
+    users = (
+        Cart.objects.filter(is_active=True)
+        .values('user_id')
+        .annotate(count=Count('id'))
+        .filter(count__gt=1)
+        .values_list('user_id', flat=True)
+    )
+    for user_id in users:
+        carts = Cart.objects.filter(user_id=user_id, is_active=True).order_by('-created_at', '-id')
+        Cart.objects.filter(id__in=list(carts.values_list('id', flat=True)[1:])).update(is_active=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0002_cartitem_unique_without_variant'),
+    ]
+
+    operations = [
+        migrations.RunPython(deactivate_duplicate_carts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_active', True)), fields=('user',), name='cart_one_active_per_user'),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth import get_user_model
+from django.utils.functional import cached_property
 from apps.products.models import Product, ProductVariant
 
 User = get_user_model()
@@ -14,24 +15,36 @@ class Cart(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        constraints = [
+            # One active cart per user; also the index for looking it up
+            models.UniqueConstraint(
+                fields=['user'], condition=models.Q(is_active=True), name='cart_one_active_per_user',
+            ),
+        ]
 
     def __str__(self):
         return f"Cart for {self.user.email}"
 
+    @cached_property
+    def totals(self):
+        """All cart totals, computed once per instance (see apps/cart/services.py)"""
+        from .services import calculate_cart_totals
+        return calculate_cart_totals(self)
+
     @property
     def total_items(self):
         """Get total number of items in cart"""
-        return sum(item.quantity for item in self.items.all())
+        return self.totals.total_items
 
     @property
     def total_price(self):
         """Calculate total price of cart"""
-        return sum(item.total_price for item in self.items.all())
+        return self.totals.total_price
 
     @property
     def total_discount(self):
         """Calculate total discount"""
-        return sum(item.total_discount for item in self.items.all())
+        return self.totals.total_discount
 
 
 class CartItem(models.Model):
@@ -45,6 +58,13 @@ class CartItem(models.Model):
 
     class Meta:
         unique_together = ['cart', 'product', 'variant']
+        constraints = [
+            # unique_together does not cover items without a variant (NULLs never conflict)
+            models.UniqueConstraint(
+                fields=['cart', 'product'], condition=models.Q(variant__isnull=True),
+                name='cart_item_unique_without_variant',
+            ),
+        ]
         ordering = ['-added_at']
 
     def __str__(self):
@@ -7,7 +7,7 @@ class CartItemSerializer(serializers.ModelSerializer):
     """Cart item serializer"""
     product = ProductListSerializer(read_only=True)
     product_id = serializers.IntegerField(write_only=True)
-    variant_id = serializers.IntegerField(write_only=True, required=False, allow_null=True)
+    variant_id = serializers.IntegerField(required=False, allow_null=True)
     unit_price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
     total_price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
     total_discount = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
@@ -98,6 +98,50 @@ class UpdateCartItemSerializer(serializers.Serializer):
         return value
 
 
+class CartOperationSerializer(serializers.Serializer):
+    """One operation of a batch cart update"""
+    op = serializers.ChoiceField(choices=['add', 'set', 'remove'])
+    product_id = serializers.IntegerField()
+    variant_id = serializers.IntegerField(required=False, allow_null=True)
+    quantity = serializers.IntegerField(required=False, min_value=1)
+
+    def validate(self, attrs):
+        if attrs['op'] != 'remove' and 'quantity' not in attrs:
+            raise serializers.ValidationError({'quantity': "This field is required for 'add' and 'set'."})
+        return attrs
+
+
+class CartBatchSerializer(serializers.Serializer):
+    """Serializer for applying several cart operations at once"""
+    operations = CartOperationSerializer(many=True, allow_empty=False, max_length=100)
+
+    def validate_operations(self, operations):
+        """Check every product and variant being added exists and is active, with one query each"""
+        from apps.products.models import Product, ProductVariant
+
+        added = [operation for operation in operations if operation['op'] != 'remove']
+        product_ids = {operation['product_id'] for operation in added}
+        variant_ids = {operation['variant_id'] for operation in added if operation.get('variant_id')}
+        products = set(Product.objects.filter(id__in=product_ids, is_active=True).values_list('id', flat=True))
+        variants = dict(ProductVariant.objects.filter(
+            id__in=variant_ids, is_active=True
+        ).values_list('id', 'product_id')) if variant_ids else {}
+
+        errors = []
+        for operation in operations:
+            error = {}
+            if operation['op'] != 'remove':
+                variant_id = operation.get('variant_id')
+                if operation['product_id'] not in products:
+                    error['product_id'] = ["Product not found or inactive"]
+                elif variant_id and variants.get(variant_id) != operation['product_id']:
+                    error['variant_id'] = ["Product variant not found or inactive"]
+            errors.append(error)
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return operations
+
+
 class WishlistSerializer(serializers.ModelSerializer):
     """Wishlist serializer"""
     product = ProductListSerializer(read_only=True)
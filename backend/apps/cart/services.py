@@ -0,0 +1,181 @@
+"""
+Cart pricing.
+
+Cart totals are computed in one place, shared by the cart views, checkout and
+shipping calculation:
+
+* ``calculate_cart_totals`` loads the items with their product and variant in
+  one joined query (or uses items already prefetched on the cart) and
+  computes every total in a single pass. Use it when the items are needed
+  too, e.g. to create order items.
+* ``aggregate_cart_totals`` computes the same totals in the database with one
+  aggregate query, without loading any rows.
+
+``validate_cart`` checks the availability, active status and price of every
+item of a stored cart with one query, for the cart ``validate`` action and
+for checkout.
+"""
+from decimal import Decimal
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from django.db.models import (
+    Case, Count, DecimalField, ExpressionWrapper, F, IntegerField, OuterRef, Subquery, Sum, Value, When
+)
+from django.db.models.functions import Coalesce
+
+from .models import CartItem
+
+ZERO = Decimal('0.00')
+
+
+def get_cart_items(cart) -> List[CartItem]:
+    """Return the cart's items with product and variant loaded"""
+    prefetched = getattr(cart, '_prefetched_objects_cache', {}).get('items')
+    if prefetched is not None:
+        return list(prefetched)
+    return list(cart.items.select_related('product', 'variant'))
+
+
+class CartLine(NamedTuple):
+    item: CartItem
+    unit_price: Decimal
+    total_price: Decimal
+    total_discount: Decimal
+
+
+class CartTotals:
+    """Totals of a cart and of each of its lines, computed in one pass over its items"""
+
+    def __init__(self, items: List[CartItem]):
+        self.items = items
+        self.lines: List[CartLine] = []
+        self.item_count = len(items)
+        self.total_items = 0
+        self.total_price = ZERO
+        self.total_discount = ZERO
+        for item in items:
+            unit_price = item.unit_price
+            line_price = unit_price * item.quantity
+            line_discount = ZERO
+            compare_price = item.product.compare_price
+            if compare_price and compare_price > unit_price:
+                line_discount = (compare_price - unit_price) * item.quantity
+            self.lines.append(CartLine(item, unit_price, line_price, line_discount))
+            self.total_items += item.quantity
+            self.total_price += line_price
+            self.total_discount += line_discount
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'total_items': self.total_items,
+            'total_price': self.total_price,
+            'total_discount': self.total_discount,
+            'item_count': self.item_count,
+        }
+
+
+def calculate_cart_totals(cart) -> CartTotals:
+    """Load the cart's items in one query and total them"""
+    return CartTotals(get_cart_items(cart))
+
+
+def aggregate_cart_totals(cart) -> Dict[str, Any]:
+    """Compute the cart totals with a single aggregate query"""
+    money = DecimalField(max_digits=12, decimal_places=2)
+    unit_price = ExpressionWrapper(
+        F('product__price') + Coalesce(F('variant__price_adjustment'), Value(ZERO)), output_field=money
+    )
+    totals = CartItem.objects.filter(cart=cart).annotate(line_unit_price=unit_price).aggregate(
+        total_items=Coalesce(Sum('quantity'), 0),
+        total_price=Coalesce(Sum(F('line_unit_price') * F('quantity'), output_field=money), Value(ZERO)),
+        total_discount=Coalesce(Sum(Case(
+            When(
+                product__compare_price__gt=F('line_unit_price'),
+                then=(F('product__compare_price') - F('line_unit_price')) * F('quantity'),
+            ),
+            default=Value(ZERO),
+            output_field=money,
+        )), Value(ZERO)),
+        item_count=Count('id'),
+    )
+    # SQLite returns aggregates over decimals as floats
+    totals['total_price'] = Decimal(str(totals['total_price'])).quantize(ZERO)
+    totals['total_discount'] = Decimal(str(totals['total_discount'])).quantize(ZERO)
+    return totals
+
+
+def get_warehouse_stock():
+    """
+    Subquery of the stock available (on hand minus reserved) in active
+    warehouses for a cart item's product and variant; NULL when the product
+    is not stocked in any warehouse.
+    """
+    from apps.shipping.models import Inventory
+
+    return Subquery(
+        Inventory.objects.filter(product_id=OuterRef('product_id'), warehouse__is_active=True)
+        .annotate(variant_key=Coalesce('variant_id', Value(0)))
+        .filter(variant_key=Coalesce(OuterRef('variant_id'), Value(0)))
+        .order_by()
+        .values('product_id')
+        .annotate(available=Sum(F('quantity') - F('reserved_quantity')))
+        .values('available'),
+        output_field=IntegerField(),
+    )
+
+
+def get_snapshot_prices(cart_data: Optional[Dict[str, Any]]) -> Dict[Tuple[int, Optional[int]], Decimal]:
+    """Return the unit prices of a serialized cart, by (product_id, variant_id)"""
+    if not cart_data:
+        return {}
+    return {
+        (item['product']['id'], item.get('variant_id')): Decimal(str(item['unit_price']))
+        for item in cart_data['items']
+    }
+
+
+def validate_cart(cart_id: int, snapshot_prices: Optional[Dict] = None) -> Dict[str, Any]:
+    """
+    Check every item of a stored cart with one query: whether its product and
+    variant are still active, whether the stock covers the quantity (in
+    warehouses where the product is stocked in any, otherwise on the product
+    or variant) and whether the unit price differs from ``snapshot_prices``,
+    e.g. the prices of the cart the shopper was last shown.
+    """
+    snapshot_prices = snapshot_prices or {}
+    items = (
+        CartItem.objects.filter(cart_id=cart_id)
+        .select_related('product', 'variant')
+        .annotate(warehouse_stock=get_warehouse_stock())
+        .order_by('added_at', 'id')
+    )
+    lines = []
+    for item in items:
+        product, variant = item.product, item.variant
+        is_active = product.is_active and (variant is None or variant.is_active)
+        if not product.track_inventory:
+            available_quantity = None
+        elif item.warehouse_stock is not None:
+            available_quantity = max(item.warehouse_stock, 0)
+        else:
+            available_quantity = variant.stock_quantity if variant else product.stock_quantity
+        unit_price = item.unit_price
+        snapshot_price = snapshot_prices.get((item.product_id, item.variant_id))
+        lines.append({
+            'item_id': item.id,
+            'product_id': item.product_id,
+            'variant_id': item.variant_id,
+            'product_name': product.name,
+            'quantity': item.quantity,
+            'is_active': is_active,
+            'available_quantity': available_quantity,
+            'is_available': is_active and (available_quantity is None or available_quantity >= item.quantity),
+            'unit_price': unit_price,
+            'snapshot_price': snapshot_price,
+            'price_changed': snapshot_price is not None and snapshot_price != unit_price,
+        })
+    return {
+        'is_valid': bool(lines) and all(line['is_available'] for line in lines),
+        'price_changed': any(line['price_changed'] for line in lines),
+        'items': lines,
+    }
@@ -0,0 +1,19 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Cart
+from core.cache_utils import CacheManager
+
+
+@receiver(post_save, sender=Cart)
+def forget_inactive_cart_on_save(sender, instance, **kwargs):
+    """Forget the cached active cart when a cart is deactivated"""
+    if not instance.is_active:
+        CacheManager.invalidate_active_cart(instance.user_id)
+
+
+@receiver(post_delete, sender=Cart)
+def forget_active_cart_on_delete(sender, instance, **kwargs):
+    """Forget the cached active cart when an active cart is deleted"""
+    # Inactive carts were forgotten when they were deactivated
+    if instance.is_active:
+        CacheManager.invalidate_active_cart(instance.user_id)
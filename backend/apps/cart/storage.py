@@ -0,0 +1,904 @@
+"""
+Cart storage.
+
+Cart views read and write carts through a cart store, chosen by
+``CART_STORAGE['BACKEND']``:
+
+* ``'database'`` (default): carts live in ``Cart``/``CartItem``.
+* ``'redis'``: the active cart of each user lives in a Redis hash, one field
+  per item (``'<product_id>:<variant_id or 0>'`` -> quantity) plus the cached
+  total quantity, the id of the backing ``Cart`` row and a version counter.
+  Every mutation is one Lua script: it updates the hash, bumps the version,
+  refreshes the TTL and marks the cart dirty in a sorted set. Carts are
+  written back to ``Cart``/``CartItem`` in batches by a background flusher
+  once they have been dirty for ``FLUSH_INTERVAL`` seconds, at checkout, and
+  by the ``flush_carts`` management command (e.g. on deploy). A cart is only
+  marked clean if its version did not change while it was being written, so
+  concurrent updates are never lost.
+
+Hashes are loaded from the database on first use. Redis calls go through the
+cache's circuit breaker; while it is open carts are read and written in the
+database directly, and the hash of every cart written that way is deleted
+once the circuit closes (``core.circuit_breaker`` replays the deletes), so
+the flusher never writes the stale Redis copy over those changes; changes
+not yet flushed when Redis went away are lost with it. ``FLUSH_INTERVAL`` must stay well below ``TTL``, and the
+Redis ``maxmemory-policy`` must not evict cart keys before they are flushed.
+
+Anonymous shoppers get a guest cart, kept in the cache (a Redis hash changed
+by Lua scripts in production) under a signed token that the client sends
+back in the ``X-Cart-Token`` header. Guest carts are never written to the
+database: at login the items are folded into the user's active cart with
+``merge_guest_cart``, in one batch.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache as default_cache
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.db.models import F, Prefetch, prefetch_related_objects
+from django.utils import timezone
+
+from core.cache_utils import CacheManager
+from core.circuit_breaker import CircuitBreakerClient
+
+from .models import Cart, CartItem
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'cart:'
+DIRTY_KEY = 'cart:dirty'
+
+# Anonymous shoppers send their signed guest cart token in this header
+GUEST_TOKEN_HEADER = 'HTTP_X_CART_TOKEN'
+GUEST_TOKEN_SALT = 'apps.cart.guest'
+# Guest carts have no row; Django needs a pk to attach the items to them
+GUEST_CART_ID = 0
+
+# Inserts nothing (and returns no row) if the cart is no longer active
+UPSERT_SQL = """
+INSERT INTO {table} (cart_id, product_id, variant_id, quantity, added_at, updated_at)
+SELECT %s, %s, %s, %s, %s, %s
+WHERE EXISTS (SELECT 1 FROM {cart_table} WHERE id = %s AND is_active)
+ON CONFLICT {target} DO UPDATE
+SET quantity = {table}.quantity + EXCLUDED.quantity, updated_at = EXCLUDED.updated_at
+RETURNING id, quantity, added_at
+"""
+
+# (product_id, variant_id)
+ItemKey = Tuple[int, Optional[int]]
+# (operation, item, quantity)
+Operation = Tuple[str, ItemKey, int]
+
+# KEYS: cart hash, dirty set
+# ARGV: TTL in seconds, dirty set member, then (operation, item field,
+# quantity) triples. 'add' adds to the quantity of an item, 'set' sets it,
+# 'update' sets it only if the item is in the cart, 'remove' deletes the item
+# and 'clear' deletes every item.
+# Returns -1 if the cart is not loaded, otherwise the new quantity of the item
+# of each operation; -2 for 'update' or 'remove' of an item not in the cart.
+MUTATE_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+if redis.call('EXISTS', KEYS[1]) == 0 then return -1 end
+local results = {}
+for i = 3, #ARGV, 3 do
+    local op = ARGV[i]
+    local field = ARGV[i + 1]
+    local new = 0
+    if op == 'clear' then
+        for _, name in ipairs(redis.call('HKEYS', KEYS[1])) do
+            if string.sub(name, 1, 1) ~= '_' then redis.call('HDEL', KEYS[1], name) end
+        end
+        redis.call('HSET', KEYS[1], '_total_items', 0)
+    else
+        local current = tonumber(redis.call('HGET', KEYS[1], field) or '0')
+        if current == 0 and (op == 'update' or op == 'remove') then
+            new = -2
+        else
+            if op == 'add' then
+                new = current + tonumber(ARGV[i + 2])
+            elseif op == 'set' or op == 'update' then
+                new = tonumber(ARGV[i + 2])
+            end
+            if new > 0 then
+                redis.call('HSET', KEYS[1], field, new)
+            else
+                redis.call('HDEL', KEYS[1], field)
+            end
+            redis.call('HINCRBY', KEYS[1], '_total_items', new - current)
+        end
+    end
+    results[#results + 1] = new
+end
+redis.call('HINCRBY', KEYS[1], '_version', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+local clock = redis.call('TIME')
+redis.call('ZADD', KEYS[2], 'NX', clock[1], ARGV[2])
+return results
+"""
+
+# KEYS: cart hash
+# ARGV: TTL in seconds, cart id, total quantity, then item field and quantity pairs
+LOAD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then return 0 end
+redis.call('HSET', KEYS[1], '_cart_id', ARGV[2], '_total_items', ARGV[3], '_version', 0, '_flushed', 0)
+for i = 4, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+READ_SCRIPT = "return redis.call('HGETALL', KEYS[1])"
+
+# KEYS: guest cart hash
+# ARGV: TTL in seconds, then (operation, item field, quantity) triples, as
+# for MUTATE_SCRIPT but without the cart totals, version and dirty set.
+# Returns the new quantity of the item of each operation; -2 for 'update' or
+# 'remove' of an item not in the cart.
+GUEST_MUTATE_SCRIPT = """
+local results = {}
+for i = 2, #ARGV, 3 do
+    local op = ARGV[i]
+    local field = ARGV[i + 1]
+    local new = 0
+    if op == 'clear' then
+        redis.call('DEL', KEYS[1])
+    else
+        local current = tonumber(redis.call('HGET', KEYS[1], field) or '0')
+        if current == 0 and (op == 'update' or op == 'remove') then
+            new = -2
+        else
+            if op == 'add' then
+                new = current + tonumber(ARGV[i + 2])
+            elseif op == 'set' or op == 'update' then
+                new = tonumber(ARGV[i + 2])
+            end
+            if new > 0 then
+                redis.call('HSET', KEYS[1], field, new)
+            else
+                redis.call('HDEL', KEYS[1], field)
+            end
+        end
+    end
+    results[#results + 1] = new
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return results
+"""
+
+# KEYS: guest cart hash
+POP_SCRIPT = """
+local values = redis.call('HGETALL', KEYS[1])
+redis.call('DEL', KEYS[1])
+return values
+"""
+
+# KEYS: cart hash, dirty set
+# ARGV: version that was flushed, dirty set member
+MARK_CLEAN_SCRIPT = """
+local version = redis.call('HGET', KEYS[1], '_version')
+if version then
+    redis.call('HSET', KEYS[1], '_flushed', ARGV[1])
+    if version ~= ARGV[1] then return 0 end
+end
+redis.call('ZREM', KEYS[2], ARGV[2])
+return 1
+"""
+
+# KEYS: dirty set
+# ARGV: minimum seconds dirty, maximum number of carts
+DUE_SCRIPT = """
+local clock = redis.call('TIME')
+return redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', tonumber(clock[1]) - tonumber(ARGV[1]), 'LIMIT', 0, ARGV[2])
+"""
+
+# KEYS: cart hash, dirty set
+# ARGV: dirty set member
+DISCARD_SCRIPT = """
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+return 1
+"""
+
+
+def get_config() -> Dict[str, Any]:
+    """Return the CART_STORAGE setting merged over the defaults"""
+    config = {
+        'BACKEND': 'database',
+        'TTL': 60 * 60 * 24 * 7,
+        'FLUSH_INTERVAL': 30,
+        'FLUSH_BATCH_SIZE': 200,
+        'GUEST_TTL': 60 * 60 * 24 * 7,
+        'EXPIRE_AFTER': 60 * 60 * 24 * 30,
+        'DELETE_INACTIVE_AFTER': 60 * 60 * 24,
+        'EXPIRE_BATCH_SIZE': 1000,
+        'EXPIRE_BATCH_SLEEP': 0.1,
+    }
+    config.update(getattr(settings, 'CART_STORAGE', {}))
+    return config
+
+
+def get_items_prefetch() -> Prefetch:
+    """Cart items with their product and variant, so totals need no more queries"""
+    return Prefetch('items', queryset=CartItem.objects.select_related('product__category', 'variant'))
+
+
+def set_prefetched_items(cart: Cart, items: List[CartItem]) -> Cart:
+    """Attach ``items`` to ``cart`` as if they had been prefetched"""
+    queryset = CartItem.objects.none()
+    queryset._result_cache = items
+    queryset._prefetch_done = True
+    cart._prefetched_objects_cache = {'items': queryset}
+    return cart
+
+
+def build_cart(cart: Cart, quantities: Dict[ItemKey, int]) -> Cart:
+    """Attach unsaved items for ``quantities`` to ``cart``, loading products and variants in bulk"""
+    from apps.products.models import Product, ProductVariant
+
+    products = Product.objects.select_related('category').in_bulk({p for p, v in quantities})
+    variants = ProductVariant.objects.in_bulk({v for p, v in quantities if v})
+    items = [
+        CartItem(
+            cart_id=cart.id, product=products[product_id], variant=variants.get(variant_id), quantity=quantity
+        )
+        for (product_id, variant_id), quantity in quantities.items()
+        if product_id in products and (variant_id is None or variant_id in variants)
+    ]
+    return set_prefetched_items(cart, items)
+
+
+def get_active_cart_id(user) -> int:
+    """
+    Return the id of the user's active cart, creating the cart if needed.
+
+    The id is memoized on the user object for the rest of the request and
+    cached across requests; the cached pointer is dropped when the cart is
+    deactivated (``apps/cart/signals.py``).
+    """
+    cart_id = getattr(user, '_active_cart_id', None)
+    if cart_id is not None:
+        return cart_id
+
+    cache_key = CacheManager.get_active_cart_cache_key(user.id)
+    cart_id = default_cache.get(cache_key)
+    if cart_id is None:
+        active = Cart.objects.filter(user=user, is_active=True).values_list('id', flat=True)
+        cart_id = active.first()
+        if cart_id is None:
+            try:
+                with transaction.atomic():
+                    cart_id = Cart.objects.create(user=user).id
+            except IntegrityError:
+                # Created concurrently; there is only ever one active cart
+                cart_id = active.get()
+        default_cache.set(cache_key, cart_id, CacheManager.CACHE_TIMEOUTS['active_cart'])
+    user._active_cart_id = cart_id
+    return cart_id
+
+
+def forget_active_cart(user) -> None:
+    """Drop the memoized and cached active cart of ``user``"""
+    user._active_cart_id = None
+    CacheManager.invalidate_active_cart(user.id)
+
+
+def get_checked_active_cart_id(user) -> int:
+    """``get_active_cart_id``, dropping a cached pointer to a cart deactivated since"""
+    cart_id = get_active_cart_id(user)
+    if not Cart.objects.filter(id=cart_id, is_active=True).exists():
+        forget_active_cart(user)
+        cart_id = get_active_cart_id(user)
+    return cart_id
+
+
+class DatabaseCartStore:
+    """Carts stored in Cart/CartItem"""
+
+    def get_or_create_cart(self, user) -> Cart:
+        """
+        Return the active cart, without loading its row; the cached id may
+        point to a cart deactivated since, so writes must check it.
+        """
+        cart = Cart(id=get_active_cart_id(user), user=user, is_active=True)
+        cart._state.adding = False
+        return cart
+
+    def get_cart(self, user) -> Cart:
+        """Return the active cart with its items loaded"""
+        carts = Cart.objects.filter(is_active=True).prefetch_related(get_items_prefetch())
+        cart = carts.filter(pk=get_active_cart_id(user)).first()
+        if cart is None:
+            # The cached cart was deactivated behind our back
+            forget_active_cart(user)
+            cart = carts.get(pk=get_active_cart_id(user))
+        return cart
+
+    def add(self, user, key: ItemKey, quantity: int) -> CartItem:
+        """Add ``quantity`` of an item, returning the cart item"""
+        item = upsert_cart_item(self.get_or_create_cart(user), key, quantity)
+        if item is None:
+            # The cached cart was deactivated behind our back
+            forget_active_cart(user)
+            item = upsert_cart_item(self.get_or_create_cart(user), key, quantity)
+        return item
+
+    def get_items(self, user):
+        """Items of the active cart; none if the cached cart was deactivated"""
+        return CartItem.objects.filter(cart_id=get_active_cart_id(user), cart__is_active=True)
+
+    def set_quantity(self, user, key: ItemKey, quantity: int) -> Optional[CartItem]:
+        """Set the quantity of an item in the cart; None if it is not in the cart"""
+        product_id, variant_id = key
+        item = self.get_items(user).filter(product_id=product_id, variant_id=variant_id).first()
+        if item is None:
+            return None
+        item.quantity = quantity
+        item.save()
+        return item
+
+    def remove(self, user, key: ItemKey) -> bool:
+        """Remove an item; False if it is not in the cart"""
+        product_id, variant_id = key
+        deleted, _ = self.get_items(user).filter(product_id=product_id, variant_id=variant_id).delete()
+        return bool(deleted)
+
+    def clear(self, user) -> None:
+        self.get_items(user).delete()
+
+    def apply(self, user, operations: List[Operation]) -> Cart:
+        """Apply add, set and remove operations in one transaction, returning the cart"""
+        with transaction.atomic():
+            carts = Cart.objects.select_for_update().filter(is_active=True)
+            cart = carts.filter(pk=get_active_cart_id(user)).first()
+            if cart is None:
+                # The cached cart was deactivated behind our back
+                forget_active_cart(user)
+                cart = carts.get(pk=get_active_cart_id(user))
+            existing = {(item.product_id, item.variant_id): item for item in cart.items.all()}
+            quantities = apply_operations({key: item.quantity for key, item in existing.items()}, operations)
+            # Products and variants were validated by the caller
+            sync_cart_items(cart, quantities, existing, check_products=False)
+        prefetch_related_objects([cart], get_items_prefetch())
+        return cart
+
+    def flush(self, user) -> None:
+        """Write the cart back to the database; nothing to do here"""
+
+    def discard(self, user) -> None:
+        """Forget the stored copy of the cart after checkout; nothing to do here"""
+
+
+def upsert_cart_item(cart: Cart, key: ItemKey, quantity: int) -> Optional[CartItem]:
+    """
+    Add ``quantity`` of an item to a cart in one statement: insert it, or add
+    to the quantity of the existing item. Concurrent adds neither lose updates
+    nor fail on the unique constraints. Returns None, writing nothing, if the
+    cart is no longer active.
+    """
+    product_id, variant_id = key
+    now = timezone.now()
+    features = connection.features
+    if not (features.supports_update_conflicts_with_target and features.can_return_columns_from_insert):
+        return _update_or_create_cart_item(cart, key, quantity, now)
+
+    quote = connection.ops.quote_name
+    table = quote(CartItem._meta.db_table)
+    # The arbiter must match one of the unique constraints exactly
+    if variant_id is None:
+        target = '(cart_id, product_id) WHERE variant_id IS NULL'
+    else:
+        target = '(cart_id, product_id, variant_id)'
+    sql = UPSERT_SQL.format(table=table, cart_table=quote(Cart._meta.db_table), target=target)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [cart.id, product_id, variant_id, quantity, now, now, cart.id])
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    item_id, quantity, added_at = row
+    return CartItem(
+        id=item_id, cart=cart, product_id=product_id, variant_id=variant_id, quantity=quantity,
+        added_at=added_at, updated_at=now,
+    )
+
+
+def _update_or_create_cart_item(cart: Cart, key: ItemKey, quantity: int, now) -> Optional[CartItem]:
+    """``upsert_cart_item`` for databases without INSERT ... ON CONFLICT ... RETURNING"""
+    product_id, variant_id = key
+    items = CartItem.objects.filter(cart=cart, product_id=product_id, variant_id=variant_id)
+    with transaction.atomic():
+        if not Cart.objects.select_for_update().filter(id=cart.id, is_active=True).exists():
+            return None
+        if not items.update(quantity=F('quantity') + quantity, updated_at=now):
+            try:
+                with transaction.atomic():
+                    return CartItem.objects.create(
+                        cart=cart, product_id=product_id, variant_id=variant_id, quantity=quantity
+                    )
+            except IntegrityError:
+                # Added concurrently; add to it instead
+                items.update(quantity=F('quantity') + quantity, updated_at=now)
+    return items.get()
+
+
+def item_field(key: ItemKey) -> str:
+    product_id, variant_id = key
+    return f"{product_id}:{variant_id or 0}"
+
+
+def parse_item_field(field: str) -> ItemKey:
+    product_id, variant_id = field.split(':')
+    return int(product_id), int(variant_id) or None
+
+
+def decode_hash(values: List[Any]) -> Dict[str, str]:
+    """Return the field -> value dict of a raw HGETALL reply"""
+    values = [value.decode() if isinstance(value, bytes) else value for value in values]
+    return dict(zip(values[::2], values[1::2]))
+
+
+def get_item_quantities(values: Dict[str, str]) -> Dict[ItemKey, int]:
+    """Return the item quantities of a raw cart hash"""
+    return {
+        parse_item_field(field): int(quantity)
+        for field, quantity in values.items() if not field.startswith('_')
+    }
+
+
+def apply_operations(quantities: Dict[ItemKey, int], operations: List[Operation]) -> Dict[ItemKey, int]:
+    """Return ``quantities`` after the add, set and remove operations, as MUTATE_SCRIPT applies them"""
+    quantities = dict(quantities)
+    for op, key, quantity in operations:
+        if op == 'add':
+            quantities[key] = quantities.get(key, 0) + quantity
+        elif op == 'set':
+            quantities[key] = quantity
+        elif op == 'remove':
+            quantities.pop(key, None)
+    return {key: quantity for key, quantity in quantities.items() if quantity > 0}
+
+
+def filter_existing_items(quantities: Dict[ItemKey, int]) -> Dict[ItemKey, int]:
+    """Drop the items whose product or variant no longer exists, with one query for each"""
+    from apps.products.models import Product, ProductVariant
+
+    product_ids = set(Product.objects.filter(id__in={p for p, v in quantities}).values_list('id', flat=True))
+    variant_ids = set(ProductVariant.objects.filter(
+        id__in={v for p, v in quantities if v}
+    ).values_list('id', flat=True))
+    return {
+        (product_id, variant_id): quantity for (product_id, variant_id), quantity in quantities.items()
+        if product_id in product_ids and (variant_id is None or variant_id in variant_ids)
+    }
+
+
+def sync_cart_items(cart: Cart, quantities: Dict[ItemKey, int], existing: Dict[ItemKey, CartItem],
+                    check_products: bool = True) -> None:
+    """Make the ``existing`` items of a locked cart match ``quantities`` with bulk writes"""
+    stale = [item.id for key, item in existing.items() if key not in quantities]
+    if stale:
+        CartItem.objects.filter(id__in=stale).delete()
+
+    now = timezone.now()
+    changed = []
+    for key, item in existing.items():
+        if key in quantities and item.quantity != quantities[key]:
+            item.quantity = quantities[key]
+            item.updated_at = now
+            changed.append(item)
+    if changed:
+        CartItem.objects.bulk_update(changed, ['quantity', 'updated_at'])
+
+    new = {key: quantity for key, quantity in quantities.items() if key not in existing}
+    if new and check_products:
+        # Skip items whose product or variant was deleted meanwhile
+        new = filter_existing_items(new)
+    if new:
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product_id=product_id, variant_id=variant_id, quantity=quantity)
+            for (product_id, variant_id), quantity in new.items()
+        ])
+
+
+def persist_cart(cart_id: int, quantities: Dict[ItemKey, int]) -> bool:
+    """Make the items of a cart match ``quantities``; False if the cart is no longer active"""
+    with transaction.atomic():
+        # Serialize flushes of the same cart (timer and checkout)
+        cart = Cart.objects.select_for_update().filter(id=cart_id, is_active=True).first()
+        if cart is None:
+            return False
+        existing = {(item.product_id, item.variant_id): item for item in cart.items.all()}
+        sync_cart_items(cart, quantities, existing)
+        return True
+
+
+class RedisCartStore:
+    """Carts kept in Redis hashes and written back to the database in batches"""
+
+    def __init__(self, cache=default_cache, config: Optional[Dict[str, Any]] = None):
+        config = config or get_config()
+        self.cache = cache
+        self.ttl = config['TTL']
+        self.flush_interval = config['FLUSH_INTERVAL']
+        self.flush_batch_size = config['FLUSH_BATCH_SIZE']
+        self.database = DatabaseCartStore()
+        self._flusher = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def eval(self, script: str, keys: List[str], args: List[Any], fallback):
+        client = self.cache.client
+        return client.eval_script(script, keys=[client.make_key(key) for key in keys], args=args, fallback=fallback)
+
+    def get_keys(self, user_id) -> List[str]:
+        return [f"{KEY_PREFIX}{user_id}", DIRTY_KEY]
+
+    def read(self, user_id) -> Optional[Dict[str, str]]:
+        """Return the raw cart hash, or None if it is not loaded"""
+        values = self.eval(READ_SCRIPT, self.get_keys(user_id)[:1], [], fallback=lambda: None)
+        if not values:
+            return None
+        return decode_hash(values)
+
+    def load(self, user) -> None:
+        """Copy the user's active cart from the database into Redis"""
+        cart_id = get_checked_active_cart_id(user)
+        items = CartItem.objects.filter(cart_id=cart_id).values_list('product_id', 'variant_id', 'quantity')
+        args = [self.ttl, cart_id, sum(quantity for _, _, quantity in items)]
+        for product_id, variant_id, quantity in items:
+            args.extend((item_field((product_id, variant_id)), quantity))
+        self.eval(LOAD_SCRIPT, self.get_keys(user.id)[:1], args, fallback=lambda: 0)
+
+    def mutate(self, user, operations: List[Tuple[str, Optional[ItemKey], int]]) -> Optional[List[int]]:
+        """Apply cart operations atomically; None if Redis is unavailable"""
+        keys = self.get_keys(user.id)
+        args = [self.ttl, user.id]
+        for op, key, quantity in operations:
+            args.extend((op, item_field(key) if key else '', quantity))
+        result = self.eval(MUTATE_SCRIPT, keys, args, fallback=lambda: None)
+        if result == -1:
+            self.load(user)
+            result = self.eval(MUTATE_SCRIPT, keys, args, fallback=lambda: None)
+        self.start_flusher()
+        return result
+
+    def get_quantities(self, user) -> Tuple[Optional[int], Dict[ItemKey, int]]:
+        """Return the cart id and item quantities, loading the cart if needed"""
+        values = self.read(user.id)
+        if values is None:
+            self.load(user)
+            values = self.read(user.id)
+        if values is None:
+            # Circuit open
+            return None, {}
+        return int(values['_cart_id']), get_item_quantities(values)
+
+    def get_cart(self, user) -> Cart:
+        """Return the active cart with unsaved items built from Redis"""
+        cart_id, quantities = self.get_quantities(user)
+        if cart_id is None:
+            return self.database.get_cart(user)
+        return build_cart(Cart(id=cart_id, user=user, is_active=True), quantities)
+
+    def forget_stale(self, user) -> None:
+        """
+        Delete the Redis copy of a cart written in the database while Redis
+        was unavailable; with the circuit open the delete is queued until it
+        closes.
+        """
+        self.cache.delete(self.get_keys(user.id)[0])
+
+    def add(self, user, key: ItemKey, quantity: int) -> CartItem:
+        results = self.mutate(user, [('add', key, quantity)])
+        if results is None:
+            item = self.database.add(user, key, quantity)
+            self.forget_stale(user)
+            return item
+        return CartItem(product_id=key[0], variant_id=key[1], quantity=results[0])
+
+    def set_quantity(self, user, key: ItemKey, quantity: int) -> Optional[CartItem]:
+        results = self.mutate(user, [('update', key, quantity)])
+        if results is None:
+            item = self.database.set_quantity(user, key, quantity)
+            self.forget_stale(user)
+            return item
+        if results[0] == -2:
+            return None
+        return CartItem(product_id=key[0], variant_id=key[1], quantity=results[0])
+
+    def remove(self, user, key: ItemKey) -> bool:
+        results = self.mutate(user, [('remove', key, 0)])
+        if results is None:
+            removed = self.database.remove(user, key)
+            self.forget_stale(user)
+            return removed
+        return results[0] != -2
+
+    def clear(self, user) -> None:
+        if self.mutate(user, [('clear', None, 0)]) is None:
+            self.database.clear(user)
+            self.forget_stale(user)
+
+    def apply(self, user, operations: List[Operation]) -> Cart:
+        if self.mutate(user, operations) is None:
+            cart = self.database.apply(user, operations)
+            self.forget_stale(user)
+            return cart
+        return self.get_cart(user)
+
+    def flush(self, user) -> None:
+        self.flush_user(user.id)
+
+    def flush_user(self, user_id) -> bool:
+        """Write one cart back to the database; False if Redis is unavailable"""
+        keys = self.get_keys(user_id)
+        values = self.read(user_id)
+        if values is None:
+            # Expired or discarded; there is nothing newer than the database
+            return self.eval(MARK_CLEAN_SCRIPT, keys, ['', user_id], fallback=lambda: False) is not False
+
+        # Skip the database when nothing changed since the last flush
+        if values['_version'] != values['_flushed']:
+            quantities = get_item_quantities(values)
+            if not persist_cart(int(values['_cart_id']), quantities):
+                # Checked out or expired elsewhere; start over from the database
+                self.eval(DISCARD_SCRIPT, keys, [user_id], fallback=lambda: 0)
+                CacheManager.invalidate_active_cart(user_id)
+                return True
+        self.eval(MARK_CLEAN_SCRIPT, keys, [values['_version'], user_id], fallback=lambda: 0)
+        return True
+
+    def flush_due(self, min_age: Optional[float] = None) -> int:
+        """Flush carts dirty for at least ``min_age`` seconds, one batch; return how many"""
+        min_age = self.flush_interval if min_age is None else min_age
+        user_ids = self.eval(DUE_SCRIPT, [DIRTY_KEY], [min_age, self.flush_batch_size], fallback=lambda: [])
+        flushed = 0
+        for user_id in user_ids:
+            user_id = user_id.decode() if isinstance(user_id, bytes) else user_id
+            try:
+                if self.flush_user(user_id):
+                    flushed += 1
+            except Exception:
+                logger.exception(f"Failed to flush cart of user {user_id}")
+        return flushed
+
+    def discard(self, user) -> None:
+        self.discard_user(user.id)
+
+    def discard_user(self, user_id) -> None:
+        """Drop the Redis copy of a cart whose database cart is no longer active"""
+        self.eval(DISCARD_SCRIPT, self.get_keys(user_id), [user_id], fallback=lambda: 0)
+
+    def start_flusher(self) -> None:
+        """Start the background flusher of this process on first use"""
+        if self._flusher is None or self._pid != os.getpid():
+            with self._lock:
+                if self._flusher is None or self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._flusher = threading.Thread(target=self._run, name='cart-flusher', daemon=True)
+                    self._flusher.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                # Keep flushing while full batches are due
+                while self.flush_due() >= self.flush_batch_size:
+                    pass
+            except Exception as e:
+                logger.warning(f"Cart flush failed: {e}")
+            finally:
+                close_old_connections()
+
+
+def new_guest_token() -> str:
+    """Return a new signed guest cart token"""
+    return signing.Signer(salt=GUEST_TOKEN_SALT).sign(uuid.uuid4().hex)
+
+
+def get_guest_cart_id(token: Optional[str]) -> Optional[str]:
+    """Return the guest cart id of a signed token; None if it is missing or was tampered with"""
+    if not token:
+        return None
+    try:
+        return signing.Signer(salt=GUEST_TOKEN_SALT).unsign(token)
+    except signing.BadSignature:
+        return None
+
+
+class GuestCartStore:
+    """
+    Carts of anonymous shoppers, one cache entry per cart (item field ->
+    quantity), kept for ``GUEST_TTL`` seconds after the last change. Takes the
+    guest cart id where the other stores take the user. Changes are atomic
+    within the process only, which is enough for a local-memory cache; with
+    Redis, ``RedisGuestCartStore`` is used.
+    """
+
+    def __init__(self, cache=default_cache, config: Optional[Dict[str, Any]] = None):
+        config = config or get_config()
+        self.cache = cache
+        self.ttl = config['GUEST_TTL']
+        self._lock = threading.Lock()
+
+    def get_key(self, guest_id: str) -> str:
+        return f"{KEY_PREFIX}guest:{guest_id}"
+
+    def get_quantities(self, guest_id: str) -> Dict[ItemKey, int]:
+        return get_item_quantities(self.cache.get(self.get_key(guest_id)) or {})
+
+    def save(self, guest_id: str, quantities: Dict[ItemKey, int]) -> None:
+        if quantities:
+            values = {item_field(key): quantity for key, quantity in quantities.items()}
+            self.cache.set(self.get_key(guest_id), values, self.ttl)
+        else:
+            self.cache.delete(self.get_key(guest_id))
+
+    def get_cart(self, guest_id: str) -> Cart:
+        """Return an unsaved cart with the guest's items"""
+        return build_cart(Cart(id=GUEST_CART_ID, is_active=True), self.get_quantities(guest_id))
+
+    def add(self, guest_id: str, key: ItemKey, quantity: int) -> CartItem:
+        with self._lock:
+            quantities = self.get_quantities(guest_id)
+            quantities[key] = quantities.get(key, 0) + quantity
+            self.save(guest_id, quantities)
+        return CartItem(product_id=key[0], variant_id=key[1], quantity=quantities[key])
+
+    def set_quantity(self, guest_id: str, key: ItemKey, quantity: int) -> Optional[CartItem]:
+        with self._lock:
+            quantities = self.get_quantities(guest_id)
+            if key not in quantities:
+                return None
+            quantities[key] = quantity
+            self.save(guest_id, quantities)
+        return CartItem(product_id=key[0], variant_id=key[1], quantity=quantity)
+
+    def remove(self, guest_id: str, key: ItemKey) -> bool:
+        with self._lock:
+            quantities = self.get_quantities(guest_id)
+            if quantities.pop(key, None) is None:
+                return False
+            self.save(guest_id, quantities)
+        return True
+
+    def clear(self, guest_id: str) -> None:
+        self.save(guest_id, {})
+
+    def apply(self, guest_id: str, operations: List[Operation]) -> Cart:
+        with self._lock:
+            quantities = apply_operations(self.get_quantities(guest_id), operations)
+            self.save(guest_id, quantities)
+        return build_cart(Cart(id=GUEST_CART_ID, is_active=True), quantities)
+
+    def pop(self, guest_id: str) -> Dict[ItemKey, int]:
+        """Return the guest's items and forget the cart"""
+        with self._lock:
+            quantities = self.get_quantities(guest_id)
+            self.save(guest_id, {})
+        return quantities
+
+
+class RedisGuestCartStore(GuestCartStore):
+    """
+    Guest carts kept in Redis hashes (item field -> quantity) and changed by
+    Lua scripts, so concurrent requests of one guest never lose an update.
+    While the circuit is open guest carts live in the breaker's local cache.
+    """
+
+    def __init__(self, cache=default_cache, config: Optional[Dict[str, Any]] = None):
+        super().__init__(cache, config)
+        self.local = GuestCartStore(cache.client.fallback, config)
+
+    def eval(self, script: str, guest_id: str, args: List[Any], fallback):
+        client = self.cache.client
+        return client.eval_script(script, keys=[client.make_key(self.get_key(guest_id))], args=args,
+                                  fallback=fallback)
+
+    def mutate(self, guest_id: str, operations: List[Tuple[str, Optional[ItemKey], int]]) -> Optional[List[int]]:
+        """Apply cart operations atomically; None if Redis is unavailable"""
+        args = [self.ttl]
+        for op, key, quantity in operations:
+            args.extend((op, item_field(key) if key else '', quantity))
+        return self.eval(GUEST_MUTATE_SCRIPT, guest_id, args, fallback=lambda: None)
+
+    def get_quantities(self, guest_id: str) -> Dict[ItemKey, int]:
+        values = self.eval(READ_SCRIPT, guest_id, [], fallback=lambda: None)
+        if values is None:
+            return self.local.get_quantities(guest_id)
+        return get_item_quantities(decode_hash(values))
+
+    def add(self, guest_id: str, key: ItemKey, quantity: int) -> CartItem:
+        results = self.mutate(guest_id, [('add', key, quantity)])
+        if results is None:
+            return self.local.add(guest_id, key, quantity)
+        return CartItem(product_id=key[0], variant_id=key[1], quantity=results[0])
+
+    def set_quantity(self, guest_id: str, key: ItemKey, quantity: int) -> Optional[CartItem]:
+        results = self.mutate(guest_id, [('update', key, quantity)])
+        if results is None:
+            return self.local.set_quantity(guest_id, key, quantity)
+        if results[0] == -2:
+            return None
+        return CartItem(product_id=key[0], variant_id=key[1], quantity=results[0])
+
+    def remove(self, guest_id: str, key: ItemKey) -> bool:
+        results = self.mutate(guest_id, [('remove', key, 0)])
+        if results is None:
+            return self.local.remove(guest_id, key)
+        return results[0] != -2
+
+    def clear(self, guest_id: str) -> None:
+        if self.mutate(guest_id, [('clear', None, 0)]) is None:
+            self.local.clear(guest_id)
+
+    def apply(self, guest_id: str, operations: List[Operation]) -> Cart:
+        if self.mutate(guest_id, operations) is None:
+            return self.local.apply(guest_id, operations)
+        return self.get_cart(guest_id)
+
+    def pop(self, guest_id: str) -> Dict[ItemKey, int]:
+        values = self.eval(POP_SCRIPT, guest_id, [], fallback=lambda: None)
+        if values is None:
+            return self.local.pop(guest_id)
+        return get_item_quantities(decode_hash(values))
+
+
+def merge_guest_cart(user, token: Optional[str]) -> bool:
+    """
+    Fold the items of the guest cart of ``token`` into the user's active cart
+    with one batch of adds; False if there was nothing to merge.
+    """
+    guest_id = get_guest_cart_id(token)
+    if guest_id is None:
+        return False
+    quantities = get_guest_cart_store().pop(guest_id)
+    if quantities:
+        # Products may have been deleted while the guest cart was idle
+        quantities = filter_existing_items(quantities)
+    if not quantities:
+        return False
+    get_cart_store().apply(user, [('add', key, quantity) for key, quantity in quantities.items()])
+    CacheManager.bump_user_cart_version(user.id)
+    return True
+
+
+_store = None
+_store_lock = threading.Lock()
+_guest_store = None
+
+
+def get_cart_store():
+    """Return the process-wide cart store configured by CART_STORAGE['BACKEND']"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                config = get_config()
+                if config['BACKEND'] == 'redis' and isinstance(getattr(default_cache, 'client', None),
+                                                               CircuitBreakerClient):
+                    _store = RedisCartStore(default_cache, config)
+                else:
+                    if config['BACKEND'] == 'redis':
+                        logger.warning("CART_STORAGE backend 'redis' needs the Redis cache; using the database")
+                    _store = DatabaseCartStore()
+    return _store
+
+
+def get_guest_cart_store() -> GuestCartStore:
+    """Return the process-wide store of guest carts"""
+    global _guest_store
+    if _guest_store is None:
+        with _store_lock:
+            if _guest_store is None:
+                if isinstance(getattr(default_cache, 'client', None), CircuitBreakerClient):
+                    _guest_store = RedisGuestCartStore(default_cache)
+                else:
+                    _guest_store = GuestCartStore()
+    return _guest_store
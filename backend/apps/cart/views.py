@@ -1,38 +1,135 @@
 from rest_framework import viewsets, status, generics
 from rest_framework.decorators import action
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
-from django.core.cache import cache
 from django.db import transaction
+from core.cache_utils import CacheManager
 from .models import Cart, CartItem, Wishlist
+from .services import get_snapshot_prices, validate_cart
+from .storage import (
+    GUEST_TOKEN_HEADER, get_active_cart_id, get_cart_store, get_guest_cart_id, get_guest_cart_store,
+    get_items_prefetch, new_guest_token
+)
 from .serializers import (
     CartSerializer, CartItemSerializer, AddToCartSerializer,
-    UpdateCartItemSerializer, WishlistSerializer
+    UpdateCartItemSerializer, CartBatchSerializer, WishlistSerializer
 )
 
 
+# The serialized cart and its summary are cached together with the version of
+# the cart they were built from. Every change bumps the version and writes the
+# new cart through, so reads are served from the cache and always include the
+# user's own changes. Price changes show up once the entry expires; checkout
+# always prices the cart from the database. Guest carts are read straight from
+# their cache entry.
+
+def build_cart_data(cart):
+    return {'cart': CartSerializer(cart).data, 'summary': cart.totals.as_dict()}
+
+
+def get_cart_data(user):
+    """Return the serialized active cart and summary, from the cache when current"""
+    data = CacheManager.get_cached_user_cart(user.id)
+    if data is None:
+        version = CacheManager.get_user_cart_version(user.id)
+        data = build_cart_data(get_cart_store().get_cart(user))
+        CacheManager.cache_user_cart(user.id, data, version)
+    return data
+
+
+def refresh_cart_cache(user, cart=None):
+    """Bump the cart version and cache the changed cart"""
+    version = CacheManager.bump_user_cart_version(user.id)
+    data = build_cart_data(cart if cart is not None else get_cart_store().get_cart(user))
+    CacheManager.cache_user_cart(user.id, data, version)
+    return data
+
+
 class CartViewSet(viewsets.ModelViewSet):
     """Cart viewset for managing shopping cart"""
     serializer_class = CartSerializer
     permission_classes = [IsAuthenticated]
+    # Actions anonymous shoppers may use on their guest cart
+    guest_actions = {'retrieve', 'create', 'add_item', 'batch', 'update_item', 'remove_item', 'clear', 'summary'}
+
+    def get_permissions(self):
+        """Allow the guest cart actions without authentication"""
+        if self.action in self.guest_actions:
+            return [AllowAny()]
+        return super().get_permissions()
+
+    def get_store(self):
+        """Return the cart store and the cart owner: the user, or the guest cart id"""
+        if self.request.user.is_authenticated:
+            return get_cart_store(), self.request.user
+        token = getattr(self, 'guest_token', None) or self.request.META.get(GUEST_TOKEN_HEADER)
+        guest_id = get_guest_cart_id(token)
+        if guest_id is None:
+            # Sent back in X-Cart-Token by finalize_response
+            self.guest_token = new_guest_token()
+            guest_id = get_guest_cart_id(self.guest_token)
+        return get_guest_cart_store(), guest_id
+
+    def get_cart_data(self):
+        if self.request.user.is_authenticated:
+            return get_cart_data(self.request.user)
+        store, guest_id = self.get_store()
+        return build_cart_data(store.get_cart(guest_id))
+
+    def cart_changed(self, cart=None):
+        """Write the changed cart through to the cache; guest carts are not cached"""
+        if self.request.user.is_authenticated:
+            return refresh_cart_cache(self.request.user, cart)
+        return build_cart_data(cart) if cart is not None else None
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        guest_token = getattr(self, 'guest_token', None)
+        if guest_token:
+            response['X-Cart-Token'] = guest_token
+        return super().finalize_response(request, response, *args, **kwargs)
 
     def get_queryset(self):
         """Get user's active cart"""
-        return Cart.objects.filter(user=self.request.user, is_active=True)
+        return Cart.objects.filter(user=self.request.user, is_active=True).prefetch_related(
+            get_items_prefetch()
+        )
+
+    def list(self, request, *args, **kwargs):
+        """List the user's active carts from the database, after writing back a cart held in Redis"""
+        get_cart_store().flush(request.user)
+        return super().list(request, *args, **kwargs)
 
     def get_object(self):
-        """Get or create user's active cart"""
-        cart, created = Cart.objects.get_or_create(
-            user=self.request.user,
-            is_active=True,
-            defaults={'user': self.request.user}
-        )
-        return cart
+        """Get or create user's active cart, with its items"""
+        return get_cart_store().get_cart(self.request.user)
+
+    def get_item_key(self, request):
+        """Return (product_id, variant_id) of the item named by item_id or product_id/variant_id"""
+        item_id = request.data.get('item_id')
+        if item_id and request.user.is_authenticated:
+            return CartItem.objects.filter(
+                id=item_id, cart_id=get_active_cart_id(request.user)
+            ).values_list('product_id', 'variant_id').first()
+        # Items still held in Redis have no id yet
+        try:
+            product_id = int(request.data['product_id'])
+            variant_id = int(request.data['variant_id']) if request.data.get('variant_id') else None
+        except (KeyError, TypeError, ValueError):
+            return None
+        return product_id, variant_id
+
+    def retrieve(self, request, *args, **kwargs):
+        """Get user's active cart"""
+        return Response(self.get_cart_data()['cart'])
 
     def create(self, request, *args, **kwargs):
         """Create cart item (add to cart)"""
-        cart = self.get_object()
+        return self.add_item(request)
+
+    @action(detail=True, methods=['post'])
+    def add_item(self, request, pk=None):
+        """Add item to cart"""
         serializer = AddToCartSerializer(data=request.data)
         
         if serializer.is_valid():
@@ -40,30 +137,12 @@ class CartViewSet(viewsets.ModelViewSet):
             variant_id = serializer.validated_data.get('variant_id')
             quantity = serializer.validated_data['quantity']
 
-            # Check if item already exists in cart
-            existing_item = CartItem.objects.filter(
-                cart=cart,
-                product_id=product_id,
-                variant_id=variant_id
-            ).first()
-
-            if existing_item:
-                # Update quantity if item exists
-                existing_item.quantity += quantity
-                existing_item.save()
-                item = existing_item
-            else:
-                # Create new cart item
-                item = CartItem.objects.create(
-                    cart=cart,
-                    product_id=product_id,
-                    variant_id=variant_id,
-                    quantity=quantity
-                )
-
-            # Clear cart cache
-            cache_key = f"cart_{request.user.id}"
-            cache.delete(cache_key)
+            # Adds to the quantity if the item is already in the cart
+            store, owner = self.get_store()
+            item = store.add(owner, (product_id, variant_id), quantity)
+
+            # Write the new cart through to the cache
+            self.cart_changed()
 
             return Response({
                 'message': 'Item added to cart successfully',
@@ -73,75 +152,49 @@ class CartViewSet(viewsets.ModelViewSet):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     @action(detail=True, methods=['post'])
-    def add_item(self, request, pk=None):
-        """Add item to cart"""
-        cart = self.get_object()
-        serializer = AddToCartSerializer(data=request.data)
+    def batch(self, request, pk=None):
+        """Apply several add, set and remove operations at once"""
+        serializer = CartBatchSerializer(data=request.data)
         
         if serializer.is_valid():
-            product_id = serializer.validated_data['product_id']
-            variant_id = serializer.validated_data.get('variant_id')
-            quantity = serializer.validated_data['quantity']
+            operations = [
+                (operation['op'], (operation['product_id'], operation.get('variant_id')), operation.get('quantity', 0))
+                for operation in serializer.validated_data['operations']
+            ]
+            store, owner = self.get_store()
+            cart = store.apply(owner, operations)
 
-            # Check if item already exists in cart
-            existing_item = CartItem.objects.filter(
-                cart=cart,
-                product_id=product_id,
-                variant_id=variant_id
-            ).first()
-
-            if existing_item:
-                # Update quantity if item exists
-                existing_item.quantity += quantity
-                existing_item.save()
-                item = existing_item
-            else:
-                # Create new cart item
-                item = CartItem.objects.create(
-                    cart=cart,
-                    product_id=product_id,
-                    variant_id=variant_id,
-                    quantity=quantity
-                )
-
-            # Clear cart cache
-            cache_key = f"cart_{request.user.id}"
-            cache.delete(cache_key)
+            # Write the new cart through to the cache
+            data = self.cart_changed(cart)
 
-            return Response({
-                'message': 'Item added to cart successfully',
-                'item': CartItemSerializer(item).data
-            }, status=status.HTTP_201_CREATED)
+            return Response(data['cart'])
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     @action(detail=True, methods=['put'])
     def update_item(self, request, pk=None):
         """Update cart item quantity"""
-        cart = self.get_object()
-        item_id = request.data.get('item_id')
+        key = self.get_item_key(request)
         quantity = request.data.get('quantity')
 
-        if not item_id or not quantity:
+        if not (request.data.get('item_id') or request.data.get('product_id')) or not quantity:
             return Response({
-                'error': 'item_id and quantity are required'
+                'error': 'item_id (or product_id) and quantity are required'
             }, status=status.HTTP_400_BAD_REQUEST)
 
-        try:
-            item = CartItem.objects.get(id=item_id, cart=cart)
-        except CartItem.DoesNotExist:
-            return Response({
-                'error': 'Cart item not found'
-            }, status=status.HTTP_404_NOT_FOUND)
-
         serializer = UpdateCartItemSerializer(data={'quantity': quantity})
         if serializer.is_valid():
-            item.quantity = serializer.validated_data['quantity']
-            item.save()
+            item = None
+            if key is not None:
+                store, owner = self.get_store()
+                item = store.set_quantity(owner, key, serializer.validated_data['quantity'])
+            if item is None:
+                return Response({
+                    'error': 'Cart item not found'
+                }, status=status.HTTP_404_NOT_FOUND)
 
-            # Clear cart cache
-            cache_key = f"cart_{request.user.id}"
-            cache.delete(cache_key)
+            # Write the new cart through to the cache
+            self.cart_changed()
 
             return Response({
                 'message': 'Cart item updated successfully',
@@ -153,39 +206,33 @@ class CartViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['delete'])
     def remove_item(self, request, pk=None):
         """Remove item from cart"""
-        cart = self.get_object()
-        item_id = request.data.get('item_id')
-
-        if not item_id:
+        if not (request.data.get('item_id') or request.data.get('product_id')):
             return Response({
-                'error': 'item_id is required'
+                'error': 'item_id (or product_id) is required'
             }, status=status.HTTP_400_BAD_REQUEST)
 
-        try:
-            item = CartItem.objects.get(id=item_id, cart=cart)
-            item.delete()
-
-            # Clear cart cache
-            cache_key = f"cart_{request.user.id}"
-            cache.delete(cache_key)
-
-            return Response({
-                'message': 'Item removed from cart successfully'
-            })
-        except CartItem.DoesNotExist:
+        key = self.get_item_key(request)
+        store, owner = self.get_store()
+        if key is None or not store.remove(owner, key):
             return Response({
                 'error': 'Cart item not found'
             }, status=status.HTTP_404_NOT_FOUND)
 
+        # Write the new cart through to the cache
+        self.cart_changed()
+
+        return Response({
+            'message': 'Item removed from cart successfully'
+        })
+
     @action(detail=True, methods=['post'])
     def clear(self, request, pk=None):
         """Clear all items from cart"""
-        cart = self.get_object()
-        cart.items.all().delete()
+        store, owner = self.get_store()
+        store.clear(owner)
 
-        # Clear cart cache
-        cache_key = f"cart_{request.user.id}"
-        cache.delete(cache_key)
+        # Write the new cart through to the cache
+        self.cart_changed()
 
         return Response({
             'message': 'Cart cleared successfully'
@@ -194,14 +241,16 @@ class CartViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['get'])
     def summary(self, request, pk=None):
         """Get cart summary"""
-        cart = self.get_object()
-        
-        return Response({
-            'total_items': cart.total_items,
-            'total_price': cart.total_price,
-            'total_discount': cart.total_discount,
-            'item_count': cart.items.count()
-        })
+        return Response(self.get_cart_data()['summary'])
+
+    @action(detail=True, methods=['get'])
+    def validate(self, request, pk=None):
+        """Check availability, active status and price changes of every item"""
+        get_cart_store().flush(request.user)
+        # Compare with the prices of the cart the shopper was last shown
+        snapshot = CacheManager.get_cached_user_cart(request.user.id)
+        snapshot_prices = get_snapshot_prices(snapshot['cart'] if snapshot else None)
+        return Response(validate_cart(get_active_cart_id(request.user), snapshot_prices))
 
 
 class WishlistViewSet(viewsets.ModelViewSet):
@@ -267,14 +316,17 @@ class WishlistViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['post'])
     def move_to_cart(self, request):
         """Move wishlist item to cart"""
-        product_id = request.data.get('product_id')
-        quantity = request.data.get('quantity', 1)
-        
-        if not product_id:
+        if not request.data.get('product_id'):
             return Response({
                 'error': 'product_id is required'
             }, status=status.HTTP_400_BAD_REQUEST)
 
+        serializer = AddToCartSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        product_id = serializer.validated_data['product_id']
+        quantity = serializer.validated_data['quantity']
+
         try:
             # Get wishlist item
             wishlist_item = Wishlist.objects.get(
@@ -282,26 +334,12 @@ class WishlistViewSet(viewsets.ModelViewSet):
                 product_id=product_id
             )
             
-            # Get or create cart
-            cart, created = Cart.objects.get_or_create(
-                user=request.user,
-                is_active=True,
-                defaults={'user': request.user}
-            )
-            
             # Add to cart
-            cart_item, created = CartItem.objects.get_or_create(
-                cart=cart,
-                product=wishlist_item.product,
-                defaults={'quantity': quantity}
-            )
-            
-            if not created:
-                cart_item.quantity += quantity
-                cart_item.save()
+            cart_item = get_cart_store().add(request.user, (wishlist_item.product_id, None), quantity)
             
             # Remove from wishlist
             wishlist_item.delete()
+            refresh_cart_cache(request.user)
             
             return Response({
                 'message': 'Product moved to cart successfully',
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+from apps.notifications.outbox import get_config, send_batch
+
+
+class Command(BaseCommand):
+    help = 'Send the emails queued in the outbox, in batches over one mail connection each'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Drain the outbox once and exit instead of polling')
+        parser.add_argument('--batch-size', type=int, help='Emails sent per connection (default: EMAIL_OUTBOX)')
+
+    def handle(self, *args, **options):
+        config = get_config()
+        if options['batch_size']:
+            config['BATCH_SIZE'] = options['batch_size']
+
+        total = 0
+        while True:
+            claimed = send_batch(config)
+            total += claimed
+            if claimed:
+                self.stdout.write(f'Processed {claimed} emails')
+            if claimed < config['BATCH_SIZE']:
+                if options['once']:
+                    break
+                time.sleep(config['POLL_INTERVAL'])
+        self.stdout.write(self.style.SUCCESS(f'Processed {total} emails'))
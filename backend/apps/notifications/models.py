@@ -2,6 +2,7 @@ from django.db import models
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
 from apps.products.models import Product
 from apps.orders.models import Order
 from decimal import Decimal
@@ -285,6 +286,38 @@ class NotificationLog(models.Model):
         return f"{self.notification.title} - {self.channel} - {self.status}"
 
 
+class OutboxEmail(models.Model):
+    """Email queued in the request's transaction, sent by the send_outbox_emails worker"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ]
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255)
+    to = models.JSONField(default=list)
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    # Also leased forward while a worker is sending the email
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, null=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['next_attempt_at']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {', '.join(self.to)} - {self.status}"
+
+
 class PriceAlert(models.Model):
     """Price drop alerts for products"""
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='price_alerts')
@@ -0,0 +1,129 @@
+"""
+Transactional email outbox.
+
+Requests never talk to the mail server. ``queue_email`` inserts an
+``OutboxEmail`` row, in the request's transaction when there is one, so an
+email is queued if and only if the change it describes is committed. The
+``send_outbox_emails`` worker drains the outbox:
+
+* it claims a batch of due emails in a short transaction, leasing them
+  (``next_attempt_at`` moves ``LEASE`` seconds ahead) so parallel workers
+  skip them, with ``SKIP LOCKED`` where the database supports it;
+* it sends the whole batch over one mail connection;
+* failed emails are retried after ``RETRY_BACKOFF`` seconds, doubling per
+  attempt up to ``MAX_BACKOFF``, and marked failed after ``MAX_ATTEMPTS``.
+
+Delivery is at least once: if a worker dies mid-batch, the unsent part of its
+batch is retried once the lease expires.
+"""
+import logging
+from datetime import timedelta
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from .models import OutboxEmail
+
+logger = logging.getLogger(__name__)
+
+
+def get_config() -> Dict[str, Any]:
+    """Return the EMAIL_OUTBOX setting merged over the defaults"""
+    config = {
+        'BATCH_SIZE': 100,
+        'MAX_ATTEMPTS': 5,
+        'RETRY_BACKOFF': 60,
+        'MAX_BACKOFF': 60 * 60,
+        'LEASE': 5 * 60,
+        'POLL_INTERVAL': 5,
+    }
+    config.update(getattr(settings, 'EMAIL_OUTBOX', {}))
+    return config
+
+
+def queue_email(subject: str, message: str, recipient_list: List[str],
+                from_email: Optional[str] = None) -> OutboxEmail:
+    """Queue an email for the outbox worker; costs one INSERT"""
+    return OutboxEmail.objects.create(
+        subject=subject,
+        body=message,
+        from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+        to=list(recipient_list),
+    )
+
+
+def get_retry_delay(attempts: int, config: Dict[str, Any]) -> timedelta:
+    """Exponential backoff after the ``attempts``-th failure"""
+    return timedelta(seconds=min(config['RETRY_BACKOFF'] * 2 ** (attempts - 1), config['MAX_BACKOFF']))
+
+
+def claim_batch(batch_size: int, lease: float) -> List[OutboxEmail]:
+    """Lease up to ``batch_size`` due emails to this worker"""
+    now = timezone.now()
+    with transaction.atomic():
+        emails = list(
+            OutboxEmail.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', next_attempt_at__lte=now)
+            .order_by('next_attempt_at')[:batch_size]
+        )
+        if emails:
+            OutboxEmail.objects.filter(id__in=[email.id for email in emails]).update(
+                next_attempt_at=now + timedelta(seconds=lease)
+            )
+    return emails
+
+
+def send_batch(config: Optional[Dict[str, Any]] = None, connection=None) -> int:
+    """Send one batch of due emails over one connection; return how many were claimed"""
+    config = config or get_config()
+    emails = claim_batch(config['BATCH_SIZE'], config['LEASE'])
+    if not emails:
+        return 0
+
+    connection = connection or get_connection()
+    now = timezone.now()
+    try:
+        connection.open()
+    except Exception as e:
+        # Mail server unreachable; the whole batch counts as an attempt
+        logger.warning(f"Could not connect to the mail server: {e}")
+        for email in emails:
+            record_failure(email, e, now, config)
+        OutboxEmail.objects.bulk_update(emails, ['status', 'attempts', 'next_attempt_at', 'last_error'])
+        return len(emails)
+
+    try:
+        for email in emails:
+            message = EmailMessage(email.subject, email.body, email.from_email, email.to, connection=connection)
+            try:
+                message.send()
+            except Exception as e:
+                logger.warning(f"Failed to send outbox email {email.id}: {e}")
+                record_failure(email, e, now, config)
+            else:
+                email.status = 'sent'
+                email.attempts += 1
+                email.sent_at = timezone.now()
+                email.last_error = None
+    finally:
+        # Record what was sent first, so nothing is sent twice if closing fails
+        OutboxEmail.objects.bulk_update(emails, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at'])
+        try:
+            connection.close()
+        except Exception as e:
+            logger.warning(f"Failed to close the mail connection: {e}")
+    return len(emails)
+
+
+def record_failure(email: OutboxEmail, error: Exception, now, config: Dict[str, Any]) -> None:
+    """Schedule a retry of a failed email, or give up after MAX_ATTEMPTS"""
+    email.attempts += 1
+    email.last_error = str(error)
+    if email.attempts >= config['MAX_ATTEMPTS']:
+        email.status = 'failed'
+        logger.error(f"Giving up on outbox email {email.id} after {email.attempts} attempts: {error}")
+    else:
+        email.next_attempt_at = now + get_retry_delay(email.attempts, config)
@@ -0,0 +1,148 @@
+import threading
+import time
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, transaction
+
+from apps.cart.models import CartItem
+from apps.products.models import Category, Product
+from apps.products.stock import reserve_stock
+from core.exceptions import OutOfStock
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Run parallel checkouts of one SKU and check stock reservation for oversell and throughput'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16, help='Parallel checkouts')
+        parser.add_argument('--checkouts', type=int, default=500, help='Checkouts attempted in total')
+        parser.add_argument('--stock', type=int, default=200, help='Starting stock of the SKU')
+        parser.add_argument('--quantity', type=int, default=1, help='Units bought per checkout')
+        parser.add_argument(
+            '--strategy', action='append', choices=['conditional', 'locked', 'naive'],
+            help='Strategies to compare (default: all). conditional is reserve_stock, locked is '
+                 'SELECT ... FOR UPDATE then save, naive is read, check and save without a lock'
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite':
+            self.stdout.write(self.style.WARNING(
+                'SQLite serializes all writes; run against PostgreSQL for meaningful numbers'
+            ))
+        strategies = options['strategy'] or ['conditional', 'locked', 'naive']
+
+        self.stdout.write(
+            f"{options['checkouts']} checkouts of {options['quantity']} on {options['threads']} threads, "
+            f"stock {options['stock']}\n"
+        )
+        self.stdout.write(
+            f"{'strategy':<13}{'sold':>7}{'refused':>9}{'errors':>8}{'stock left':>12}{'oversold':>10}"
+            f"{'checkouts/s':>13}{'p95 ms':>9}"
+        )
+        oversold_any = False
+        for strategy in strategies:
+            result = self.run(strategy, options)
+            oversold_any = oversold_any or (strategy != 'naive' and result['oversold'])
+            self.stdout.write(
+                f"{strategy:<13}{result['sold']:>7}{result['refused']:>9}{result['errors']:>8}"
+                f"{result['stock_left']:>12}{result['oversold']:>10}{result['throughput']:>13.1f}"
+                f"{result['p95_ms']:>9.1f}"
+            )
+        if oversold_any:
+            raise CommandError('Stock was oversold')
+
+    def run(self, strategy, options):
+        """Run the checkouts of one strategy against a fresh product"""
+        product = self.create_product(options['stock'])
+        reserve = getattr(self, f'reserve_{strategy}')
+        remaining = [options['checkouts']]
+        counts = {'sold': 0, 'refused': 0, 'errors': 0}
+        latencies = []
+        lock = threading.Lock()
+
+        def worker():
+            try:
+                while True:
+                    with lock:
+                        if remaining[0] == 0:
+                            return
+                        remaining[0] -= 1
+                    started = time.perf_counter()
+                    try:
+                        with transaction.atomic():
+                            outcome = 'sold' if reserve(product, options['quantity']) else 'refused'
+                    except OutOfStock:
+                        outcome = 'refused'
+                    except DatabaseError:
+                        # Deadlocks, lock timeouts, SQLite busy
+                        outcome = 'errors'
+                    with lock:
+                        counts[outcome] += 1
+                        latencies.append(time.perf_counter() - started)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        stock_left = Product.objects.values_list('stock_quantity', flat=True).get(pk=product.pk)
+        self.delete_product(product)
+        latencies.sort()
+        sold_units = counts['sold'] * options['quantity']
+        return dict(
+            counts,
+            stock_left=stock_left,
+            # Units sold without being taken from the stock (lost updates)
+            oversold=max(sold_units - (options['stock'] - stock_left), 0),
+            throughput=options['checkouts'] / elapsed,
+            p95_ms=latencies[int(len(latencies) * 0.95) - 1] * 1000 if latencies else 0,
+        )
+
+    def reserve_conditional(self, product, quantity):
+        reserve_stock([CartItem(product=product, quantity=quantity)])
+        return True
+
+    # The other strategies write with update() too, so no strategy pays for the save signals
+
+    def reserve_locked(self, product, quantity):
+        products = Product.objects.filter(pk=product.pk)
+        stock = products.select_for_update().values_list('stock_quantity', flat=True).get()
+        if stock < quantity:
+            return False
+        products.update(stock_quantity=stock - quantity)
+        return True
+
+    def reserve_naive(self, product, quantity):
+        products = Product.objects.filter(pk=product.pk)
+        stock = products.values_list('stock_quantity', flat=True).get()
+        if stock < quantity:
+            return False
+        products.update(stock_quantity=stock - quantity)
+        return True
+
+    def create_product(self, stock):
+        """Create a throwaway SKU; bulk_create skips the cache invalidation signals"""
+        suffix = uuid.uuid4().hex[:8]
+        user = User.objects.create_user(
+            username=f'stock-benchmark-{suffix}', email=f'stock-benchmark-{suffix}@example.com'
+        )
+        category, = Category.objects.bulk_create([Category(name=f'Benchmark {suffix}', slug=f'benchmark-{suffix}')])
+        product, = Product.objects.bulk_create([Product(
+            name=f'Benchmark {suffix}', slug=f'benchmark-{suffix}', sku=f'BENCH-{suffix}', price='1.00',
+            stock_quantity=stock, category=category, created_by=user,
+        )])
+        return product
+
+    def delete_product(self, product):
+        # Cascades to the product
+        User.objects.filter(pk=product.created_by_id).delete()
+        Category.objects.filter(pk=product.category_id).delete()
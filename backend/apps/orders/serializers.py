@@ -1,9 +1,31 @@
 from rest_framework import serializers
 from .models import Order, OrderItem, OrderStatusHistory, ShippingMethod, TaxRate
 from apps.cart.models import Cart, CartItem
+from apps.cart.services import calculate_cart_totals, validate_cart
+from apps.cart.storage import forget_active_cart, get_active_cart_id, get_cart_store
+from apps.products.stock import record_reservations, reserve_stock
+from core.cache_utils import CacheManager
+from django.db import transaction
+from django.utils import timezone
 from decimal import Decimal
 
 
+def validate_cart_items(cart_id):
+    """Reject an empty cart, or one with items that are inactive or out of stock"""
+    validation = validate_cart(cart_id)
+    if not validation['items']:
+        raise serializers.ValidationError("Cart is empty")
+    errors = []
+    for line in validation['items']:
+        if not line['is_active']:
+            errors.append(f"{line['product_name']} is no longer available")
+        elif not line['is_available']:
+            errors.append(f"Only {line['available_quantity']} of {line['product_name']} available in stock")
+    if errors:
+        raise serializers.ValidationError({'items': errors})
+    return validation
+
+
 class OrderItemSerializer(serializers.ModelSerializer):
     """Serializer for order items"""
     product_name = serializers.CharField(read_only=True)
@@ -75,38 +97,19 @@ class CreateOrderSerializer(serializers.ModelSerializer):
             'shipping_city', 'shipping_state', 'shipping_postal_code', 'shipping_country', 'notes'
         ]
 
-
-class OrderCreateUpdateSerializer(serializers.ModelSerializer):
-    """Serializer for admin order create/update operations"""
-    class Meta:
-        model = Order
-        fields = [
-            'user', 'status', 'payment_status', 'customer_email', 'customer_first_name', 
-            'customer_last_name', 'customer_phone', 'billing_address_line1', 'billing_address_line2',
-            'billing_city', 'billing_state', 'billing_postal_code', 'billing_country',
-            'shipping_address_line1', 'shipping_address_line2', 'shipping_city', 'shipping_state',
-            'shipping_postal_code', 'shipping_country', 'subtotal', 'tax_amount', 'shipping_amount',
-            'discount_amount', 'total_amount', 'payment_method', 'shipping_method', 
-            'tracking_number', 'notes'
-        ]
-        read_only_fields = [
-            'order_number', 'payment_transaction_id', 'payment_date', 'estimated_delivery',
-            'created_at', 'updated_at'
-        ]
-
     def validate(self, attrs):
         """Validate order data"""
         cart_id = attrs.get('cart_id')
         shipping_method_id = attrs.get('shipping_method_id')
         use_same_address = attrs.get('use_same_address', True)
 
-        # Validate cart exists and has items
-        try:
-            cart = Cart.objects.get(id=cart_id, user=self.context['request'].user, is_active=True)
-            if not cart.items.exists():
-                raise serializers.ValidationError("Cart is empty")
-        except Cart.DoesNotExist:
+        # Write back a cart held in Redis before reading it
+        get_cart_store().flush(self.context['request'].user)
+
+        # Validate cart is the user's active cart and has items
+        if cart_id != get_active_cart_id(self.context['request'].user):
             raise serializers.ValidationError("Invalid cart")
+        validate_cart_items(cart_id)
 
         # Validate shipping method
         try:
@@ -114,68 +117,75 @@ class OrderCreateUpdateSerializer(serializers.ModelSerializer):
         except ShippingMethod.DoesNotExist:
             raise serializers.ValidationError("Invalid shipping method")
 
-        # If using same address, copy billing to shipping
+        # If using same address, copy billing to shipping (omitted fields keep their defaults)
         if use_same_address:
-            attrs['shipping_address_line1'] = attrs.get('billing_address_line1')
-            attrs['shipping_address_line2'] = attrs.get('billing_address_line2')
-            attrs['shipping_city'] = attrs.get('billing_city')
-            attrs['shipping_state'] = attrs.get('billing_state')
-            attrs['shipping_postal_code'] = attrs.get('billing_postal_code')
-            attrs['shipping_country'] = attrs.get('billing_country')
+            for field in ('address_line1', 'address_line2', 'city', 'state', 'postal_code', 'country'):
+                if f'billing_{field}' in attrs:
+                    attrs[f'shipping_{field}'] = attrs[f'billing_{field}']
 
         return attrs
 
+    @transaction.atomic
     def create(self, validated_data):
-        """Create order from cart"""
+        """Create order from cart, taking the stock of every line"""
+        user = self.context['request'].user
         cart_id = validated_data.pop('cart_id')
         shipping_method_id = validated_data.pop('shipping_method_id')
-        use_same_address = validated_data.pop('use_same_address', True)
+        validated_data.pop('use_same_address', True)
 
-        # Get cart and shipping method
-        cart = Cart.objects.get(id=cart_id)
         shipping_method = ShippingMethod.objects.get(id=shipping_method_id)
 
-        # Calculate totals
-        subtotal = cart.total_price
+        # Load the lines once, with product and variant, and price them in one pass
+        totals = calculate_cart_totals(Cart(id=cart_id))
+
+        # Raises OutOfStock (409) if another checkout took the stock since validation
+        reservations = reserve_stock(totals.items)
+        subtotal = totals.total_price
         shipping_amount = shipping_method.base_price
         
         # Calculate tax (simplified - you might want to integrate with a tax service)
         tax_amount = self.calculate_tax(validated_data, subtotal)
         
         # Calculate total
-        total_amount = subtotal + tax_amount + shipping_amount - cart.total_discount
+        total_amount = subtotal + tax_amount + shipping_amount - totals.total_discount
 
         # Create order
         order = Order.objects.create(
-            user=self.context['request'].user,
+            user=user,
             subtotal=subtotal,
             tax_amount=tax_amount,
             shipping_amount=shipping_amount,
-            discount_amount=cart.total_discount,
+            discount_amount=totals.total_discount,
             total_amount=total_amount,
             shipping_method=shipping_method.name,
             **validated_data
         )
+        record_reservations(order, reservations)
 
-        # Create order items from cart items
-        for cart_item in cart.items.all():
-            OrderItem.objects.create(
+        # Create order items from the priced cart lines in one INSERT
+        OrderItem.objects.bulk_create([
+            OrderItem(
                 order=order,
-                product=cart_item.product,
-                variant=cart_item.variant,
-                product_name=cart_item.product.name,
-                product_sku=cart_item.product.sku,
-                variant_name=f"{cart_item.variant.name}: {cart_item.variant.value}" if cart_item.variant else None,
-                quantity=cart_item.quantity,
-                unit_price=cart_item.unit_price,
-                total_price=cart_item.total_price,
-                discount_amount=cart_item.total_discount
+                product=line.item.product,
+                variant=line.item.variant,
+                product_name=line.item.product.name,
+                product_sku=line.item.product.sku,
+                variant_name=f"{line.item.variant.name}: {line.item.variant.value}" if line.item.variant else None,
+                quantity=line.item.quantity,
+                unit_price=line.unit_price,
+                total_price=line.total_price,
+                discount_amount=line.total_discount
             )
+            for line in totals.lines
+        ])
 
-        # Clear cart
-        cart.items.all().delete()
-        cart.is_active = False
-        cart.save()
+        # Clear and deactivate the cart with one statement each
+        CartItem.objects.filter(cart_id=cart_id).delete()
+        Cart.objects.filter(id=cart_id).update(is_active=False, updated_at=timezone.now())
+        # update() sends no signals; start the next cart afresh
+        forget_active_cart(user)
+        get_cart_store().discard(user)
+        CacheManager.bump_user_cart_version(user.id)
 
         # Create initial status history
         OrderStatusHistory.objects.create(
@@ -211,6 +221,25 @@ class OrderCreateUpdateSerializer(serializers.ModelSerializer):
             return subtotal * default_tax_rate
 
 
+class OrderCreateUpdateSerializer(serializers.ModelSerializer):
+    """Serializer for admin order create/update operations"""
+    class Meta:
+        model = Order
+        fields = [
+            'user', 'status', 'payment_status', 'customer_email', 'customer_first_name', 
+            'customer_last_name', 'customer_phone', 'billing_address_line1', 'billing_address_line2',
+            'billing_city', 'billing_state', 'billing_postal_code', 'billing_country',
+            'shipping_address_line1', 'shipping_address_line2', 'shipping_city', 'shipping_state',
+            'shipping_postal_code', 'shipping_country', 'subtotal', 'tax_amount', 'shipping_amount',
+            'discount_amount', 'total_amount', 'payment_method', 'shipping_method', 
+            'tracking_number', 'notes'
+        ]
+        read_only_fields = [
+            'order_number', 'payment_transaction_id', 'payment_date', 'estimated_delivery',
+            'created_at', 'updated_at'
+        ]
+
+
 class UpdateOrderStatusSerializer(serializers.Serializer):
     """Serializer for updating order status"""
     status = serializers.ChoiceField(choices=Order.STATUS_CHOICES)
@@ -273,13 +302,13 @@ class CheckoutSerializer(serializers.Serializer):
         """Validate checkout data"""
         cart_id = attrs.get('cart_id')
         
-        # Validate cart exists and has items
-        try:
-            cart = Cart.objects.get(id=cart_id, user=self.context['request'].user, is_active=True)
-            if not cart.items.exists():
-                raise serializers.ValidationError("Cart is empty")
-        except Cart.DoesNotExist:
+        # Write back a cart held in Redis before reading it
+        get_cart_store().flush(self.context['request'].user)
+
+        # Validate cart is the user's active cart and has items
+        if cart_id != get_active_cart_id(self.context['request'].user):
             raise serializers.ValidationError("Invalid cart")
+        validate_cart_items(cart_id)
 
         # Validate shipping method
         shipping_method_id = attrs.get('shipping_method_id')
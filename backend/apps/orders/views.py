@@ -4,7 +4,6 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
 from django.db import transaction
-from django.core.mail import send_mail
 from django.conf import settings
 from .models import Order, OrderItem, OrderStatusHistory, ShippingMethod, TaxRate
 from .serializers import (
@@ -12,6 +11,11 @@ from .serializers import (
     ShippingMethodSerializer, TaxRateSerializer, CheckoutSerializer
 )
 from apps.cart.models import Cart
+from apps.cart.services import aggregate_cart_totals
+from apps.cart.storage import get_active_cart_id, get_cart_store
+from apps.notifications.outbox import queue_email
+from apps.products.stock import release_stock
+from core.exceptions import OutOfStock
 from django.utils import timezone
 
 
@@ -49,16 +53,21 @@ class OrderViewSet(viewsets.ModelViewSet):
     def cancel(self, request, pk=None):
         """Cancel an order"""
         order = self.get_object()
-        
-        if not order.can_be_cancelled:
-            return Response({
-                'error': 'Order cannot be cancelled'
-            }, status=status.HTTP_400_BAD_REQUEST)
 
         with transaction.atomic():
+            # Lock the order so a concurrent cancel cannot release its stock twice
+            order = Order.objects.select_for_update().get(pk=order.pk)
+            if not order.can_be_cancelled:
+                return Response({
+                    'error': 'Order cannot be cancelled'
+                }, status=status.HTTP_400_BAD_REQUEST)
+
             order.status = 'cancelled'
             order.save()
 
+            # Give back the stock taken at checkout
+            release_stock(order)
+
             # Create status history
             OrderStatusHistory.objects.create(
                 order=order,
@@ -130,43 +139,33 @@ class OrderViewSet(viewsets.ModelViewSet):
         })
 
     def send_order_status_email(self, order, status):
-        """Send order status update email"""
-        try:
-            subject = f'Order {order.order_number} - Status Update'
-            
-            if status == 'cancelled':
-                message = f"""
-                Dear {order.customer_first_name},
+        """Queue order status update email; commits or rolls back with the status change"""
+        subject = f'Order {order.order_number} - Status Update'
+        
+        if status == 'cancelled':
+            message = f"""
+            Dear {order.customer_first_name},
 
-                Your order {order.order_number} has been cancelled.
+            Your order {order.order_number} has been cancelled.
 
-                If you have any questions, please contact our support team.
+            If you have any questions, please contact our support team.
 
-                Best regards,
-                Your E-commerce Team
-                """
-            else:
-                message = f"""
-                Dear {order.customer_first_name},
+            Best regards,
+            Your E-commerce Team
+            """
+        else:
+            message = f"""
+            Dear {order.customer_first_name},
 
-                Your order {order.order_number} status has been updated to: {status}
+            Your order {order.order_number} status has been updated to: {status}
 
-                You can track your order at: {settings.SITE_URL}/orders/{order.id}/tracking
+            You can track your order at: {settings.SITE_URL}/orders/{order.id}/tracking
 
-                Best regards,
-                Your E-commerce Team
-                """
+            Best regards,
+            Your E-commerce Team
+            """
 
-            send_mail(
-                subject,
-                message,
-                settings.DEFAULT_FROM_EMAIL,
-                [order.customer_email],
-                fail_silently=True
-            )
-        except Exception as e:
-            # Log the error but don't fail the request
-            print(f"Failed to send email: {e}")
+        queue_email(subject, message, [order.customer_email])
 
 
 class ShippingMethodViewSet(viewsets.ReadOnlyModelViewSet):
@@ -182,10 +181,13 @@ class ShippingMethodViewSet(viewsets.ReadOnlyModelViewSet):
     def calculate_shipping(self, request):
         """Calculate shipping cost for cart"""
         cart_id = request.data.get('cart_id')
+        get_cart_store().flush(request.user)
         
         try:
-            cart = Cart.objects.get(id=cart_id, user=request.user, is_active=True)
-        except Cart.DoesNotExist:
+            cart_id = int(cart_id)
+        except (TypeError, ValueError):
+            cart_id = None
+        if cart_id is None or cart_id != get_active_cart_id(request.user):
             return Response({
                 'error': 'Cart not found'
             }, status=status.HTTP_404_NOT_FOUND)
@@ -205,7 +207,7 @@ class ShippingMethodViewSet(viewsets.ReadOnlyModelViewSet):
             })
 
         return Response({
-            'cart_total': cart.total_price,
+            'cart_total': aggregate_cart_totals(Cart(id=cart_id))['total_price'],
             'shipping_options': shipping_options
         })
 
@@ -292,6 +294,9 @@ class CheckoutView(generics.CreateAPIView):
                     else:
                         return Response(order_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
                         
+            except OutOfStock:
+                # Rendered as 409 with the short lines by the exception handler
+                raise
             except Exception as e:
                 return Response({
                     'error': 'Failed to create order'
@@ -300,35 +305,26 @@ class CheckoutView(generics.CreateAPIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def send_order_confirmation_email(self, order):
-        """Send order confirmation email"""
-        try:
-            subject = f'Order Confirmation - {order.order_number}'
-            
-            message = f"""
-            Dear {order.customer_first_name},
+        """Queue order confirmation email; commits or rolls back with the order"""
+        subject = f'Order Confirmation - {order.order_number}'
+        
+        message = f"""
+        Dear {order.customer_first_name},
 
-            Thank you for your order! Your order has been confirmed and is being processed.
+        Thank you for your order! Your order has been confirmed and is being processed.
 
-            Order Details:
-            Order Number: {order.order_number}
-            Total Amount: ${order.total_amount}
-            Shipping Address: {order.shipping_address_line1}, {order.shipping_city}, {order.shipping_state}
+        Order Details:
+        Order Number: {order.order_number}
+        Total Amount: ${order.total_amount}
+        Shipping Address: {order.shipping_address_line1}, {order.shipping_city}, {order.shipping_state}
 
-            You can track your order at: {settings.SITE_URL}/orders/{order.id}/tracking
+        You can track your order at: {settings.SITE_URL}/orders/{order.id}/tracking
 
-            Best regards,
-            Your E-commerce Team
-            """
+        Best regards,
+        Your E-commerce Team
+        """
 
-            send_mail(
-                subject,
-                message,
-                settings.DEFAULT_FROM_EMAIL,
-                [order.customer_email],
-                fail_silently=True
-            )
-        except Exception as e:
-            print(f"Failed to send confirmation email: {e}")
+        queue_email(subject, message, [order.customer_email])
 
 
 class OrderHistoryView(generics.ListAPIView):
@@ -0,0 +1,161 @@
+from collections import OrderedDict
+from datetime import timedelta
+from decimal import Decimal
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from django_redis.compressors.identity import IdentityCompressor
+from django_redis.serializers.pickle import PickleSerializer
+
+from core.cache_codecs import PayloadCompressor, PayloadSerializer, lz4_frame, msgpack, orjson, zstandard
+
+
+class Command(BaseCommand):
+    help = 'Benchmark cache payload codecs against pickle on product list pages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=20, help='Products per page')
+        parser.add_argument('--pages', type=int, default=50, help='Number of distinct pages')
+        parser.add_argument('--iterations', type=int, default=20, help='Encode/decode rounds per page')
+        parser.add_argument(
+            '--from-db', action='store_true',
+            help='Serialize real products with ProductListSerializer instead of generated ones'
+        )
+
+    def handle(self, *args, **options):
+        pages = self.build_pages(options['pages'], options['page_size'], options['from_db'])
+        if not pages:
+            self.stdout.write(self.style.ERROR('No products to benchmark'))
+            return
+
+        self.stdout.write(
+            f"Benchmarking {len(pages)} pages x {options['page_size']} products, "
+            f"{options['iterations']} iterations\n"
+        )
+        self.stdout.write(f"{'codec':<22}{'bytes/page':>12}{'ratio':>8}{'encode us':>12}{'decode us':>12}")
+
+        baseline_size = None
+        for name, serializer, compressor in self.get_configurations():
+            size, encode_us, decode_us = self.measure(pages, serializer, compressor, options['iterations'])
+            if baseline_size is None:
+                baseline_size = size
+            self.stdout.write(
+                f"{name:<22}{size:>12.0f}{size / baseline_size:>8.2f}{encode_us:>12.1f}{decode_us:>12.1f}"
+            )
+
+    def get_configurations(self):
+        """Codec/compressor combinations to compare, pickle first as the baseline"""
+        configurations = [
+            ('pickle (current)', PickleSerializer({}), IdentityCompressor({})),
+            ('pickle+zlib', PayloadSerializer({'PAYLOAD_CODEC': 'pickle'}), PayloadCompressor({'COMPRESSION': 'zlib'})),
+        ]
+        if msgpack is not None:
+            configurations.append(
+                ('msgpack', PayloadSerializer({'PAYLOAD_CODEC': 'msgpack'}), PayloadCompressor({'COMPRESSION': None}))
+            )
+            if zstandard is not None:
+                configurations.append(
+                    ('msgpack+zstd', PayloadSerializer({'PAYLOAD_CODEC': 'msgpack'}), PayloadCompressor({'COMPRESSION': 'zstd'}))
+                )
+            if lz4_frame is not None:
+                configurations.append(
+                    ('msgpack+lz4', PayloadSerializer({'PAYLOAD_CODEC': 'msgpack'}), PayloadCompressor({'COMPRESSION': 'lz4'}))
+                )
+        if orjson is not None:
+            configurations.append(
+                ('orjson', PayloadSerializer({'PAYLOAD_CODEC': 'orjson'}), PayloadCompressor({'COMPRESSION': None}))
+            )
+            if zstandard is not None:
+                configurations.append(
+                    ('orjson+zstd', PayloadSerializer({'PAYLOAD_CODEC': 'orjson'}), PayloadCompressor({'COMPRESSION': 'zstd'}))
+                )
+        return configurations
+
+    def measure(self, pages, serializer, compressor, iterations):
+        """Return mean bytes, encode and decode microseconds per page"""
+        encoded = [compressor.compress(serializer.dumps(page)) for page in pages]
+        size = sum(len(value) for value in encoded) / len(encoded)
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for page in pages:
+                compressor.compress(serializer.dumps(page))
+        encode_us = (time.perf_counter() - start) / (iterations * len(pages)) * 1e6
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for value in encoded:
+                try:
+                    value = compressor.decompress(value)
+                except Exception:
+                    # Same as django-redis: values below the threshold are stored raw
+                    pass
+                serializer.loads(value)
+        decode_us = (time.perf_counter() - start) / (iterations * len(pages)) * 1e6
+
+        return size, encode_us, decode_us
+
+    def build_pages(self, page_count, page_size, from_db):
+        """Build paginated list payloads shaped like ProductViewSet.list responses"""
+        if from_db:
+            from apps.products.models import Product
+            from apps.products.serializers import ProductListSerializer
+
+            products = list(
+                Product.objects.filter(is_active=True).select_related('category')[:page_count * page_size]
+            )
+            results = ProductListSerializer(products, many=True).data
+        else:
+            results = [self.generate_product(index) for index in range(page_count * page_size)]
+
+        pages = []
+        for start in range(0, len(results), page_size):
+            pages.append(OrderedDict([
+                ('count', len(results)),
+                ('next', f"/api/v1/products/?page={start // page_size + 2}"),
+                ('previous', None),
+                ('results', list(results[start:start + page_size])),
+            ]))
+        return pages
+
+    def generate_product(self, index):
+        """Generate one product in the ProductListSerializer shape"""
+        price = Decimal(random.randint(500, 99999)) / 100
+        created_at = timezone.now() - timedelta(days=random.randint(0, 365))
+        return OrderedDict([
+            ('id', index + 1),
+            ('name', f"Product {index + 1}"),
+            ('slug', f"product-{index + 1}"),
+            ('short_description', 'A short marketing description of the product for catalog pages.'),
+            ('price', price),
+            ('compare_price', price * Decimal('1.20') if index % 3 == 0 else None),
+            ('category', OrderedDict([
+                ('id', index % 5 + 1),
+                ('name', f"Category {index % 5 + 1}"),
+                ('slug', f"category-{index % 5 + 1}"),
+                ('description', 'Category description'),
+                ('image', None),
+                ('parent', None),
+                ('is_active', True),
+                ('children', []),
+                ('product_count', random.randint(10, 500)),
+                ('created_at', created_at.isoformat()),
+            ])),
+            ('primary_image', OrderedDict([
+                ('id', index + 1),
+                ('image', f"/media/products/product-{index + 1}.jpg"),
+                ('alt_text', f"Product {index + 1}"),
+                ('is_primary', True),
+                ('order', 0),
+            ])),
+            ('is_in_stock', True),
+            ('is_low_stock', index % 7 == 0),
+            ('discount_percentage', 16 if index % 3 == 0 else 0),
+            ('is_featured', index % 4 == 0),
+            ('is_bestseller', index % 6 == 0),
+            ('average_rating', round(random.uniform(1, 5), 2)),
+            ('review_count', random.randint(0, 200)),
+            ('created_at', created_at),
+        ])
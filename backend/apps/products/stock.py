@@ -0,0 +1,221 @@
+"""
+Stock reservation at checkout.
+
+``reserve_stock`` takes the stock of every checkout line with one conditional
+UPDATE (``SET stock_quantity = stock_quantity - q WHERE id = ? AND
+stock_quantity >= q``), inside the checkout transaction. The row lock is only
+held from the UPDATE to the end of the transaction, so concurrent checkouts
+of a hot SKU queue on the UPDATE itself instead of on a read-check-save
+round trip, and stock can never go below zero.
+
+Stock is taken from the same source ``validate_cart`` checks: a SKU stocked
+in any active warehouse is reserved there (``reserved_quantity`` is raised
+with the same conditional UPDATE, on as many warehouses as it takes, in
+inventory id order); otherwise lines of a variant take the variant's stock
+and other lines the product's. Products with ``track_inventory`` off are not
+counted.
+
+Lines are taken in (product id, variant id) order, so two checkouts with
+overlapping carts always lock the rows in the same order and cannot
+deadlock.
+
+If any line cannot be covered, ``OutOfStock`` (409) is raised listing every
+such line, and the transaction rolls back the lines already taken.
+
+Warehouse reservations are recorded as ``InventoryTransaction`` rows
+referencing the order number. ``release_stock`` gives a cancelled order's
+stock back from those rows (or to the product/variant stock for lines taken
+there), with the same conditional UPDATEs in the same lock order.
+"""
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from django.db import transaction
+from django.db.models import F
+
+from core.exceptions import OutOfStock
+
+from .models import Product, ProductVariant
+
+
+def get_lock_order(item) -> tuple:
+    return item.product_id, item.variant_id or 0
+
+
+def get_warehouse_stock(items: Iterable) -> Dict[tuple, List[List[int]]]:
+    """
+    Return the [inventory id, available quantity] rows of active warehouses
+    stocking each (product id, variant id or 0) of ``items``, in id order.
+    """
+    from apps.shipping.models import Inventory
+
+    keys = {get_lock_order(item) for item in items}
+    rows = (
+        Inventory.objects.filter(product_id__in={product_id for product_id, _ in keys}, warehouse__is_active=True)
+        .order_by('id')
+        .values_list('id', 'product_id', 'variant_id', 'quantity', 'reserved_quantity')
+    )
+    stock = {}
+    for inventory_id, product_id, variant_id, quantity, reserved in rows:
+        key = (product_id, variant_id or 0)
+        if key in keys:
+            stock.setdefault(key, []).append([inventory_id, quantity - reserved])
+    return stock
+
+
+def reserve_in_warehouses(rows: List[List[int]], quantity: int,
+                          reservations: Optional[List[Tuple[int, int]]] = None) -> int:
+    """
+    Reserve up to ``quantity`` across warehouse rows with conditional UPDATEs;
+    return how many were, appending (inventory id, quantity) to ``reservations``.
+    """
+    from apps.shipping.models import Inventory
+
+    remaining = quantity
+    for inventory_id, available in rows:
+        inventory = Inventory.objects.filter(id=inventory_id)
+        while remaining and available > 0:
+            take = min(available, remaining)
+            taken = inventory.filter(quantity__gte=F('reserved_quantity') + take).update(
+                reserved_quantity=F('reserved_quantity') + take
+            )
+            if taken:
+                remaining -= take
+                if reservations is not None:
+                    reservations.append((inventory_id, take))
+                break
+            # Another checkout reserved from this row since it was read
+            available = inventory.annotate(
+                available=F('quantity') - F('reserved_quantity')
+            ).values_list('available', flat=True).first() or 0
+        if not remaining:
+            break
+    return quantity - remaining
+
+
+def reserve_stock(items: Iterable) -> List[Tuple[int, int]]:
+    """
+    Take the stock of checkout lines (cart items with their product loaded)
+    with one conditional UPDATE each; raise OutOfStock if any is short.
+    Returns the (inventory id, quantity) warehouse reservations made, for
+    ``record_reservations``.
+    """
+    if not transaction.get_connection().in_atomic_block:
+        raise RuntimeError('reserve_stock must run inside the checkout transaction')
+
+    items = [item for item in items if item.product.track_inventory]
+    warehouse_stock = get_warehouse_stock(items) if items else {}
+    short = []
+    # Units of short lines already reserved, given back by the rollback
+    partly_reserved = {}
+    reservations = []
+    for item in sorted(items, key=get_lock_order):
+        warehouse_rows = warehouse_stock.get(get_lock_order(item))
+        if warehouse_rows is not None:
+            reserved = reserve_in_warehouses(warehouse_rows, item.quantity, reservations)
+            if reserved < item.quantity:
+                short.append(item)
+                partly_reserved[get_lock_order(item)] = reserved
+            continue
+        if item.variant_id:
+            rows = ProductVariant.objects.filter(id=item.variant_id, stock_quantity__gte=item.quantity)
+        else:
+            rows = Product.objects.filter(id=item.product_id, stock_quantity__gte=item.quantity)
+        if not rows.update(stock_quantity=F('stock_quantity') - item.quantity):
+            short.append(item)
+
+    if short:
+        raise OutOfStock({'items': get_shortages(short, partly_reserved)})
+    return reservations
+
+
+def record_reservations(order, reservations: List[Tuple[int, int]]) -> None:
+    """Record an order's warehouse reservations so ``release_stock`` can give them back"""
+    from apps.shipping.models import InventoryTransaction
+
+    if reservations:
+        InventoryTransaction.objects.bulk_create([
+            InventoryTransaction(
+                inventory_id=inventory_id, transaction_type='reservation', quantity=-quantity,
+                reference=order.order_number,
+            )
+            for inventory_id, quantity in reservations
+        ])
+
+
+def release_stock(order) -> None:
+    """
+    Give back the stock an order took at checkout, in the same lock order:
+    warehouse reservations recorded for it are released, other lines go back
+    to the variant's or product's stock.
+    """
+    from apps.shipping.models import Inventory, InventoryTransaction
+
+    if not transaction.get_connection().in_atomic_block:
+        raise RuntimeError('release_stock must run inside the cancelling transaction')
+
+    reserved = {}
+    for inventory_id, product_id, variant_id, transaction_type, quantity in (
+        InventoryTransaction.objects.filter(
+            reference=order.order_number, transaction_type__in=('reservation', 'release')
+        ).values_list('inventory_id', 'inventory__product_id', 'inventory__variant_id', 'transaction_type', 'quantity')
+    ):
+        # Reservations are recorded negative and releases positive
+        rows = reserved.setdefault((product_id, variant_id or 0), {})
+        rows[inventory_id] = rows.get(inventory_id, 0) - quantity
+
+    released = []
+    for item in sorted(order.items.select_related('product'), key=get_lock_order):
+        warehouse_rows = reserved.pop(get_lock_order(item), None)
+        if warehouse_rows is not None:
+            for inventory_id, quantity in sorted(warehouse_rows.items()):
+                if quantity > 0 and Inventory.objects.filter(
+                    id=inventory_id, reserved_quantity__gte=quantity
+                ).update(reserved_quantity=F('reserved_quantity') - quantity):
+                    released.append((inventory_id, quantity))
+            continue
+        if not item.product.track_inventory:
+            continue
+        if item.variant_id:
+            rows = ProductVariant.objects.filter(id=item.variant_id)
+        else:
+            rows = Product.objects.filter(id=item.product_id)
+        rows.update(stock_quantity=F('stock_quantity') + item.quantity)
+
+    if released:
+        InventoryTransaction.objects.bulk_create([
+            InventoryTransaction(
+                inventory_id=inventory_id, transaction_type='release', quantity=quantity,
+                reference=order.order_number,
+            )
+            for inventory_id, quantity in released
+        ])
+
+
+def get_shortages(items: List, partly_reserved: Optional[Dict[tuple, int]] = None) -> List[Dict[str, Any]]:
+    """Describe lines the stock could not cover, with the stock now available"""
+    products = dict(Product.objects.filter(
+        id__in=[item.product_id for item in items if not item.variant_id]
+    ).values_list('id', 'stock_quantity'))
+    variants = dict(ProductVariant.objects.filter(
+        id__in=[item.variant_id for item in items if item.variant_id]
+    ).values_list('id', 'stock_quantity'))
+    warehouse_stock = get_warehouse_stock(items)
+
+    shortages = []
+    for item in items:
+        rows = warehouse_stock.get(get_lock_order(item))
+        if rows is not None:
+            available = max(sum(row_available for _, row_available in rows), 0)
+            available += (partly_reserved or {}).get(get_lock_order(item), 0)
+        elif item.variant_id:
+            available = variants.get(item.variant_id, 0)
+        else:
+            available = products.get(item.product_id, 0)
+        shortages.append({
+            'product_id': item.product_id,
+            'variant_id': item.variant_id,
+            'requested': item.quantity,
+            'available': available,
+            'message': f"Only {available} of {item.product.name} available in stock",
+        })
+    return shortages
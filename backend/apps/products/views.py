@@ -6,6 +6,7 @@ from django_filters.rest_framework import DjangoFilterBackend
 from django.db.models import Q, Avg, Count
 from django.core.cache import cache
 from core.cache_utils import CacheManager
+from core.throttling import QueryCost, throttle_cost
 from .models import Category, Product, ProductReview
 from .serializers import (
     CategorySerializer, ProductListSerializer, ProductDetailSerializer,
@@ -87,6 +88,7 @@ class ProductViewSet(viewsets.ModelViewSet):
         
         return queryset
 
+    @throttle_cost(QueryCost(per_item=0.1, per_term=2))
     def list(self, request, *args, **kwargs):
         """List products with caching"""
         # Check cache first
@@ -145,6 +147,7 @@ class ProductViewSet(viewsets.ModelViewSet):
         return Response(serializer.data)
 
     @action(detail=False, methods=['get'])
+    @throttle_cost(QueryCost(base=5, search_params=('q',), per_term=5))
     def search(self, request):
         """Advanced search endpoint"""
         query = request.query_params.get('q', '')
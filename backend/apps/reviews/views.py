@@ -6,6 +6,7 @@ from django.shortcuts import get_object_or_404
 from django.db.models import Q, Count, Sum, Avg
 from django.utils import timezone
 from datetime import timedelta
+from core.throttling import throttle_cost
 from .models import (
     ProductReview, ReviewVote, ProductRating,
     AnalyticsEvent, SalesAnalytics, ProductAnalytics, CustomerAnalytics
@@ -73,6 +74,7 @@ class AnalyticsEventViewSet(viewsets.ModelViewSet):
         return AnalyticsEventSerializer
 
     @action(detail=False, methods=['get'])
+    @throttle_cost(10)
     def summary(self, request):
         """Get analytics summary"""
         days = int(request.query_params.get('days', 30))
@@ -4,6 +4,7 @@ from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import get_user_model
+from apps.cart.storage import GUEST_TOKEN_HEADER, merge_guest_cart
 from .serializers import UserRegistrationSerializer, UserLoginSerializer, UserProfileSerializer
 
 User = get_user_model()
@@ -16,6 +17,8 @@ def register(request):
     serializer = UserRegistrationSerializer(data=request.data)
     if serializer.is_valid():
         user = serializer.save()
+        # Keep what the shopper put in the cart before signing up
+        merge_guest_cart(user, request.META.get(GUEST_TOKEN_HEADER))
         refresh = RefreshToken.for_user(user)
         return Response({
             'message': 'User registered successfully',
@@ -35,6 +38,8 @@ def login(request):
     serializer = UserLoginSerializer(data=request.data)
     if serializer.is_valid():
         user = serializer.validated_data['user']
+        # Keep what the shopper put in the cart before logging in
+        merge_guest_cart(user, request.META.get(GUEST_TOKEN_HEADER))
         refresh = RefreshToken.for_user(user)
         return Response({
             'message': 'Login successful',
@@ -0,0 +1,181 @@
+"""
+Admission control.
+
+``AdmissionControlMiddleware`` puts every API request in a route class
+(catalog reads, cart, checkout, admin analytics, ...) and, when this worker
+is overloaded, refuses the low-priority classes at once with 503 and
+``Retry-After`` instead of letting every endpoint slow down together. The
+signals, all per worker process, are:
+
+* requests in flight, for the worker and for each route class;
+* the recent latency of each route class (exponentially weighted);
+* the time requests waited before reaching the worker, from the
+  ``X-Request-Start`` header set by nginx. A sync gunicorn worker serves one
+  request at a time, so overload shows up as queueing first.
+
+Each route class has a priority. ``low`` classes are shed first and
+``normal`` ones later. ``critical`` classes (checkout, cart writes) are only
+refused when the worker is completely full, so they keep their capacity.
+``exempt`` classes (health checks, metrics) are never refused.
+
+Refusals based on latency or queueing let one probe request per class
+through every ``PROBE_INTERVAL`` seconds, so a class recovers once its
+latency does.
+"""
+import re
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from django.conf import settings
+
+# Share of the worker's in-flight capacity each priority may use, and the
+# multiple of the queue delay target at which it is shed
+PRIORITIES = {
+    'low': (0.5, 1.0),
+    'normal': (0.8, 2.0),
+    'critical': (1.0, None),
+    'exempt': (None, None),
+}
+
+# Weight of the newest sample in the latency and queue delay averages
+EWMA_ALPHA = 0.2
+
+
+def get_config() -> Dict[str, Any]:
+    """Return the ADMISSION_CONTROL setting merged over the defaults"""
+    config = {
+        'ENABLED': True,
+        'MAX_IN_FLIGHT': 16,
+        'QUEUE_DELAY_TARGET_MS': 500,
+        'RETRY_AFTER': 5,
+        'PROBE_INTERVAL': 1.0,
+        'ROUTE_CLASSES': {'default': {'PRIORITY': 'normal'}},
+        'ROUTES': [],
+    }
+    config.update(getattr(settings, 'ADMISSION_CONTROL', {}))
+    return config
+
+
+def get_queue_delay(request) -> Optional[float]:
+    """Return seconds since the proxy received the request, from X-Request-Start"""
+    header = request.META.get('HTTP_X_REQUEST_START')
+    if not header:
+        return None
+    try:
+        start = float(header[2:] if header.startswith('t=') else header)
+    except ValueError:
+        return None
+    # nginx sends seconds with millisecond precision; others send ms or us
+    if start > 1e14:
+        start /= 1e6
+    elif start > 1e11:
+        start /= 1e3
+    return max(0.0, time.time() - start)
+
+
+class RouteClass:
+    """Configuration and load of one route class in this worker"""
+    __slots__ = ('name', 'priority', 'max_in_flight', 'latency_target', 'in_flight', 'latency', 'last_admitted')
+
+    def __init__(self, name: str, priority: str = 'normal', max_in_flight: Optional[int] = None,
+                 latency_target: Optional[float] = None):
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown admission priority '{priority}' for route class '{name}'")
+        self.name = name
+        self.priority = priority
+        self.max_in_flight = max_in_flight
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.latency = 0.0
+        self.last_admitted = 0.0
+
+    def get_state(self) -> Dict[str, Any]:
+        return {
+            'priority': self.priority,
+            'in_flight': self.in_flight,
+            'latency_ms': round(self.latency * 1000, 2),
+        }
+
+
+class AdmissionController:
+    """Decide per request whether this worker should serve it"""
+
+    def __init__(self, config: Dict[str, Any]):
+        self.max_in_flight = config['MAX_IN_FLIGHT']
+        self.queue_delay_target = config['QUEUE_DELAY_TARGET_MS'] / 1000
+        self.probe_interval = config['PROBE_INTERVAL']
+        self.classes = {
+            name: RouteClass(
+                name,
+                priority=options.get('PRIORITY', 'normal'),
+                max_in_flight=options.get('MAX_IN_FLIGHT'),
+                latency_target=options['LATENCY_TARGET_MS'] / 1000 if options.get('LATENCY_TARGET_MS') else None,
+            )
+            for name, options in config['ROUTE_CLASSES'].items()
+        }
+        self.classes.setdefault('default', RouteClass('default'))
+        self.routes = [
+            (self.classes[name], re.compile(pattern), frozenset(methods) if methods else None)
+            for name, pattern, methods in config['ROUTES']
+        ]
+        self.in_flight = 0
+        self.queue_delay = 0.0
+        self._lock = threading.Lock()
+
+    def classify(self, request) -> RouteClass:
+        """Return the route class of the first matching route"""
+        for route_class, pattern, methods in self.routes:
+            if (methods is None or request.method in methods) and pattern.match(request.path):
+                return route_class
+        return self.classes['default']
+
+    def admit(self, route_class: RouteClass, queue_delay: Optional[float] = None) -> Optional[str]:
+        """Admit a request, returning None, or the reason it should be refused"""
+        with self._lock:
+            if queue_delay is not None:
+                self.queue_delay += EWMA_ALPHA * (queue_delay - self.queue_delay)
+
+            reason = self._check(route_class)
+            if reason is not None:
+                return reason
+            self.in_flight += 1
+            route_class.in_flight += 1
+            route_class.last_admitted = time.monotonic()
+            return None
+
+    def _check(self, route_class: RouteClass) -> Optional[str]:
+        """Return why ``route_class`` is refused right now; caller must hold the lock"""
+        share, queue_factor = PRIORITIES[route_class.priority]
+        if share is None:
+            return None
+        if self.in_flight >= self.max_in_flight * share:
+            return 'capacity'
+        if route_class.max_in_flight is not None and route_class.in_flight >= route_class.max_in_flight:
+            return 'class_capacity'
+
+        # Latency and queueing describe past requests; probe now and then
+        if time.monotonic() - route_class.last_admitted >= self.probe_interval:
+            return None
+        if queue_factor is not None and self.queue_delay > self.queue_delay_target * queue_factor:
+            return 'queue_delay'
+        if (route_class.priority != 'critical' and route_class.latency_target is not None
+                and route_class.latency > route_class.latency_target):
+            return 'latency'
+        return None
+
+    def release(self, route_class: RouteClass, duration: float) -> None:
+        """Record the end of an admitted request"""
+        with self._lock:
+            self.in_flight -= 1
+            route_class.in_flight -= 1
+            route_class.latency += EWMA_ALPHA * (duration - route_class.latency)
+
+    def get_state(self) -> Dict[str, Any]:
+        """Export the load of this worker"""
+        with self._lock:
+            return {
+                'in_flight': self.in_flight,
+                'queue_delay_ms': round(self.queue_delay * 1000, 2),
+                'route_classes': {name: route_class.get_state() for name, route_class in self.classes.items()},
+            }
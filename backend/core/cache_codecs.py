@@ -0,0 +1,285 @@
+"""
+Payload codecs for cached data.
+
+Catalog pages are cached as lists of dicts holding strings, Decimals and
+datetimes. Pickling them is slow and bulky, so the Redis cache encodes values
+with a compact codec (msgpack by default) and compresses payloads above a size
+threshold.
+
+Every serialized value starts with a one-byte codec tag and every compressed
+value with a two-byte header, so entries written with another codec - or
+plain pickles written before this module existed - still decode.
+
+Configured through the django-redis ``SERIALIZER``/``COMPRESSOR`` options::
+
+    'OPTIONS': {
+        'SERIALIZER': 'core.cache_codecs.PayloadSerializer',
+        'COMPRESSOR': 'core.cache_codecs.PayloadCompressor',
+        'PAYLOAD_CODEC': 'msgpack',        # msgpack | orjson | pickle
+        'COMPRESSION': 'zstd',             # zstd | lz4 | zlib | None
+        'COMPRESS_MIN_LENGTH': 1024,       # bytes
+    }
+"""
+import datetime
+import pickle
+import uuid
+import zlib
+from decimal import Decimal
+from typing import Any, Dict, Optional
+
+from django.core.exceptions import ImproperlyConfigured
+from django_redis.compressors.base import BaseCompressor
+from django_redis.exceptions import CompressorError
+from django_redis.serializers.base import BaseSerializer
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional dependency
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # pragma: no cover - optional dependency
+    lz4_frame = None
+
+
+# msgpack extension type codes
+EXT_DECIMAL = 1
+EXT_DATETIME = 2
+EXT_DATE = 3
+EXT_UUID = 4
+EXT_TUPLE = 5
+
+
+class PayloadCodec:
+    """Base class for payload codecs"""
+    name = None
+    tag = None
+
+    def dumps(self, value: Any) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data: bytes) -> Any:
+        raise NotImplementedError
+
+
+class PickleCodec(PayloadCodec):
+    """Pickle codec, used as the fallback for values other codecs can't encode"""
+    name = 'pickle'
+    tag = b'P'
+
+    def dumps(self, value: Any) -> bytes:
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data: bytes) -> Any:
+        return pickle.loads(data)
+
+
+class MsgPackCodec(PayloadCodec):
+    """
+    msgpack codec with extension types for Decimal, datetime, date, UUID and
+    tuple. msgpack would pack tuples as arrays and hand them back as lists, so
+    types are checked exactly and tuples round-trip as an extension type.
+    dict, list and str subclasses (OrderedDict, SafeString, ...) are packed as
+    their base type; other subclasses, such as namedtuples, fall back to pickle.
+    """
+    name = 'msgpack'
+    tag = b'M'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImproperlyConfigured("PAYLOAD_CODEC 'msgpack' requires the msgpack package")
+
+    @classmethod
+    def _default(cls, value):
+        if isinstance(value, Decimal):
+            return msgpack.ExtType(EXT_DECIMAL, str(value).encode())
+        if isinstance(value, datetime.datetime):
+            return msgpack.ExtType(EXT_DATETIME, value.isoformat().encode())
+        if isinstance(value, datetime.date):
+            return msgpack.ExtType(EXT_DATE, value.isoformat().encode())
+        if isinstance(value, uuid.UUID):
+            return msgpack.ExtType(EXT_UUID, value.bytes)
+        if type(value) is tuple:
+            return msgpack.ExtType(EXT_TUPLE, cls._pack(list(value)))
+        if isinstance(value, dict):
+            return dict(value)
+        if isinstance(value, list):
+            return list(value)
+        if isinstance(value, str):
+            # str() returns some subclasses (SafeString) unchanged
+            return str.__str__(value)
+        raise TypeError(f"Cannot encode {type(value).__name__}")
+
+    @classmethod
+    def _ext_hook(cls, code, data):
+        if code == EXT_DECIMAL:
+            return Decimal(data.decode())
+        if code == EXT_DATETIME:
+            return datetime.datetime.fromisoformat(data.decode())
+        if code == EXT_DATE:
+            return datetime.date.fromisoformat(data.decode())
+        if code == EXT_UUID:
+            return uuid.UUID(bytes=data)
+        if code == EXT_TUPLE:
+            return tuple(cls._unpack(data))
+        return msgpack.ExtType(code, data)
+
+    @classmethod
+    def _pack(cls, value: Any) -> bytes:
+        return msgpack.packb(value, default=cls._default, use_bin_type=True, strict_types=True)
+
+    @classmethod
+    def _unpack(cls, data: bytes) -> Any:
+        return msgpack.unpackb(data, ext_hook=cls._ext_hook, raw=False, strict_map_key=False)
+
+    def dumps(self, value: Any) -> bytes:
+        return self._pack(value)
+
+    def loads(self, data: bytes) -> Any:
+        return self._unpack(data)
+
+
+class OrjsonCodec(PayloadCodec):
+    """
+    orjson codec. Decimals come back as strings, matching the JSON the API
+    renders, so only use it for caches of serializer output.
+    """
+    name = 'orjson'
+    tag = b'J'
+
+    def __init__(self):
+        if orjson is None:
+            raise ImproperlyConfigured("PAYLOAD_CODEC 'orjson' requires the orjson package")
+
+    @staticmethod
+    def _default(value):
+        if isinstance(value, Decimal):
+            return str(value)
+        raise TypeError(f"Cannot encode {type(value).__name__}")
+
+    def dumps(self, value: Any) -> bytes:
+        return orjson.dumps(value, default=self._default, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, data: bytes) -> Any:
+        return orjson.loads(data)
+
+
+CODECS = {
+    'pickle': PickleCodec,
+    'msgpack': MsgPackCodec,
+    'orjson': OrjsonCodec,
+}
+
+CODEC_TAGS = {codec.tag: name for name, codec in CODECS.items()}
+
+
+def get_codec(name: str) -> PayloadCodec:
+    """Instantiate a payload codec by name"""
+    try:
+        return CODECS[name]()
+    except KeyError:
+        raise ImproperlyConfigured(f"Unknown PAYLOAD_CODEC '{name}'")
+
+
+class PayloadSerializer(BaseSerializer):
+    """
+    django-redis serializer that encodes with the configured codec and falls
+    back to pickle for values the codec can't represent (e.g. model instances).
+    """
+
+    def __init__(self, options: Dict[str, Any]):
+        super().__init__(options=options)
+        self.codec = get_codec(options.get('PAYLOAD_CODEC', 'msgpack'))
+        self.fallback = PickleCodec()
+        self.decoders = {self.fallback.tag: self.fallback, self.codec.tag: self.codec}
+
+    def dumps(self, value: Any) -> bytes:
+        try:
+            return self.codec.tag + self.codec.dumps(value)
+        except (TypeError, ValueError, OverflowError):
+            return self.fallback.tag + self.fallback.dumps(value)
+
+    def loads(self, value: bytes) -> Any:
+        tag = value[:1]
+        if tag not in self.decoders:
+            if tag not in CODEC_TAGS:
+                # Untagged pickle written before codecs were introduced
+                return pickle.loads(value)
+            # Written by a worker configured with another codec
+            self.decoders[tag] = get_codec(CODEC_TAGS[tag])
+        return self.decoders[tag].loads(value[1:])
+
+
+def _zstd_compress(data: bytes, level: int) -> bytes:
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _zstd_decompress(data: bytes) -> bytes:
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+COMPRESSION_HEADERS = {
+    'zstd': b'\x00Z',
+    'lz4': b'\x00L',
+    'zlib': b'\x00D',
+}
+
+
+class PayloadCompressor(BaseCompressor):
+    """
+    django-redis compressor that only compresses payloads larger than
+    ``COMPRESS_MIN_LENGTH`` and only keeps the result when it is smaller.
+    """
+
+    def __init__(self, options: Dict[str, Any]):
+        super().__init__(options=options)
+        self.algorithm: Optional[str] = options.get('COMPRESSION', 'zstd') or None
+        if self.algorithm == 'none':
+            self.algorithm = None
+        self.min_length: int = options.get('COMPRESS_MIN_LENGTH', 1024)
+        self.level: int = options.get('COMPRESS_LEVEL', 3)
+
+        if self.algorithm and self.algorithm not in COMPRESSION_HEADERS:
+            raise ImproperlyConfigured(f"Unknown COMPRESSION '{self.algorithm}'")
+        if self.algorithm == 'zstd' and zstandard is None:
+            raise ImproperlyConfigured("COMPRESSION 'zstd' requires the zstandard package")
+        if self.algorithm == 'lz4' and lz4_frame is None:
+            raise ImproperlyConfigured("COMPRESSION 'lz4' requires the lz4 package")
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.algorithm == 'zstd':
+            return _zstd_compress(data, self.level)
+        if self.algorithm == 'lz4':
+            return lz4_frame.compress(data)
+        return zlib.compress(data, self.level)
+
+    def compress(self, value: bytes) -> bytes:
+        if not self.algorithm or len(value) < self.min_length:
+            return value
+        compressed = COMPRESSION_HEADERS[self.algorithm] + self._compress(value)
+        return compressed if len(compressed) < len(value) else value
+
+    def decompress(self, value: bytes) -> bytes:
+        header, body = value[:2], value[2:]
+        try:
+            if header == COMPRESSION_HEADERS['zstd'] and zstandard is not None:
+                return _zstd_decompress(body)
+            if header == COMPRESSION_HEADERS['lz4'] and lz4_frame is not None:
+                return lz4_frame.decompress(body)
+            if header == COMPRESSION_HEADERS['zlib']:
+                return zlib.decompress(body)
+        except Exception as e:
+            raise CompressorError(e)
+        # Not compressed (below the threshold or not worth it)
+        raise CompressorError("Value is not compressed")
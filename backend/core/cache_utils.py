@@ -1,8 +1,10 @@
 from django.core.cache import cache
 from django.conf import settings
 from django.db.models import Model
+from rest_framework.response import Response
 import hashlib
 import json
+import time
 from typing import Any, Optional, List, Dict
 
 
@@ -14,6 +16,7 @@ class CacheManager:
         'products': 1800,  # 30 minutes
         'categories': 3600,  # 1 hour
         'user_cart': 900,  # 15 minutes
+        'active_cart': 3600,  # 1 hour
         'product_list': 1800,  # 30 minutes
         'category_products': 900,  # 15 minutes
         'featured_products': 3600,  # 1 hour
@@ -49,7 +52,17 @@ class CacheManager:
     @classmethod
     def get_user_cart_cache_key(cls, user_id: int) -> str:
         """Generate cache key for user cart"""
-        return cls.get_cache_key("user_cart", user_id, user_id)
+        return cls.get_cache_key("user_cart", user_id)
+    
+    @classmethod
+    def get_active_cart_cache_key(cls, user_id: int) -> str:
+        """Generate cache key for the id of a user's active cart"""
+        return cls.get_cache_key("active_cart", user_id)
+    
+    @classmethod
+    def get_user_cart_version_key(cls, user_id: int) -> str:
+        """Generate cache key for the version of a user cart"""
+        return cls.get_cache_key("user_cart_version", user_id)
     
     @classmethod
     def get_category_products_cache_key(cls, category_id: int, filters: Dict = None) -> str:
@@ -75,17 +88,43 @@ class CacheManager:
         return cache.get(cache_key)
     
     @classmethod
-    def cache_user_cart(cls, user_id: int, cart_data: Dict) -> None:
-        """Cache user cart data"""
+    def get_user_cart_version(cls, user_id: int) -> int:
+        """Get the current version of a user cart"""
+        version_key = cls.get_user_cart_version_key(user_id)
+        version = cache.get(version_key)
+        if version is None:
+            # Start from the clock, so a version lost to eviction is never reused
+            cache.add(version_key, time.time_ns() // 1000, cls.CACHE_TIMEOUTS['user_cart'])
+            version = cache.get(version_key)
+        return version
+    
+    @classmethod
+    def bump_user_cart_version(cls, user_id: int) -> int:
+        """Mark cached user cart data stale; call after every cart change"""
+        version_key = cls.get_user_cart_version_key(user_id)
+        try:
+            return cache.incr(version_key)
+        except ValueError:
+            cache.add(version_key, time.time_ns() // 1000, cls.CACHE_TIMEOUTS['user_cart'])
+            return cache.incr(version_key)
+    
+    @classmethod
+    def cache_user_cart(cls, user_id: int, cart_data: Dict, version: int) -> None:
+        """Cache user cart data built from cart ``version``"""
         cache_key = cls.get_user_cart_cache_key(user_id)
         timeout = cls.CACHE_TIMEOUTS['user_cart']
-        cache.set(cache_key, cart_data, timeout)
+        cache.set(cache_key, {'version': version, 'data': cart_data}, timeout)
     
     @classmethod
     def get_cached_user_cart(cls, user_id: int) -> Optional[Dict]:
-        """Get cached user cart data"""
+        """Get cached user cart data, if it was built from the current cart version"""
         cache_key = cls.get_user_cart_cache_key(user_id)
-        return cache.get(cache_key)
+        version_key = cls.get_user_cart_version_key(user_id)
+        cached = cache.get_many([cache_key, version_key])
+        snapshot = cached.get(cache_key)
+        if snapshot is None or snapshot['version'] != cached.get(version_key):
+            return None
+        return snapshot['data']
     
     @classmethod
     def cache_category_products(cls, category_id: int, products_data: List[Dict], filters: Dict = None) -> None:
@@ -113,10 +152,23 @@ class CacheManager:
         cache.delete_pattern("featured_products_*")
         cache.delete_pattern("bestseller_products_*")
     
+    @classmethod
+    def invalidate_active_cart(cls, user_id: int) -> None:
+        """Forget the active cart of a user; call when a cart is deactivated"""
+        cache.delete(cls.get_active_cart_cache_key(user_id))
+    
+    @classmethod
+    def invalidate_user_carts(cls, user_ids: List[int]) -> None:
+        """Forget the active carts and cart snapshots of many users at once, e.g. after expiring carts"""
+        keys = []
+        for user_id in user_ids:
+            keys.extend((cls.get_active_cart_cache_key(user_id), cls.get_user_cart_cache_key(user_id)))
+        cache.delete_many(keys)
+    
     @classmethod
     def invalidate_user_cache(cls, user_id: int) -> None:
         """Invalidate user-related cache"""
-        cache.delete(cls.get_user_cart_cache_key(user_id))
+        cls.bump_user_cart_version(user_id)
         cache.delete_pattern(f"user_profile_{user_id}")
         cache.delete_pattern(f"user_orders_{user_id}")
     
@@ -140,11 +192,13 @@ def cache_response(timeout: int = 300, key_prefix: str = "view"):
             # Try to get from cache
             cached_response = cache.get(cache_key)
             if cached_response is not None:
-                return cached_response
+                return Response(cached_response['data'], status=cached_response['status'])
             
-            # Execute view and cache response
+            # Execute view and cache the response payload (not the response
+            # object) so it goes through the compact cache codec
             response = view_func(request, *args, **kwargs)
-            cache.set(cache_key, response, timeout)
+            if response.status_code == 200 and hasattr(response, 'data'):
+                cache.set(cache_key, {'data': response.data, 'status': response.status_code}, timeout)
             return response
         
         return wrapper
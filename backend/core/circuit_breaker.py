@@ -0,0 +1,519 @@
+"""
+Circuit breaker for Redis.
+
+When Redis is slow or down every cache call would block for the socket
+timeout, turning a cache outage into a site outage. ``CircuitBreakerClient``
+wraps the django-redis client: after ``FAILURE_THRESHOLD`` consecutive
+connection errors the circuit opens and calls are served from a bounded
+local-memory cache without touching Redis. After ``RECOVERY_TIMEOUT`` seconds
+one probe request is let through (half-open); success closes the circuit,
+failure re-opens it. Every call is also recorded in the per-request metrics
+(``core.instrumentation``).
+
+Writes served locally while the circuit is open never reach Redis, so Redis
+would keep serving what they invalidated (product lists, cart snapshots,
+version counters) once it is back. The keys written and the patterns
+deleted are queued, up to ``REPLAY_MAX_KEYS``, and deleted from Redis by
+the first call after the circuit closes. The queue is per process.
+
+Breakers are process-wide (cache backends are per thread) and their state is
+exported through ``get_breaker_states()`` for health checks and metrics.
+"""
+import logging
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.locmem import LocMemCache
+from django_redis.client import DefaultClient
+from django_redis.exceptions import ConnectionInterrupted
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import ResponseError
+from redis.exceptions import TimeoutError as RedisTimeoutError
+
+from .instrumentation import record_cache_call
+from .tracing import start_span
+
+logger = logging.getLogger(__name__)
+
+CONNECTION_ERRORS = (RedisConnectionError, RedisTimeoutError, socket.timeout)
+
+
+class CircuitBreaker:
+    """Thread-safe circuit breaker with closed, open and half-open states"""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30,
+                 half_open_max_calls: int = 1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._half_open_calls = 0
+        self._listeners: List[Callable[[str, str], None]] = []
+
+        # Counters exported with the state
+        self.total_failures = 0
+        self.total_short_circuits = 0
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def add_listener(self, listener: Callable[[str, str], None]) -> None:
+        """Register a callback invoked with (old_state, new_state) on transitions"""
+        self._listeners.append(listener)
+
+    def allow_request(self) -> bool:
+        """Return True if the protected call should be attempted"""
+        if self._state == self.CLOSED:
+            # Fast path without taking the lock
+            return True
+
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.recovery_timeout:
+                    self.total_short_circuits += 1
+                    return False
+                self._transition(self.HALF_OPEN)
+
+            # Half-open: only let a limited number of probes through
+            if self._half_open_calls < self.half_open_max_calls:
+                self._half_open_calls += 1
+                return True
+            self.total_short_circuits += 1
+            return False
+
+    def record_success(self) -> None:
+        if self._state == self.CLOSED and not self._consecutive_failures:
+            return
+
+        with self._lock:
+            self._consecutive_failures = 0
+            if self._state != self.CLOSED:
+                self._transition(self.CLOSED)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._consecutive_failures += 1
+            self.total_failures += 1
+            if self._state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                self._transition(self.OPEN)
+
+    def _transition(self, new_state: str) -> None:
+        """Change state; caller must hold the lock"""
+        old_state = self._state
+        if old_state == new_state:
+            # Failures while already open restart the recovery timer
+            self._opened_at = time.monotonic()
+            return
+
+        self._state = new_state
+        self._half_open_calls = 0
+        if new_state == self.OPEN:
+            self._opened_at = time.monotonic()
+            logger.warning(f"Circuit breaker '{self.name}' opened after {self._consecutive_failures} failures")
+        elif new_state == self.CLOSED:
+            self._opened_at = None
+            logger.info(f"Circuit breaker '{self.name}' closed")
+
+        for listener in self._listeners:
+            try:
+                listener(old_state, new_state)
+            except Exception:
+                logger.exception(f"Circuit breaker '{self.name}' listener failed")
+
+    def get_state(self) -> Dict[str, Any]:
+        """Export breaker state"""
+        with self._lock:
+            open_for = time.monotonic() - self._opened_at if self._opened_at else None
+            return {
+                'name': self.name,
+                'state': self._state,
+                'consecutive_failures': self._consecutive_failures,
+                'total_failures': self.total_failures,
+                'total_short_circuits': self.total_short_circuits,
+                'open_for_seconds': round(open_for, 3) if open_for is not None else None,
+            }
+
+
+class PendingInvalidations:
+    """Keys and patterns to delete from Redis once the circuit closes"""
+
+    def __init__(self, name: str, max_keys: int):
+        self.name = name
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        # version -> keys
+        self._keys: Dict[Any, Set[Any]] = {}
+        # (pattern, version, prefix)
+        self._patterns: Set[Tuple[Any, Any, Any]] = set()
+        self._size = 0
+
+    def __bool__(self) -> bool:
+        return self._size > 0
+
+    def add_keys(self, keys, version=None) -> None:
+        with self._lock:
+            pending = self._keys.setdefault(version, set())
+            for key in keys:
+                if key in pending:
+                    continue
+                if self._size >= self.max_keys:
+                    logger.error(f"Circuit breaker '{self.name}': too many keys written while open, "
+                                 f"Redis may serve stale values for the rest")
+                    return
+                pending.add(key)
+                self._size += 1
+
+    def add_pattern(self, pattern, version=None, prefix=None) -> None:
+        with self._lock:
+            if (pattern, version, prefix) not in self._patterns:
+                self._patterns.add((pattern, version, prefix))
+                self._size += 1
+
+    def take(self) -> Tuple[Dict[Any, Set[Any]], Set[Tuple[Any, Any, Any]]]:
+        """Return and forget everything queued"""
+        with self._lock:
+            keys, patterns = self._keys, self._patterns
+            self._keys, self._patterns, self._size = {}, set(), 0
+            return keys, patterns
+
+    def restore(self, keys: Dict[Any, Set[Any]], patterns: Set[Tuple[Any, Any, Any]]) -> None:
+        """Queue again what could not be replayed"""
+        for version, version_keys in keys.items():
+            self.add_keys(version_keys, version)
+        for pattern in patterns:
+            self.add_pattern(*pattern)
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_fallback_caches: Dict[str, LocMemCache] = {}
+_pending_invalidations: Dict[str, PendingInvalidations] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str, **config) -> CircuitBreaker:
+    """Return the process-wide breaker for ``name``, creating it on first use"""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, **config)
+        return _breakers[name]
+
+
+def get_fallback_cache(breaker: CircuitBreaker, timeout: int, key_prefix: str,
+                       max_entries: int) -> LocMemCache:
+    """Return the local-memory cache used while ``breaker`` is open"""
+    with _breakers_lock:
+        fallback = _fallback_caches.get(breaker.name)
+        if fallback is None:
+            fallback = LocMemCache(f"circuit-breaker-fallback:{breaker.name}", {
+                'TIMEOUT': timeout,
+                'KEY_PREFIX': key_prefix,
+                'OPTIONS': {'MAX_ENTRIES': max_entries},
+            })
+
+            def clear_on_close(old_state, new_state):
+                # Drop local values once Redis is back so a later outage
+                # never serves data written during an earlier one
+                if new_state == CircuitBreaker.CLOSED:
+                    fallback.clear()
+
+            breaker.add_listener(clear_on_close)
+            _fallback_caches[breaker.name] = fallback
+        return fallback
+
+
+def get_pending_invalidations(breaker: CircuitBreaker, max_keys: int) -> PendingInvalidations:
+    """Return the keys and patterns to delete from Redis once ``breaker`` closes"""
+    with _breakers_lock:
+        pending = _pending_invalidations.get(breaker.name)
+        if pending is None:
+            pending = _pending_invalidations[breaker.name] = PendingInvalidations(breaker.name, max_keys)
+        return pending
+
+
+def get_breaker_states() -> List[Dict[str, Any]]:
+    """Export the state of every breaker in this process"""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return [breaker.get_state() for breaker in breakers]
+
+
+def get_cache_breaker_state(cache) -> Optional[Dict[str, Any]]:
+    """Export the breaker state of a cache backend, if it uses one"""
+    breaker = getattr(getattr(cache, 'client', None), 'breaker', None)
+    return breaker.get_state() if breaker is not None else None
+
+
+class CircuitBreakerClient(DefaultClient):
+    """
+    django-redis client that short-circuits to a bounded local-memory cache
+    while Redis is unavailable.
+
+    Configured with ``OPTIONS['CIRCUIT_BREAKER']``::
+
+        'CIRCUIT_BREAKER': {
+            'FAILURE_THRESHOLD': 5,        # consecutive errors before opening
+            'RECOVERY_TIMEOUT': 30,        # seconds before a half-open probe
+            'FALLBACK_MAX_ENTRIES': 1000,  # local cache size while open
+            'REPLAY_MAX_KEYS': 100000,     # keys written while open, deleted on close
+        }
+    """
+
+    def __init__(self, server, params: Dict[str, Any], backend) -> None:
+        super().__init__(server, params, backend)
+        config = self._options.get('CIRCUIT_BREAKER', {})
+
+        name = f"redis:{','.join(self._server)}"
+        self.breaker = get_breaker(
+            name,
+            failure_threshold=config.get('FAILURE_THRESHOLD', 5),
+            recovery_timeout=config.get('RECOVERY_TIMEOUT', 30),
+        )
+        self.fallback = get_fallback_cache(
+            self.breaker,
+            timeout=params.get('TIMEOUT', 300),
+            key_prefix=params.get('KEY_PREFIX', ''),
+            max_entries=config.get('FALLBACK_MAX_ENTRIES', 1000),
+        )
+        self.pending = get_pending_invalidations(self.breaker, config.get('REPLAY_MAX_KEYS', 100000))
+        self._scripts: Dict[str, Any] = {}
+
+    def _guarded(self, command: str, operation: Callable[[], Any], fallback: Callable[[], Any],
+                 outcome: Optional[Callable[[Any], Tuple[int, int]]] = None) -> Any:
+        """
+        Run a Redis operation through the breaker, falling back when it is
+        open, and record it in the request metrics and trace. ``outcome``
+        maps the result to (hits, misses) for read operations.
+        """
+        start = time.perf_counter()
+        with start_span(f"cache.{command}", kind='client', **{'cache.breaker': self.breaker.state}) as span:
+            result = self._call(operation, fallback)
+            hits, misses = outcome(result) if outcome is not None else (0, 0)
+            if span is not None and outcome is not None:
+                span.set_attribute('cache.hits', hits)
+                span.set_attribute('cache.misses', misses)
+        record_cache_call(time.perf_counter() - start, hits=hits, misses=misses)
+        return result
+
+    def _call(self, operation: Callable[[], Any], fallback: Callable[[], Any]) -> Any:
+        if not self.breaker.allow_request():
+            return fallback()
+        try:
+            if self.pending:
+                self._replay_invalidations()
+            result = operation()
+        except ConnectionInterrupted as e:
+            if not isinstance(e.__cause__, ResponseError):
+                self.breaker.record_failure()
+                return fallback()
+            # Command errors mean Redis is up; don't trip the breaker
+            self.breaker.record_success()
+            raise
+        except CONNECTION_ERRORS:
+            self.breaker.record_failure()
+            return fallback()
+        except Exception:
+            self.breaker.record_success()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def _replay_invalidations(self) -> None:
+        """Delete from Redis what was written locally while the circuit was open"""
+        keys, patterns = self.pending.take()
+        try:
+            for version, version_keys in keys.items():
+                super().delete_many(list(version_keys), version=version)
+            for pattern, version, prefix in patterns:
+                super().delete_pattern(pattern, version=version, prefix=prefix)
+        except Exception:
+            self.pending.restore(keys, patterns)
+            raise
+        logger.info(f"Circuit breaker '{self.breaker.name}': deleted "
+                    f"{sum(map(len, keys.values()))} keys and {len(patterns)} patterns written while open")
+
+    def eval_script(self, source: str, keys: List[Any], args: List[Any], fallback: Callable[[], Any]) -> Any:
+        """Run a Lua script through the breaker, calling ``fallback`` while it is open"""
+
+        def operation():
+            client = self.get_client(write=True)
+            script = self._scripts.get(source)
+            if script is None:
+                script = self._scripts[source] = client.register_script(source)
+            return script(keys=keys, args=args, client=client)
+
+        return self._guarded('eval', operation, fallback)
+
+    def get(self, key, default=None, version=None, client=None):
+        return self._guarded(
+            'get',
+            lambda: super(CircuitBreakerClient, self).get(key, default=default, version=version, client=client),
+            lambda: self.fallback.get(key, default, version=version),
+            lambda value: (0, 1) if value is default else (1, 0),
+        )
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, client=None, nx=False, xx=False):
+
+        def fallback():
+            self.pending.add_keys([key], version)
+            if nx:
+                return self.fallback.add(key, value, timeout, version=version)
+            if xx and not self.fallback.has_key(key, version=version):
+                return False
+            self.fallback.set(key, value, timeout, version=version)
+            return True
+
+        return self._guarded(
+            'set',
+            lambda: super(CircuitBreakerClient, self).set(
+                key, value, timeout=timeout, version=version, client=client, nx=nx, xx=xx
+            ),
+            fallback,
+        )
+
+    def get_many(self, keys, version=None, client=None):
+        keys = list(keys)
+        return self._guarded(
+            'get_many',
+            lambda: super(CircuitBreakerClient, self).get_many(keys, version=version, client=client),
+            lambda: self.fallback.get_many(keys, version=version),
+            lambda found: (len(found), len(keys) - len(found)),
+        )
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None, client=None):
+        def fallback():
+            self.pending.add_keys(data, version)
+            return self.fallback.set_many(data, timeout, version=version)
+
+        def operation():
+            # DefaultClient.set_many calls self.set per key, which would be
+            # guarded and recorded again; pipeline the unguarded sets instead
+            redis = client or self.get_client(write=True)
+            try:
+                pipeline = redis.pipeline()
+                for key, value in data.items():
+                    DefaultClient.set(self, key, value, timeout, version=version, client=pipeline)
+                pipeline.execute()
+            except CONNECTION_ERRORS as e:
+                raise ConnectionInterrupted(connection=redis) from e
+
+        return self._guarded('set_many', operation, fallback)
+
+    def delete(self, key, version=None, prefix=None, client=None):
+        def fallback():
+            self.pending.add_keys([key], version)
+            return int(self.fallback.delete(key, version=version))
+
+        return self._guarded(
+            'delete',
+            lambda: super(CircuitBreakerClient, self).delete(key, version=version, prefix=prefix, client=client),
+            fallback,
+        )
+
+    def delete_many(self, keys, version=None, client=None):
+        keys = list(keys)
+
+        def fallback():
+            self.pending.add_keys(keys, version)
+            return self.fallback.delete_many(keys, version=version)
+
+        return self._guarded(
+            'delete_many',
+            lambda: super(CircuitBreakerClient, self).delete_many(keys, version=version, client=client),
+            fallback,
+        )
+
+    def delete_pattern(self, pattern, version=None, prefix=None, client=None, itersize=None):
+        def fallback():
+            # The local cache can't match patterns; dropping it is always safe
+            self.pending.add_pattern(pattern, version, prefix)
+            self.fallback.clear()
+            return 0
+
+        return self._guarded(
+            'delete_pattern',
+            lambda: super(CircuitBreakerClient, self).delete_pattern(
+                pattern, version=version, prefix=prefix, client=client, itersize=itersize
+            ),
+            fallback,
+        )
+
+    def _incr(self, key, delta=1, version=None, client=None, ignore_key_check=False):
+        def fallback():
+            self.pending.add_keys([key], version)
+            if ignore_key_check and not self.fallback.has_key(key, version=version):
+                self.fallback.set(key, delta, version=version)
+                return delta
+            return self.fallback.incr(key, delta, version=version)
+
+        return self._guarded(
+            'incr',
+            lambda: super(CircuitBreakerClient, self)._incr(
+                key, delta=delta, version=version, client=client, ignore_key_check=ignore_key_check
+            ),
+            fallback,
+        )
+
+    def has_key(self, key, version=None, client=None):
+        return self._guarded(
+            'has_key',
+            lambda: super(CircuitBreakerClient, self).has_key(key, version=version, client=client),
+            lambda: self.fallback.has_key(key, version=version),
+        )
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None, client=None):
+        return self._guarded(
+            'touch',
+            lambda: super(CircuitBreakerClient, self).touch(key, timeout=timeout, version=version, client=client),
+            lambda: self.fallback.touch(key, timeout, version=version),
+        )
+
+    def ttl(self, key, version=None, client=None):
+        return self._guarded(
+            'ttl',
+            lambda: super(CircuitBreakerClient, self).ttl(key, version=version, client=client),
+            lambda: None,
+        )
+
+    def expire(self, key, timeout, version=None, client=None):
+        return self._guarded(
+            'expire',
+            lambda: super(CircuitBreakerClient, self).expire(key, timeout, version=version, client=client),
+            lambda: self.fallback.touch(key, timeout, version=version),
+        )
+
+    def persist(self, key, version=None, client=None):
+        return self._guarded(
+            'persist',
+            lambda: super(CircuitBreakerClient, self).persist(key, version=version, client=client),
+            lambda: self.fallback.touch(key, None, version=version),
+        )
+
+    def keys(self, search, version=None, client=None):
+        return self._guarded(
+            'keys',
+            lambda: super(CircuitBreakerClient, self).keys(search, version=version, client=client),
+            lambda: [],
+        )
+
+    def clear(self, client=None):
+        self.fallback.clear()
+        return self._guarded(
+            'clear',
+            lambda: super(CircuitBreakerClient, self).clear(client=client),
+            lambda: None,
+        )
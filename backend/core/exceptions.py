@@ -102,3 +102,12 @@ class ResourceNotFound(APIException):
     status_code = status.HTTP_404_NOT_FOUND
     default_detail = 'The requested resource was not found.'
     default_code = 'not_found'
+
+
+class OutOfStock(APIException):
+    """
+    Custom exception for checkout lines the stock can no longer cover
+    """
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Some items are no longer available in the requested quantity.'
+    default_code = 'out_of_stock'
@@ -6,6 +6,7 @@ from django.db import connection
 from django.core.cache import cache
 from django.utils import timezone
 from django.conf import settings
+from core.circuit_breaker import get_cache_breaker_state
 import psutil
 import os
 import redis
@@ -31,6 +32,10 @@ def health_check(request):
         cache.set('health_check', 'ok', timeout=10)
         cache_result = cache.get('health_check')
         redis_status = "healthy" if cache_result == 'ok' else "error"
+        # A local fallback answers while the circuit is open
+        breaker_state = get_cache_breaker_state(cache)
+        if breaker_state and breaker_state['state'] != 'closed':
+            redis_status = "error: circuit breaker open"
     except Exception as e:
         redis_status = f"error: {str(e)}"
 
@@ -93,9 +98,11 @@ def detailed_health_check(request):
         cache.delete('health_test')
         response_time = (timezone.now() - start_time).total_seconds()
         
+        breaker_state = get_cache_breaker_state(cache)
         checks['redis'] = {
-            'status': 'healthy',
-            'response_time': f"{response_time:.3f}s"
+            'status': 'degraded' if breaker_state and breaker_state['state'] != 'closed' else 'healthy',
+            'response_time': f"{response_time:.3f}s",
+            'circuit_breaker': breaker_state,
         }
     except Exception as e:
         checks['redis'] = {'status': 'error', 'error': str(e)}
@@ -0,0 +1,133 @@
+"""
+Per-request instrumentation.
+
+``PerformanceMonitoringMiddleware`` opens a ``RequestMetrics`` for every API
+request. The database execute wrapper, the Redis cache client and the
+serializer hook record into the metrics of the current request through a
+context variable, so none of them need a reference to the request. Top-level
+serialization is also traced as a span (``core.tracing``).
+"""
+import contextvars
+import time
+from typing import Any, Dict, Optional
+
+from .tracing import start_span
+
+_current_metrics: contextvars.ContextVar = contextvars.ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    """Counters and timings (in seconds) for one request"""
+    __slots__ = (
+        'route', 'query_count', 'sql_time', 'cache_hits', 'cache_misses', 'cache_calls', 'cache_time',
+        'serializer_time', '_serializer_depth',
+    )
+
+    def __init__(self):
+        self.route = None
+        self.query_count = 0
+        self.sql_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_calls = 0
+        self.cache_time = 0.0
+        self.serializer_time = 0.0
+        self._serializer_depth = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Export metrics as log fields, times in milliseconds"""
+        return {
+            'db_queries': self.query_count,
+            'db_ms': round(self.sql_time * 1000, 2),
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'cache_calls': self.cache_calls,
+            'cache_ms': round(self.cache_time * 1000, 2),
+            'serializer_ms': round(self.serializer_time * 1000, 2),
+        }
+
+    def server_timing(self, total: Optional[float] = None) -> str:
+        """Render the metrics as a Server-Timing header value"""
+        entries = [
+            f'db;dur={self.sql_time * 1000:.1f};desc="{self.query_count} queries"',
+            f'cache;dur={self.cache_time * 1000:.1f};desc="{self.cache_hits} hits, {self.cache_misses} misses"',
+            f'serialize;dur={self.serializer_time * 1000:.1f}',
+        ]
+        if total is not None:
+            entries.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(entries)
+
+
+def start_request() -> contextvars.Token:
+    """Open metrics for the current request"""
+    return _current_metrics.set(RequestMetrics())
+
+
+def end_request(token: contextvars.Token) -> None:
+    """Close the metrics opened by ``start_request``"""
+    _current_metrics.reset(token)
+
+
+def get_current_metrics() -> Optional[RequestMetrics]:
+    """Return the metrics of the current request, or None outside a request"""
+    return _current_metrics.get()
+
+
+def record_cache_call(duration: float, hits: int = 0, misses: int = 0) -> None:
+    """Record one cache round trip"""
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.cache_calls += 1
+        metrics.cache_time += duration
+        metrics.cache_hits += hits
+        metrics.cache_misses += misses
+
+
+def query_timer(execute, sql, params, many, context):
+    """Database execute wrapper counting and timing queries"""
+    metrics = _current_metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.query_count += 1
+        metrics.sql_time += time.perf_counter() - start
+
+
+def _timed_to_representation(to_representation):
+    """Wrap a serializer ``to_representation`` so only the outermost call is timed"""
+
+    def wrapper(self, instance):
+        metrics = _current_metrics.get()
+        if metrics is None or metrics._serializer_depth:
+            return to_representation(self, instance)
+
+        metrics._serializer_depth += 1
+        start = time.perf_counter()
+        sql_time = metrics.sql_time
+        try:
+            with start_span('serialize', serializer=type(getattr(self, 'child', self)).__name__):
+                return to_representation(self, instance)
+        finally:
+            # Lazy relations are loaded while serializing; their SQL time is
+            # already counted under db, so keep the two timings disjoint
+            metrics._serializer_depth -= 1
+            elapsed = time.perf_counter() - start
+            metrics.serializer_time += elapsed - (metrics.sql_time - sql_time)
+
+    wrapper.__wrapped__ = to_representation
+    wrapper._timed = True
+    return wrapper
+
+
+def install_serializer_timing() -> None:
+    """Time DRF serialization; safe to call more than once"""
+    from rest_framework.serializers import ListSerializer, Serializer
+
+    for serializer_class in (Serializer, ListSerializer):
+        to_representation = serializer_class.to_representation
+        if not getattr(to_representation, '_timed', False):
+            serializer_class.to_representation = _timed_to_representation(to_representation)
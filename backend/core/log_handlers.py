@@ -0,0 +1,171 @@
+"""
+Non-blocking JSON-lines logging.
+
+``AsyncJSONLinesHandler`` only enqueues records on the calling thread. A
+background thread drains the queue in batches, formats each record as one
+JSON object per line and writes the batch to a size-rotated file with a
+single write. When the queue is full records are dropped (and counted)
+rather than blocking the request. ``logging.shutdown()`` flushes the queue
+at exit.
+
+Configured as a regular ``LOGGING`` handler::
+
+    'api_file': {
+        'class': 'core.log_handlers.AsyncJSONLinesHandler',
+        'filename': 'logs/api.log',
+        'max_bytes': 10 * 1024 * 1024,
+        'backup_count': 5,
+        'batch_size': 200,
+        'flush_interval': 1.0,
+        'queue_size': 10000,
+    }
+"""
+import datetime
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler, RotatingFileHandler
+from typing import List
+
+_STOP = object()
+
+
+class _FlushMarker:
+    """Queue item signalling that everything before it has been written"""
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class JSONLinesFormatter(logging.Formatter):
+    """Format a record as one JSON object, merging the ``fields`` extra"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'timestamp': datetime.datetime.fromtimestamp(record.created, tz=datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class AsyncJSONLinesHandler(QueueHandler):
+    """Queue handler with a batching background writer and file rotation"""
+
+    def __init__(self, filename: str, max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5,
+                 batch_size: int = 200, flush_interval: float = 1.0, queue_size: int = 10000):
+        super().__init__(queue.Queue(maxsize=queue_size))
+        self.setFormatter(JSONLinesFormatter())
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+
+        # Only used for its stream and rollover logic; records never pass through it
+        self.file_handler = RotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True
+        )
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self) -> None:
+        """Start the writer thread on first use, and again after a fork"""
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._monitor, name='log-writer', daemon=True)
+            self._thread.start()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting happens on the writer thread; only pin the message so
+        # later mutation of the arguments can't change it
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _monitor(self) -> None:
+        """Writer thread: drain the queue in batches until stopped"""
+        while True:
+            try:
+                record = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            batch = [record]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            records = [item for item in batch if isinstance(item, logging.LogRecord)]
+            self._write(records)
+            for item in batch:
+                if isinstance(item, _FlushMarker):
+                    item.done.set()
+            if any(item is _STOP for item in batch):
+                return
+
+    def _write(self, records: List[logging.LogRecord]) -> None:
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            records.append(logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': f"Dropped {dropped} log records, queue full",
+            }))
+        if not records:
+            return
+
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record) + '\n')
+            except Exception:
+                self.handleError(record)
+        data = ''.join(lines)
+
+        handler = self.file_handler
+        try:
+            if handler.stream is None:
+                handler.stream = handler._open()
+            if handler.maxBytes and handler.stream.tell() + len(data) >= handler.maxBytes:
+                handler.doRollover()
+            handler.stream.write(data)
+            handler.stream.flush()
+        except Exception as e:
+            sys.stderr.write(f"AsyncJSONLinesHandler: failed to write {len(lines)} records: {e}\n")
+
+    def flush(self) -> None:
+        """Block until everything enqueued so far has been written"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        marker = _FlushMarker()
+        self.queue.put(marker)
+        marker.done.wait(timeout=5)
+
+    def close(self) -> None:
+        thread = self._thread
+        if thread is not None and thread.is_alive() and self._pid == os.getpid():
+            self.queue.put(_STOP)
+            thread.join(timeout=5)
+        self._thread = None
+        self.file_handler.close()
+        super().close()
@@ -0,0 +1,100 @@
+"""
+Prometheus metrics.
+
+``PerformanceMonitoringMiddleware`` records every API request here: request
+counts and latency per route, requests in flight, and the DB/cache figures
+collected by ``core.instrumentation``. Routes are labelled with the URL name
+(e.g. ``product-list``) so label cardinality stays bounded.
+
+Under gunicorn each worker has its own memory, so when
+``PROMETHEUS_MULTIPROC_DIR`` is set prometheus_client keeps values in
+per-process mmap'd files in that directory and ``/api/metrics/`` aggregates
+them across workers. The directory must be emptied before the server starts
+(see gunicorn.conf.py).
+
+Scrapes must send ``Authorization: Bearer <METRICS_AUTH_TOKEN>``; with no
+token configured the endpoint is only served when ``DEBUG`` is on.
+"""
+import hmac
+import os
+from typing import Optional
+
+from django.conf import settings
+from django.http import HttpResponse
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest,
+)
+from prometheus_client import multiprocess
+
+from .instrumentation import RequestMetrics
+
+UNMATCHED_ROUTE = 'unmatched'
+
+REQUESTS = Counter(
+    'api_requests_total', 'API requests', ['method', 'route', 'status'],
+)
+REQUEST_LATENCY = Histogram(
+    'api_request_duration_seconds', 'API request latency', ['method', 'route'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+IN_FLIGHT = Gauge(
+    'api_requests_in_flight', 'API requests currently being served', multiprocess_mode='livesum',
+)
+DB_QUERIES = Histogram(
+    'api_request_db_queries', 'Database queries per API request', ['route'],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200),
+)
+DB_DURATION = Histogram(
+    'api_request_db_duration_seconds', 'Database time per API request', ['route'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+CACHE_LOOKUPS = Counter(
+    'cache_lookups_total', 'Cache lookups by result', ['result'],
+)
+SHED_REQUESTS = Counter(
+    'api_requests_shed_total', 'API requests refused by admission control', ['route_class', 'reason'],
+)
+
+
+def get_route(request) -> str:
+    """Return the URL name used as the route label"""
+    match = getattr(request, 'resolver_match', None)
+    return (match.url_name or match.view_name) if match else UNMATCHED_ROUTE
+
+
+def observe_request(request, status_code: int, duration: float, metrics: Optional[RequestMetrics]) -> None:
+    """Record a finished API request"""
+    route = get_route(request)
+    REQUESTS.labels(request.method, route, str(status_code)).inc()
+    REQUEST_LATENCY.labels(request.method, route).observe(duration)
+
+    if metrics is not None:
+        DB_QUERIES.labels(route).observe(metrics.query_count)
+        DB_DURATION.labels(route).observe(metrics.sql_time)
+        if metrics.cache_hits:
+            CACHE_LOOKUPS.labels('hit').inc(metrics.cache_hits)
+        if metrics.cache_misses:
+            CACHE_LOOKUPS.labels('miss').inc(metrics.cache_misses)
+
+
+def get_registry():
+    """Return the registry to expose, aggregated over workers in multiprocess mode"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def metrics_view(request):
+    """Expose metrics in the Prometheus text format"""
+    token = getattr(settings, 'PROMETHEUS_METRICS', {}).get('AUTH_TOKEN')
+    if token:
+        auth = request.META.get('HTTP_AUTHORIZATION', '')
+        if not hmac.compare_digest(auth.encode(), f"Bearer {token}".encode()):
+            return HttpResponse('Unauthorized', status=401, content_type='text/plain')
+    elif not settings.DEBUG:
+        # Fail closed: without a token metrics are only served in development
+        return HttpResponse('Metrics require METRICS_AUTH_TOKEN', status=403, content_type='text/plain')
+
+    return HttpResponse(generate_latest(get_registry()), content_type=CONTENT_TYPE_LATEST)
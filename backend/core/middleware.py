@@ -1,55 +1,139 @@
 import logging
 import time
+import cProfile
 import json
+import random
+import threading
+from contextlib import ExitStack
+from django.conf import settings
+from django.db import connection
 from django.utils.deprecation import MiddlewareMixin
 from django.http import JsonResponse
 from rest_framework import status
 
+from . import admission
+from . import metrics as prometheus
+from . import n_plus_one
+from . import profiling
+from . import tracing
+from .instrumentation import end_request, get_current_metrics, install_serializer_timing, query_timer, start_request
+from .slow_queries import get_recorder
+
 logger = logging.getLogger('apps')
+api_logger = logging.getLogger('core.api')
+
+# Only one request is profiled at a time per process
+_profile_lock = threading.Lock()
+
+
+class TracingMiddleware(MiddlewareMixin):
+    """
+    Middleware tracing sampled API requests (TRACING setting, see
+    core/tracing.py). The root span covers the rest of the middleware stack;
+    the view, DB queries, cache calls, serializers and email sends become
+    child spans.
+    """
+    
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.config = tracing.get_config()
+        self.trusted_networks = tracing.parse_networks(self.config['TRUSTED_NETWORKS'])
+        tracing.install_tracing()
+    
+    def __call__(self, request):
+        if not self.config['ENABLED'] or not request.path.startswith('/api/'):
+            return super().__call__(request)
+        
+        trace, token = tracing.begin_trace(
+            request.META.get('HTTP_TRACEPARENT'), self.config['SAMPLE_RATE'], self.config['MAX_SPANS'],
+            trusted=tracing.is_trusted(request.META.get('REMOTE_ADDR'), self.trusted_networks)
+        )
+        if trace is None:
+            return super().__call__(request)
+        
+        try:
+            with tracing.start_span(f"{request.method} {request.path}", kind='server', **{
+                'http.method': request.method,
+                'http.target': request.path,
+            }) as span, connection.execute_wrapper(tracing.trace_query):
+                response = super().__call__(request)
+                route = prometheus.get_route(request)
+                span.name = f"{request.method} {route}"
+                span.set_attribute('http.route', route)
+                span.set_attribute('http.status_code', response.status_code)
+                if response.status_code >= 500:
+                    span.status = 'error'
+                response['X-Trace-Id'] = trace.trace_id
+                return response
+        finally:
+            tracing.end_trace(trace, token)
+    
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """Open the view span"""
+        if tracing.is_tracing():
+            request.trace_view_span = tracing.start_span(
+                'view', view=getattr(view_func, '__name__', type(view_func).__name__)
+            )
+            request.trace_view_span.__enter__()
+    
+    def process_response(self, request, response):
+        """Close the view span"""
+        view_span = getattr(request, 'trace_view_span', None)
+        if view_span is not None:
+            view_span.__exit__(None, None, None)
+            del request.trace_view_span
+        return response
 
 
 class APILoggingMiddleware(MiddlewareMixin):
     """
-    Middleware for logging API requests and responses
+    Middleware for logging API requests and responses.
+    
+    Writes one structured record per request to the 'core.api' logger, which
+    is routed to a non-blocking JSON-lines handler. Successful requests are
+    sampled (API_LOGGING setting); errors and slow requests are always logged.
     """
     
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        config = getattr(settings, 'API_LOGGING', {})
+        self.success_sample_rate = config.get('SUCCESS_SAMPLE_RATE', 1.0)
+        self.slow_request_threshold = config.get('SLOW_REQUEST_THRESHOLD', 1.0)
+    
     def process_request(self, request):
-        """Log incoming API requests"""
+        """Mark the start of an API request"""
         if request.path.startswith('/api/'):
             request.start_time = time.time()
-            
-            # Log request details
-            log_data = {
-                'type': 'request',
-                'method': request.method,
-                'path': request.path,
-                'user': request.user.username if request.user.is_authenticated else 'anonymous',
-                'ip': self.get_client_ip(request),
-                'user_agent': request.META.get('HTTP_USER_AGENT', ''),
-            }
-            
-            logger.info(f"API Request: {json.dumps(log_data)}")
     
     def process_response(self, request, response):
-        """Log API responses"""
+        """Log API requests with their response"""
         if hasattr(request, 'start_time') and request.path.startswith('/api/'):
             duration = time.time() - request.start_time
+            is_error = response.status_code >= 400
+            
+            if (not is_error and duration < self.slow_request_threshold
+                    and random.random() >= self.success_sample_rate):
+                return response
             
-            # Log response details
             log_data = {
-                'type': 'response',
+                'type': 'request',
                 'method': request.method,
                 'path': request.path,
                 'status_code': response.status_code,
-                'duration': f"{duration:.3f}s",
+                'duration_ms': round(duration * 1000, 2),
                 'user': request.user.username if request.user.is_authenticated else 'anonymous',
+                'ip': self.get_client_ip(request),
+                'user_agent': request.META.get('HTTP_USER_AGENT', ''),
             }
             
-            # Log errors with more detail
-            if response.status_code >= 400:
-                logger.warning(f"API Error: {json.dumps(log_data)}")
+            # Per-request metrics recorded by PerformanceMonitoringMiddleware
+            log_data.update(getattr(request, 'performance_metrics', {}))
+            
+            if is_error:
+                api_logger.warning('API Error', extra={'fields': log_data})
             else:
-                logger.info(f"API Response: {json.dumps(log_data)}")
+                log_data['sample_rate'] = self.success_sample_rate
+                api_logger.info('API Response', extra={'fields': log_data})
         
         return response
     
@@ -63,29 +147,202 @@ class APILoggingMiddleware(MiddlewareMixin):
         return ip
 
 
+class AdmissionControlMiddleware(MiddlewareMixin):
+    """
+    Middleware shedding low-priority API requests with 503 and Retry-After
+    while this worker is overloaded (ADMISSION_CONTROL setting, see
+    core/admission.py)
+    """
+    
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.config = admission.get_config()
+        self.controller = admission.AdmissionController(self.config)
+    
+    def __call__(self, request):
+        if not self.config['ENABLED'] or not request.path.startswith('/api/'):
+            return super().__call__(request)
+        
+        route_class = self.controller.classify(request)
+        reason = self.controller.admit(route_class, admission.get_queue_delay(request))
+        if reason is not None:
+            prometheus.SHED_REQUESTS.labels(route_class.name, reason).inc()
+            response = JsonResponse({
+                'error': 'Service overloaded',
+                'message': 'The server is busy, please retry shortly',
+                'status_code': 503,
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            response['Retry-After'] = str(self.config['RETRY_AFTER'])
+            return response
+        
+        start = time.perf_counter()
+        try:
+            return super().__call__(request)
+        finally:
+            self.controller.release(route_class, time.perf_counter() - start)
+
+
+class ProfilingMiddleware(MiddlewareMixin):
+    """
+    Middleware profiling API requests for staff on demand, or a sampled
+    fraction of all API requests (PROFILING setting, see core/profiling.py)
+    """
+    
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.config = profiling.get_config()
+    
+    def __call__(self, request):
+        if not self.config['ENABLED'] or not request.path.startswith('/api/'):
+            return super().__call__(request)
+        
+        mode, trigger, user = self.get_profile_request(request)
+        if mode is None or not _profile_lock.acquire(blocking=False):
+            return super().__call__(request)
+        
+        try:
+            return self.profile(request, mode, trigger, user)
+        finally:
+            _profile_lock.release()
+    
+    def get_profile_request(self, request):
+        """Return (mode, trigger, user) if this request should be profiled"""
+        requested = request.META.get(profiling.PROFILE_HEADER) or request.GET.get(profiling.PROFILE_QUERY_PARAM)
+        if requested:
+            user = profiling.get_staff_user(request)
+            if user is None:
+                return None, None, None
+            mode = requested if requested in profiling.MODES else 'cprofile'
+            trigger = 'header' if request.META.get(profiling.PROFILE_HEADER) else 'query'
+            return mode, trigger, user
+        
+        if self.config['SAMPLE_RATE'] and random.random() < self.config['SAMPLE_RATE']:
+            return self.config['SAMPLE_MODE'], 'sample', None
+        return None, None, None
+    
+    def profile(self, request, mode, trigger, user):
+        """Run the rest of the stack under the profiler and save the result"""
+        if mode == 'cprofile':
+            profiler = cProfile.Profile()
+        else:
+            profiler = profiling.StackSampler(self.config['SAMPLER_INTERVAL'])
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            response = super().__call__(request)
+        finally:
+            profiler.disable()
+        duration = time.perf_counter() - start
+        
+        try:
+            profile_id = profiling.save_profile(
+                request, response, profiler, mode, trigger, user, duration, self.config
+            )
+        except OSError as e:
+            logger.error(f"Failed to save profile for {request.path}: {e}")
+        else:
+            response['X-Profile-Id'] = profile_id
+        return response
+
+
 class PerformanceMonitoringMiddleware(MiddlewareMixin):
     """
-    Middleware for monitoring API performance
+    Middleware for monitoring API performance.
+
+    Records query count, SQL time, cache hits/misses/time and serializer time
+    for each API request, emits them as a Server-Timing header and Prometheus
+    metrics, and warns when a request exceeds its query budget
+    (PERFORMANCE_MONITORING setting). With N_PLUS_ONE enabled, repeated
+    queries are reported too (see core/n_plus_one.py).
     """
     
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.config = getattr(settings, 'PERFORMANCE_MONITORING', {})
+        self.prometheus_enabled = getattr(settings, 'PROMETHEUS_METRICS', {}).get('ENABLED', True)
+        self.slow_query_recorder = (
+            get_recorder() if getattr(settings, 'SLOW_QUERIES', {}).get('ENABLED', True) else None
+        )
+        self.n_plus_one = n_plus_one.get_config()
+        install_serializer_timing()
+    
+    def __call__(self, request):
+        if not request.path.startswith('/api/'):
+            return super().__call__(request)
+        
+        token = start_request()
+        try:
+            with ExitStack() as stack:
+                stack.enter_context(connection.execute_wrapper(query_timer))
+                if self.slow_query_recorder is not None:
+                    stack.enter_context(connection.execute_wrapper(self.slow_query_recorder))
+                detector = None
+                if self.n_plus_one['ENABLED']:
+                    detector = n_plus_one.NPlusOneDetector.from_settings()
+                    stack.enter_context(connection.execute_wrapper(detector))
+                stack.enter_context(prometheus.IN_FLIGHT.track_inprogress())
+                response = super().__call__(request)
+                if detector is not None:
+                    detector.check(self.n_plus_one['ACTION'], f"{request.method} {request.path}")
+                return response
+        finally:
+            end_request(token)
+    
     def process_request(self, request):
         """Start performance monitoring"""
         if request.path.startswith('/api/'):
             request.performance_start = time.time()
     
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """Tag the request metrics with the resolved route"""
+        metrics = get_current_metrics()
+        if metrics is not None:
+            metrics.route = prometheus.get_route(request)
+    
     def process_response(self, request, response):
         """Monitor response performance"""
         if hasattr(request, 'performance_start') and request.path.startswith('/api/'):
             duration = time.time() - request.performance_start
+            metrics = get_current_metrics()
             
             # Log slow requests
-            if duration > 1.0:  # Log requests taking more than 1 second
+            if duration > self.config.get('SLOW_REQUEST_THRESHOLD', 1.0):
                 logger.warning(f"Slow API Request: {request.path} took {duration:.3f}s")
             
             # Add performance headers
             response['X-Response-Time'] = f"{duration:.3f}s"
+            
+            if metrics is not None:
+                request.performance_metrics = metrics.as_dict()
+                if self.config.get('SERVER_TIMING', True):
+                    response['Server-Timing'] = metrics.server_timing(total=duration)
+                self.check_query_budget(request, metrics.query_count)
+            
+            if self.prometheus_enabled:
+                prometheus.observe_request(request, response.status_code, duration, metrics)
         
         return response
+    
+    def get_query_budget(self, request):
+        """Get the query budget for the resolved URL name"""
+        match = getattr(request, 'resolver_match', None)
+        url_name = match.url_name if match else None
+        return self.config.get('QUERY_BUDGETS', {}).get(url_name, self.config.get('DEFAULT_QUERY_BUDGET'))
+    
+    def check_query_budget(self, request, query_count):
+        """Warn when a request runs more queries than its budget"""
+        budget = self.get_query_budget(request)
+        if budget is not None and query_count > budget:
+            match = getattr(request, 'resolver_match', None)
+            log_data = {
+                'type': 'query_budget_exceeded',
+                'method': request.method,
+                'path': request.path,
+                'url_name': match.url_name if match else None,
+                'queries': query_count,
+                'budget': budget,
+            }
+            logger.warning(f"Query Budget Exceeded: {json.dumps(log_data)}")
 
 
 class ErrorHandlingMiddleware(MiddlewareMixin):
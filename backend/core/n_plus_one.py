@@ -0,0 +1,152 @@
+"""
+N+1 query detection.
+
+``NPlusOneDetector`` is a database execute wrapper that groups the queries of
+one request (or block) by normalized SQL and call site. A query shape
+repeated ``THRESHOLD`` times or more from the same place is reported as an
+N+1, together with the serializer field being rendered when it ran (e.g.
+``ProductListSerializer.primary_image``), found from the DRF
+``Serializer.to_representation`` frame on the stack.
+
+``PerformanceMonitoringMiddleware`` runs the detector for API requests when
+``N_PLUS_ONE['ENABLED']`` is set (by default in DEBUG). ``ACTION`` is
+``'warn'`` to log, or ``'raise'`` to raise ``NPlusOneError`` (for CI). Tests
+can check a block directly::
+
+    with detect_n_plus_one():
+        self.client.get('/api/v1/products/')
+"""
+import inspect
+import logging
+import sys
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection
+
+from .slow_queries import fingerprint, get_call_site, normalize_sql
+
+logger = logging.getLogger(__name__)
+
+_to_representation_code = None
+
+
+class NPlusOneError(Exception):
+    """Raised when repeated queries are detected with ACTION 'raise'"""
+
+
+def get_config() -> Dict[str, Any]:
+    """Return the N_PLUS_ONE setting merged over the defaults"""
+    config = {
+        'ENABLED': settings.DEBUG,
+        'THRESHOLD': 5,
+        'ACTION': 'warn',
+        'STACK_DEPTH': 4,
+        'IGNORE': [],
+    }
+    config.update(getattr(settings, 'N_PLUS_ONE', {}))
+    return config
+
+
+def get_serializer_field() -> Optional[str]:
+    """Return 'Serializer.field' for the innermost field being serialized"""
+    global _to_representation_code
+    if _to_representation_code is None:
+        from rest_framework.serializers import Serializer
+        # Unwrap the timing wrapper installed by core.instrumentation
+        _to_representation_code = inspect.unwrap(Serializer.to_representation).__code__
+
+    frame = sys._getframe(1)
+    while frame is not None:
+        if frame.f_code is _to_representation_code:
+            field = frame.f_locals.get('field')
+            if field is not None:
+                return f"{type(frame.f_locals['self']).__name__}.{field.field_name}"
+        frame = frame.f_back
+    return None
+
+
+class NPlusOneDetector:
+    """Execute wrapper grouping queries by shape and call site"""
+
+    def __init__(self, threshold: int = 5, stack_depth: int = 4, ignore: Tuple[str, ...] = ()):
+        self.threshold = threshold
+        self.stack_depth = stack_depth
+        self.ignore = tuple(ignore)
+        self._groups: Dict[Tuple, Dict[str, Any]] = {}
+
+    @classmethod
+    def from_settings(cls) -> 'NPlusOneDetector':
+        config = get_config()
+        return cls(threshold=config['THRESHOLD'], stack_depth=config['STACK_DEPTH'], ignore=config['IGNORE'])
+
+    def __call__(self, execute, sql, params, many, context):
+        if not many:
+            self.record(sql)
+        return execute(sql, params, many, context)
+
+    def record(self, sql: str) -> None:
+        normalized = normalize_sql(sql)
+        field = get_serializer_field()
+        stack = get_call_site(self.stack_depth, skip_files=(__file__,))
+        key = (normalized, field, tuple(stack))
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = {
+                'fingerprint': fingerprint(normalized),
+                'normalized': normalized,
+                'serializer_field': field,
+                'stack': stack,
+                'example_sql': sql if len(sql) <= 1000 else sql[:1000] + '...',
+                'count': 0,
+            }
+        group['count'] += 1
+
+    def get_repeated(self) -> List[Dict[str, Any]]:
+        """Return the query groups at or over the threshold, most repeated first"""
+        repeated = [
+            group for group in self._groups.values()
+            if group['count'] >= self.threshold and not self.is_ignored(group)
+        ]
+        return sorted(repeated, key=lambda group: group['count'], reverse=True)
+
+    def is_ignored(self, group: Dict[str, Any]) -> bool:
+        """Return True if an IGNORE entry matches the fingerprint, serializer field or a call site"""
+        for pattern in self.ignore:
+            if pattern in (group['fingerprint'], group['serializer_field']):
+                return True
+            if any(pattern in frame for frame in group['stack']):
+                return True
+        return False
+
+    def check(self, action: str = 'warn', label: str = '') -> List[Dict[str, Any]]:
+        """Warn about or raise for repeated queries"""
+        repeated = self.get_repeated()
+        if not repeated:
+            return repeated
+
+        message = self.format(repeated, label)
+        if action == 'raise':
+            raise NPlusOneError(message)
+        logger.warning(message, extra={'fields': {'n_plus_one': repeated, 'label': label}})
+        return repeated
+
+    def format(self, repeated: List[Dict[str, Any]], label: str = '') -> str:
+        lines = [f"Possible N+1 queries{' in ' + label if label else ''}:"]
+        for group in repeated:
+            location = group['serializer_field'] or (group['stack'][0] if group['stack'] else 'unknown')
+            lines.append(f"  {group['count']}x from {location}: {group['normalized'][:200]}")
+            lines.extend(f"      at {frame}" for frame in group['stack'])
+        return '\n'.join(lines)
+
+
+@contextmanager
+def detect_n_plus_one(threshold: Optional[int] = None, action: str = 'raise', label: str = ''):
+    """Check the queries run inside the block for N+1 patterns"""
+    detector = NPlusOneDetector.from_settings()
+    if threshold is not None:
+        detector.threshold = threshold
+    with connection.execute_wrapper(detector):
+        yield detector
+    detector.check(action, label)
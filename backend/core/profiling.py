@@ -0,0 +1,189 @@
+"""
+On-demand request profiling.
+
+``core.middleware.ProfilingMiddleware`` profiles an API request when a staff
+user asks for it with the ``X-Profile`` header or the ``_profile`` query
+parameter, or when the request is picked by ``PROFILING['SAMPLE_RATE']``. The
+value selects the profiler:
+
+* ``cprofile`` - deterministic cProfile, saved as a pstats ``.prof`` file
+* ``sampler`` - a low-overhead stack sampler, saved in the collapsed
+  ``.folded`` format read by flamegraph.pl and speedscope
+
+Each profile is written to ``PROFILING['DIRECTORY']`` next to a ``.json`` file
+with the route, timing and per-request metrics, and is listed and downloaded
+through the admin API (``/api/admin/profiles/``).
+"""
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import uuid
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+PROFILE_QUERY_PARAM = '_profile'
+MODES = ('cprofile', 'sampler')
+PROFILE_EXTENSIONS = {'cprofile': '.prof', 'sampler': '.folded'}
+PROFILE_ID_RE = re.compile(r'^[0-9]{8}T[0-9]{6}-[0-9a-f]{12}$')
+
+
+def get_config() -> Dict[str, Any]:
+    """Return the PROFILING setting merged over the defaults"""
+    config = {
+        'ENABLED': True,
+        'SAMPLE_RATE': 0.0,
+        'SAMPLE_MODE': 'sampler',
+        'SAMPLER_INTERVAL': 0.005,
+        'DIRECTORY': os.path.join(settings.BASE_DIR, 'logs', 'profiles'),
+        'MAX_PROFILES': 200,
+    }
+    config.update(getattr(settings, 'PROFILING', {}))
+    return config
+
+
+class StackSampler:
+    """
+    Sample the stack of one thread at a fixed interval. Mirrors the
+    enable()/disable() interface of cProfile.Profile.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+        self._thread_id = None
+
+    def enable(self) -> None:
+        self._thread_id = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def disable(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        """Render samples in the collapsed stack format"""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+def get_staff_user(request):
+    """Return the requesting user if staff, authenticating JWT if needed"""
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return user if user.is_staff else None
+
+    # JWT authentication runs in the view, so middleware only sees an
+    # anonymous user; authenticate here, only for requests asking to profile
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+    try:
+        result = JWTAuthentication().authenticate(request)
+    except (InvalidToken, TokenError):
+        return None
+    if result is None or not result[0].is_staff:
+        return None
+    return result[0]
+
+
+def save_profile(request, response, profiler, mode: str, trigger: str, user, duration: float,
+                 config: Dict[str, Any]) -> str:
+    """Write a profile and its metadata, returning the profile id"""
+    directory = config['DIRECTORY']
+    os.makedirs(directory, exist_ok=True)
+
+    now = timezone.now()
+    profile_id = f"{now:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:12]}"
+    filename = profile_id + PROFILE_EXTENSIONS[mode]
+    path = os.path.join(directory, filename)
+    if mode == 'cprofile':
+        profiler.dump_stats(path)
+    else:
+        with open(path, 'w') as f:
+            f.write(profiler.collapsed())
+
+    match = getattr(request, 'resolver_match', None)
+    if user is None and getattr(request, 'user', None) is not None and request.user.is_authenticated:
+        user = request.user
+    metadata = {
+        'id': profile_id,
+        'filename': filename,
+        'mode': mode,
+        'trigger': trigger,
+        'method': request.method,
+        'path': request.path,
+        'route': match.url_name if match else None,
+        'status_code': response.status_code,
+        'duration_ms': round(duration * 1000, 2),
+        'user': user.username if user is not None else None,
+        'created_at': now.isoformat(),
+        'metrics': getattr(request, 'performance_metrics', {}),
+    }
+    with open(os.path.join(directory, f"{profile_id}.json"), 'w') as f:
+        json.dump(metadata, f)
+
+    logger.info(f"Saved {mode} profile {profile_id} for {request.method} {request.path} ({duration:.3f}s)")
+    prune_profiles(directory, config['MAX_PROFILES'])
+    return profile_id
+
+
+def list_profiles(directory: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Return profile metadata, newest first"""
+    directory = directory or get_config()['DIRECTORY']
+    if not os.path.isdir(directory):
+        return []
+
+    profiles = []
+    for name in sorted(os.listdir(directory), reverse=True):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+
+def get_profile_path(profile_id: str, directory: Optional[str] = None) -> Optional[str]:
+    """Return the path of a stored profile, or None if it doesn't exist"""
+    if not PROFILE_ID_RE.match(profile_id):
+        return None
+    directory = directory or get_config()['DIRECTORY']
+    for extension in PROFILE_EXTENSIONS.values():
+        path = os.path.join(directory, profile_id + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def prune_profiles(directory: str, max_profiles: int) -> None:
+    """Delete the oldest profiles beyond ``max_profiles``"""
+    profile_ids = sorted(name[:-5] for name in os.listdir(directory) if name.endswith('.json'))
+    for profile_id in profile_ids[:-max_profiles] if max_profiles else []:
+        for extension in ('.json',) + tuple(PROFILE_EXTENSIONS.values()):
+            try:
+                os.remove(os.path.join(directory, profile_id + extension))
+            except FileNotFoundError:
+                pass
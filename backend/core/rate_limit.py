@@ -0,0 +1,192 @@
+"""
+GCRA rate limiting.
+
+The generic cell rate algorithm keeps a single value per key, the theoretical
+arrival time (TAT) of the next request, instead of a list of request
+timestamps. A limit of ``limit`` requests per ``period`` seconds spaces
+requests ``period / limit`` seconds apart and allows bursts of up to
+``limit`` requests; each request advances the TAT by that interval and is
+refused while the TAT would move more than ``period`` ahead of now.
+
+``hit_many`` applies several rules (e.g. the anon, user and scoped rates of
+one request) together: the request is allowed only if every rule allows it,
+and the result carries the longest wait.
+
+``RedisGCRALimiter`` runs the check-and-update as one Lua script, so it is
+atomic across workers and costs a single round trip however many rules
+apply. Redis calls go through the cache's circuit breaker; while the breaker
+is open the process-local ``LocalGCRALimiter`` takes over. ``LocalGCRALimiter``
+is also used when the default cache is not the circuit-breaking Redis cache,
+e.g. a settings override with the local-memory backend.
+"""
+import math
+import threading
+import time
+from typing import Callable, Dict, NamedTuple, Optional, Sequence
+
+from django.core.cache import cache as default_cache
+
+from .circuit_breaker import CircuitBreakerClient
+
+KEY_PREFIX = 'gcra:'
+
+# KEYS: one limiter key per rule
+# ARGV: emission interval and period in seconds and cost in requests, per rule
+# A request is allowed only if every rule allows it; a refused request
+# consumes nothing.
+GCRA_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local new_tats = {}
+local retry_after = 0
+local remaining = -1
+for i, key in ipairs(KEYS) do
+    local interval = tonumber(ARGV[i * 3 - 2])
+    local period = tonumber(ARGV[i * 3 - 1])
+    local cost = tonumber(ARGV[i * 3])
+    local stored = redis.call('GET', key)
+    local tat = stored and tonumber(stored) or now
+    if tat < now then tat = now end
+    local new_tat = tat + interval * cost
+    local allow_at = new_tat - period
+    if allow_at > now then
+        retry_after = math.max(retry_after, allow_at - now)
+    else
+        local left = math.floor((now - allow_at) / interval)
+        if remaining < 0 or left < remaining then remaining = left end
+    end
+    new_tats[i] = new_tat
+end
+if retry_after > 0 then
+    return {0, string.format('%.6f', retry_after), 0}
+end
+for i, key in ipairs(KEYS) do
+    redis.call('SET', key, string.format('%.6f', new_tats[i]), 'PX', math.ceil((new_tats[i] - now) * 1000))
+end
+return {1, '0', remaining}
+"""
+
+
+class Rule(NamedTuple):
+    """``limit`` requests per ``period`` seconds for ``key``; a request counts ``cost`` times"""
+    key: str
+    limit: int
+    period: float
+    cost: int = 1
+
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    # Seconds until the request would be allowed by every rule, 0 when allowed
+    retry_after: float
+    # Requests still allowed right now by the tightest rule
+    remaining: int
+
+
+ALLOWED = RateLimitResult(True, 0.0, -1)
+
+
+class LocalGCRALimiter:
+    """In-process GCRA limiter; limits are per process"""
+
+    def __init__(self, timer: Callable[[], float] = time.time, max_keys: int = 10000):
+        self.timer = timer
+        self.max_keys = max_keys
+        self._tats: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key: str, limit: int, period: float, cost: int = 1) -> RateLimitResult:
+        return self.hit_many([Rule(key, limit, period, cost)])
+
+    def hit_many(self, rules: Sequence[Rule]) -> RateLimitResult:
+        """Apply all rules to one request, as ``GCRA_SCRIPT`` does"""
+        if not rules:
+            return ALLOWED
+
+        with self._lock:
+            now = self.timer()
+            new_tats = []
+            retry_after = 0.0
+            remaining = None
+            for rule in rules:
+                interval = rule.period / rule.limit
+                tat = max(self._tats.get(rule.key, now), now)
+                new_tat = tat + interval * rule.cost
+                allow_at = new_tat - rule.period
+                if allow_at > now:
+                    retry_after = max(retry_after, allow_at - now)
+                else:
+                    left = math.floor((now - allow_at) / interval)
+                    remaining = left if remaining is None else min(remaining, left)
+                new_tats.append(new_tat)
+
+            if retry_after > 0:
+                return RateLimitResult(False, retry_after, 0)
+
+            if len(self._tats) + len(rules) > self.max_keys:
+                self._prune(now)
+            for rule, new_tat in zip(rules, new_tats):
+                self._tats[rule.key] = new_tat
+            return RateLimitResult(True, 0.0, remaining)
+
+    def _prune(self, now: float) -> None:
+        """Drop keys whose TAT has passed; caller must hold the lock"""
+        self._tats = {key: tat for key, tat in self._tats.items() if tat > now}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._tats.clear()
+
+
+class RedisGCRALimiter:
+    """GCRA limiter evaluated atomically in Redis by a Lua script"""
+
+    def __init__(self, cache=default_cache, fallback: Optional[LocalGCRALimiter] = None):
+        self.cache = cache
+        self.fallback = fallback or LocalGCRALimiter()
+
+    def hit(self, key: str, limit: int, period: float, cost: int = 1) -> RateLimitResult:
+        return self.hit_many([Rule(key, limit, period, cost)])
+
+    def hit_many(self, rules: Sequence[Rule]) -> RateLimitResult:
+        """Apply all rules to one request in a single round trip"""
+        if not rules:
+            return ALLOWED
+
+        client = self.cache.client
+        args = []
+        for rule in rules:
+            args.extend((rule.period / rule.limit, rule.period, rule.cost))
+        result = client.eval_script(
+            GCRA_SCRIPT,
+            keys=[client.make_key(KEY_PREFIX + rule.key) for rule in rules],
+            args=args,
+            fallback=lambda: self.fallback.hit_many(rules),
+        )
+        if isinstance(result, RateLimitResult):
+            return result
+        allowed, retry_after, remaining = result
+        return RateLimitResult(bool(allowed), float(retry_after), int(remaining))
+
+    def reset(self) -> None:
+        """Forget every limiter key, in Redis and in the fallback"""
+        self.cache.delete_pattern(f'{KEY_PREFIX}*')
+        self.fallback.reset()
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter():
+    """Return the process-wide limiter for the default cache"""
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                if isinstance(getattr(default_cache, 'client', None), CircuitBreakerClient):
+                    _limiter = RedisGCRALimiter(default_cache)
+                else:
+                    _limiter = LocalGCRALimiter()
+    return _limiter
@@ -53,7 +53,10 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     # Custom middleware
+    'core.middleware.TracingMiddleware',
     'core.middleware.APILoggingMiddleware',
+    'core.middleware.AdmissionControlMiddleware',
+    'core.middleware.ProfilingMiddleware',
     'core.middleware.PerformanceMonitoringMiddleware',
     'core.middleware.ErrorHandlingMiddleware',
 ]
@@ -139,9 +142,7 @@ REST_FRAMEWORK = {
     'EXCEPTION_HANDLER': 'core.exceptions.custom_exception_handler',
     # Rate Limiting
     'DEFAULT_THROTTLE_CLASSES': [
-        'rest_framework.throttling.AnonRateThrottle',
-        'rest_framework.throttling.UserRateThrottle',
-        'rest_framework.throttling.ScopedRateThrottle',
+        'core.throttling.CompositeRateThrottle',
     ],
     'DEFAULT_THROTTLE_RATES': {
         'anon': '100/hour',
@@ -154,6 +155,7 @@ REST_FRAMEWORK = {
         'orders': '100/hour',
         'cart': '500/hour',
         'admin': '200/hour',
+        'cost': '3000/hour',  # request cost units, see core.throttling.throttle_cost
     },
     # API Versioning
     'DEFAULT_VERSIONING_CLASS': 'rest_framework.versioning.URLPathVersioning',
@@ -199,7 +201,19 @@ CACHES = {
         'BACKEND': 'django_redis.cache.RedisCache',
         'LOCATION': REDIS_URL,
         'OPTIONS': {
-            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'CLIENT_CLASS': 'core.circuit_breaker.CircuitBreakerClient',
+            'CIRCUIT_BREAKER': {
+                'FAILURE_THRESHOLD': 5,  # consecutive errors before opening
+                'RECOVERY_TIMEOUT': 30,  # seconds before a half-open probe
+                'FALLBACK_MAX_ENTRIES': 1000,
+                'REPLAY_MAX_KEYS': 100000,  # keys written while open, deleted from Redis on close
+            },
+            # Compact payload encoding (see core/cache_codecs.py)
+            'SERIALIZER': 'core.cache_codecs.PayloadSerializer',
+            'COMPRESSOR': 'core.cache_codecs.PayloadCompressor',
+            'PAYLOAD_CODEC': os.environ.get('CACHE_PAYLOAD_CODEC', 'msgpack'),
+            'COMPRESSION': os.environ.get('CACHE_COMPRESSION', 'zstd'),
+            'COMPRESS_MIN_LENGTH': 1024,  # bytes
         }
     }
 }
@@ -240,6 +254,30 @@ LOGGING = {
             'filename': 'logs/error.log',
             'formatter': 'verbose',
         },
+        'api_file': {
+            'level': 'INFO',
+            'class': 'core.log_handlers.AsyncJSONLinesHandler',
+            'filename': 'logs/api.log',
+            'max_bytes': 1024 * 1024 * 10,  # 10MB
+            'backup_count': 5,
+            'batch_size': 200,
+            'flush_interval': 1.0,  # seconds
+            'queue_size': 10000,
+        },
+        'slow_query_file': {
+            'level': 'WARNING',
+            'class': 'core.log_handlers.AsyncJSONLinesHandler',
+            'filename': 'logs/slow_queries.log',
+            'max_bytes': 1024 * 1024 * 10,  # 10MB
+            'backup_count': 5,
+        },
+        'trace_file': {
+            'level': 'INFO',
+            'class': 'core.log_handlers.AsyncJSONLinesHandler',
+            'filename': 'logs/traces.log',
+            'max_bytes': 1024 * 1024 * 50,  # 50MB
+            'backup_count': 5,
+        },
     },
     'loggers': {
         'django': {
@@ -267,6 +305,21 @@ LOGGING = {
             'level': 'INFO',
             'propagate': False,
         },
+        'core.api': {
+            'handlers': ['api_file'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'core.slow_queries': {
+            'handlers': ['slow_query_file'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+        'core.tracing.export': {
+            'handlers': ['trace_file'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     },
     'root': {
         'handlers': ['console', 'file'],
@@ -299,6 +352,129 @@ RATE_LIMIT_CONFIG = {
     }
 }
 
+# Structured API request logging (core.middleware.APILoggingMiddleware)
+API_LOGGING = {
+    'SUCCESS_SAMPLE_RATE': 1.0,  # fraction of successful requests logged
+    'SLOW_REQUEST_THRESHOLD': 1.0,  # seconds; slower requests are always logged
+}
+
+# Per-request performance monitoring (core.middleware.PerformanceMonitoringMiddleware)
+PERFORMANCE_MONITORING = {
+    'SLOW_REQUEST_THRESHOLD': 1.0,  # seconds
+    'SERVER_TIMING': True,
+    # Maximum queries per request, keyed by URL name; exceeding one logs a warning
+    'DEFAULT_QUERY_BUDGET': 50,
+    'QUERY_BUDGETS': {
+        'product-list': 10,
+        'product-detail': 15,
+        'cart-list': 10,
+        'cart-summary': 10,
+        'cart-validate': 5,
+        'order-list': 15,
+        'checkout': 40,
+    },
+}
+
+# Slow query capture (core/slow_queries.py)
+SLOW_QUERIES = {
+    'ENABLED': True,
+    'THRESHOLD_MS': 100,
+    'EXPLAIN': True,  # EXPLAIN QUERY PLAN on SQLite, EXPLAIN on Postgres
+    'STACK_DEPTH': 8,  # project frames kept per capture
+    'MAX_FINGERPRINTS': 500,  # query shapes aggregated per process
+}
+
+# N+1 query detection (core/n_plus_one.py); set N_PLUS_ONE_ACTION=raise in CI
+N_PLUS_ONE = {
+    'ENABLED': DEBUG or bool(os.environ.get('N_PLUS_ONE_ACTION')),
+    'THRESHOLD': 5,  # identical query shapes from one call site per request
+    'ACTION': os.environ.get('N_PLUS_ONE_ACTION', 'warn'),  # warn | raise
+    'STACK_DEPTH': 4,
+    'IGNORE': [],  # fingerprints, serializer fields or call site substrings
+}
+
+# On-demand request profiling (core/profiling.py); staff send "X-Profile: cprofile|sampler"
+PROFILING = {
+    'ENABLED': True,
+    'SAMPLE_RATE': 0.0,  # fraction of all API requests profiled
+    'SAMPLE_MODE': 'sampler',
+    'SAMPLER_INTERVAL': 0.005,  # seconds
+    'DIRECTORY': os.path.join(BASE_DIR, 'logs', 'profiles'),
+    'MAX_PROFILES': 200,
+}
+
+# Request tracing (core/tracing.py); requests with a sampled traceparent are always traced
+TRACING = {
+    'ENABLED': True,
+    'SAMPLE_RATE': 0.01,
+    'EXPORTER': os.environ.get('TRACE_EXPORTER', 'jsonl'),  # jsonl | otlp
+    'OTLP_ENDPOINT': os.environ.get('OTLP_ENDPOINT', 'http://localhost:4318/v1/traces'),
+    'SERVICE_NAME': 'cartaway-api',
+    'MAX_SPANS': 1000,  # per trace
+    # Only callers in these networks can force a trace with a sampled traceparent
+    'TRUSTED_NETWORKS': os.environ.get('TRACE_TRUSTED_NETWORKS', '127.0.0.1/32,::1/128').split(','),
+}
+
+# Prometheus metrics exposed at /api/metrics/ (core.metrics)
+PROMETHEUS_METRICS = {
+    'ENABLED': True,
+    # Scrapes must send "Authorization: Bearer <token>"; unset, metrics are served only with DEBUG
+    'AUTH_TOKEN': os.environ.get('METRICS_AUTH_TOKEN'),
+}
+
+# Load shedding per worker (core/admission.py); nginx sets X-Request-Start
+ADMISSION_CONTROL = {
+    'ENABLED': True,
+    'MAX_IN_FLIGHT': 16,  # concurrent requests per worker (threads)
+    'QUEUE_DELAY_TARGET_MS': 500,  # wait before reaching the worker
+    'RETRY_AFTER': 5,  # seconds
+    'PROBE_INTERVAL': 1.0,  # seconds between probes of a class shed for latency
+    # priority: low | normal | critical | exempt
+    'ROUTE_CLASSES': {
+        'checkout': {'PRIORITY': 'critical'},
+        'cart_write': {'PRIORITY': 'critical'},
+        'cart': {'PRIORITY': 'normal'},
+        'catalog': {'PRIORITY': 'normal', 'LATENCY_TARGET_MS': 1000},
+        'admin_analytics': {'PRIORITY': 'low', 'MAX_IN_FLIGHT': 2, 'LATENCY_TARGET_MS': 3000},
+        'ops': {'PRIORITY': 'exempt'},
+        'default': {'PRIORITY': 'normal'},
+    },
+    # (route class, path regex, methods or None for any); first match wins
+    'ROUTES': [
+        ('ops', r'^/api/(health|metrics)/', None),
+        ('checkout', r'^/api/(v1/)?orders/(checkout/)?$', ['POST']),
+        ('cart_write', r'^/api/(v1/)?cart/', ['POST', 'PUT', 'PATCH', 'DELETE']),
+        ('cart', r'^/api/(v1/)?cart/', None),
+        ('admin_analytics', r'^/api/(v1/)?(admin/(analytics|dashboard)|dashboard|analytics-events/summary'
+                            r'|(sales|product|customer)-analytics)/', None),
+        ('catalog', r'^/api/(v1/)?(products|categories)/', ['GET', 'HEAD']),
+    ],
+}
+
+# Cart storage (apps/cart/storage.py): database | redis
+CART_STORAGE = {
+    'BACKEND': os.environ.get('CART_STORAGE', 'database'),
+    'TTL': 60 * 60 * 24 * 7,  # seconds an idle cart stays in Redis
+    'FLUSH_INTERVAL': 30,  # seconds a cart may stay dirty before it is written back
+    'FLUSH_BATCH_SIZE': 200,  # carts written back per batch
+    'GUEST_TTL': 60 * 60 * 24 * 7,  # seconds an idle guest cart is kept
+    # expire_carts: idle active carts are deactivated, inactive ones deleted
+    'EXPIRE_AFTER': 60 * 60 * 24 * 30,  # seconds an active cart may stay idle
+    'DELETE_INACTIVE_AFTER': 60 * 60 * 24,  # seconds an inactive cart is kept
+    'EXPIRE_BATCH_SIZE': 1000,  # carts deactivated or deleted per statement
+    'EXPIRE_BATCH_SLEEP': 0.1,  # seconds between batches
+}
+
+# Email outbox (apps/notifications/outbox.py), drained by send_outbox_emails
+EMAIL_OUTBOX = {
+    'BATCH_SIZE': 100,  # emails sent per connection
+    'MAX_ATTEMPTS': 5,  # attempts before an email is marked failed
+    'RETRY_BACKOFF': 60,  # seconds before the first retry, doubled per attempt
+    'MAX_BACKOFF': 60 * 60,  # longest wait between retries
+    'LEASE': 5 * 60,  # seconds a claimed batch is hidden from other workers
+    'POLL_INTERVAL': 5,  # seconds the worker sleeps when the outbox is drained
+}
+
 # API Documentation Settings
 SPECTACULAR_SETTINGS = {
     'TITLE': 'E-commerce API',
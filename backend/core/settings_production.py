@@ -37,13 +37,25 @@ CACHES = {
         'BACKEND': 'django_redis.cache.RedisCache',
         'LOCATION': os.environ.get('REDIS_URL', 'redis://localhost:6379/1'),
         'OPTIONS': {
-            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'CLIENT_CLASS': 'core.circuit_breaker.CircuitBreakerClient',
             'CONNECTION_POOL_KWARGS': {
                 'max_connections': 50,
-                'retry_on_timeout': True,
+                # Retrying would double the latency of every timed-out call;
+                # the circuit breaker handles a degraded Redis instead
+                'retry_on_timeout': False,
             },
-            'SOCKET_CONNECT_TIMEOUT': 5,
-            'SOCKET_TIMEOUT': 5,
+            'SOCKET_CONNECT_TIMEOUT': float(os.environ.get('REDIS_SOCKET_CONNECT_TIMEOUT', 0.5)),
+            'SOCKET_TIMEOUT': float(os.environ.get('REDIS_SOCKET_TIMEOUT', 0.5)),
+            'CIRCUIT_BREAKER': {
+                'FAILURE_THRESHOLD': 5,  # consecutive errors before opening
+                'RECOVERY_TIMEOUT': 15,  # seconds before a half-open probe
+                'FALLBACK_MAX_ENTRIES': 5000,
+            },
+            'SERIALIZER': 'core.cache_codecs.PayloadSerializer',
+            'COMPRESSOR': 'core.cache_codecs.PayloadCompressor',
+            'PAYLOAD_CODEC': os.environ.get('CACHE_PAYLOAD_CODEC', 'msgpack'),
+            'COMPRESSION': os.environ.get('CACHE_COMPRESSION', 'zstd'),
+            'COMPRESS_MIN_LENGTH': 1024,  # bytes
         },
         'KEY_PREFIX': 'ecommerce_prod',
         'TIMEOUT': 300,
@@ -131,6 +143,30 @@ LOGGING = {
             'backupCount': 5,
             'formatter': 'verbose',
         },
+        'api_file': {
+            'level': 'INFO',
+            'class': 'core.log_handlers.AsyncJSONLinesHandler',
+            'filename': '/var/log/django/api.log',
+            'max_bytes': 1024 * 1024 * 10,  # 10MB
+            'backup_count': 5,
+            'batch_size': 200,
+            'flush_interval': 1.0,  # seconds
+            'queue_size': 10000,
+        },
+        'slow_query_file': {
+            'level': 'WARNING',
+            'class': 'core.log_handlers.AsyncJSONLinesHandler',
+            'filename': '/var/log/django/slow_queries.log',
+            'max_bytes': 1024 * 1024 * 10,  # 10MB
+            'backup_count': 5,
+        },
+        'trace_file': {
+            'level': 'INFO',
+            'class': 'core.log_handlers.AsyncJSONLinesHandler',
+            'filename': '/var/log/django/traces.log',
+            'max_bytes': 1024 * 1024 * 50,  # 50MB
+            'backup_count': 5,
+        },
     },
     'loggers': {
         'django': {
@@ -158,6 +194,21 @@ LOGGING = {
             'level': 'INFO',
             'propagate': False,
         },
+        'core.api': {
+            'handlers': ['api_file'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'core.slow_queries': {
+            'handlers': ['slow_query_file'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+        'core.tracing.export': {
+            'handlers': ['trace_file'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     },
     'root': {
         'handlers': ['console', 'file'],
@@ -200,9 +251,7 @@ REST_FRAMEWORK = {
     ),
     'EXCEPTION_HANDLER': 'core.exceptions.custom_exception_handler',
     'DEFAULT_THROTTLE_CLASSES': [
-        'rest_framework.throttling.AnonRateThrottle',
-        'rest_framework.throttling.UserRateThrottle',
-        'rest_framework.throttling.ScopedRateThrottle',
+        'core.throttling.CompositeRateThrottle',
     ],
     'DEFAULT_THROTTLE_RATES': {
         'anon': '50/hour',  # Reduced for production
@@ -215,6 +264,7 @@ REST_FRAMEWORK = {
         'orders': '50/hour',
         'cart': '200/hour',
         'admin': '100/hour',
+        'cost': '1500/hour',  # request cost units, see core.throttling.throttle_cost
     },
     'DEFAULT_VERSIONING_CLASS': 'rest_framework.versioning.URLPathVersioning',
     'DEFAULT_VERSION': 'v1',
@@ -267,7 +317,10 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
+    'x-cart-token',
 ]
+# Guest cart token issued by the cart API (apps/cart/storage.py)
+CORS_EXPOSE_HEADERS = ['x-cart-token']
 
 # API Documentation settings for production
 SPECTACULAR_SETTINGS = {
@@ -306,6 +359,37 @@ SPECTACULAR_SETTINGS = {
     },
 }
 
+# Errors and slow requests are always logged; sample the rest
+API_LOGGING = {
+    'SUCCESS_SAMPLE_RATE': float(os.environ.get('API_LOG_SAMPLE_RATE', '0.1')),
+    'SLOW_REQUEST_THRESHOLD': 1.0,  # seconds
+}
+
+# Request profiling
+PROFILING = {
+    **PROFILING,
+    'SAMPLE_RATE': float(os.environ.get('PROFILE_SAMPLE_RATE', '0.0')),
+    'DIRECTORY': '/var/log/django/profiles',
+}
+
+# Request tracing
+TRACING = {
+    **TRACING,
+    'SAMPLE_RATE': float(os.environ.get('TRACE_SAMPLE_RATE', '0.01')),
+}
+
+# N+1 detection is for development and CI
+N_PLUS_ONE = {
+    **N_PLUS_ONE,
+    'ENABLED': False,
+}
+
+# Load shedding; sync gunicorn workers serve one request at a time
+ADMISSION_CONTROL = {
+    **ADMISSION_CONTROL,
+    'MAX_IN_FLIGHT': int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', '1')),
+}
+
 # Monitoring and health check settings
 HEALTH_CHECK_ENABLED = True
 HEALTH_CHECK_TIMEOUT = 30  # seconds
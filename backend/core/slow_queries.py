@@ -0,0 +1,221 @@
+"""
+Slow query capture.
+
+``SlowQueryRecorder`` is a database execute wrapper installed for API
+requests by ``PerformanceMonitoringMiddleware``. Queries slower than
+``SLOW_QUERIES['THRESHOLD_MS']`` are captured with their SQL, a fingerprint of
+the parameters, the call site in project code and the route, optionally
+EXPLAINed, and:
+
+* logged as one JSON line to the ``core.slow_queries`` logger, and
+* aggregated in memory by normalized query fingerprint, so the most
+  expensive query shapes of this process can be listed with ``get_report()``
+  (``/api/admin/slow-queries/``).
+
+``manage.py slow_query_report`` aggregates the log across all workers.
+"""
+import hashlib
+import logging
+import os
+import re
+import sysconfig
+import threading
+import time
+import traceback
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import instrumentation
+from .instrumentation import get_current_metrics
+
+logger = logging.getLogger('core.slow_queries')
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER_LIST_RE = re.compile(r'\(\s*(?:(?:%s|\?)\s*,\s*)+(?:%s|\?)\s*\)')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+}
+
+# Frames from the standard library, installed packages and the
+# instrumentation itself are skipped when locating the call site
+_SKIPPED_PATHS = (sysconfig.get_paths()['stdlib'], os.sep + 'site-packages' + os.sep)
+_SKIPPED_FILES = (__file__, instrumentation.__file__)
+
+
+def normalize_sql(sql: str) -> str:
+    """Reduce a query to its shape: literals, placeholders and IN lists collapsed"""
+    sql = _STRING_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = sql.replace('%s', '?')
+    sql = _PLACEHOLDER_LIST_RE.sub('(...)', sql)
+    return _WHITESPACE_RE.sub(' ', sql).strip()
+
+
+def fingerprint(value: str) -> str:
+    return hashlib.sha1(value.encode()).hexdigest()[:16]
+
+
+def get_call_site(depth: int, skip_files=()) -> List[str]:
+    """Return the innermost ``depth`` project frames of the current stack"""
+    frames = []
+    for frame in reversed(traceback.extract_stack()):
+        filename = frame.filename
+        if (filename in _SKIPPED_FILES or filename in skip_files
+                or any(path in filename for path in _SKIPPED_PATHS)):
+            continue
+        frames.append(f"{os.path.relpath(filename, settings.BASE_DIR)}:{frame.lineno} in {frame.name}")
+        if len(frames) >= depth:
+            break
+    return frames
+
+
+class SlowQueryRecorder:
+    """Execute wrapper capturing and aggregating slow queries"""
+
+    def __init__(self, threshold_ms: float = 100, explain: bool = True, stack_depth: int = 8,
+                 max_fingerprints: int = 500):
+        self.threshold = threshold_ms / 1000
+        self.explain = explain
+        self.stack_depth = stack_depth
+        self.max_fingerprints = max_fingerprints
+        self._stats: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> 'SlowQueryRecorder':
+        config = getattr(settings, 'SLOW_QUERIES', {})
+        return cls(
+            threshold_ms=config.get('THRESHOLD_MS', 100),
+            explain=config.get('EXPLAIN', True),
+            stack_depth=config.get('STACK_DEPTH', 8),
+            max_fingerprints=config.get('MAX_FINGERPRINTS', 500),
+        )
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        result = execute(sql, params, many, context)
+        duration = time.perf_counter() - start
+        if duration >= self.threshold:
+            try:
+                self.record(sql, params, many, duration, context['connection'])
+            except Exception as e:
+                # Never fail the query because of the recorder
+                logger.warning(f"Failed to record slow query: {e}")
+        return result
+
+    def record(self, sql: str, params, many: bool, duration: float, connection) -> Dict[str, Any]:
+        """Capture one slow query"""
+        normalized = normalize_sql(sql)
+        metrics = get_current_metrics()
+        capture = {
+            'fingerprint': fingerprint(normalized),
+            'params_fingerprint': fingerprint(repr(params)),
+            'duration_ms': round(duration * 1000, 2),
+            'route': metrics.route if metrics is not None else None,
+            'sql': sql if len(sql) <= 2000 else sql[:2000] + '...',
+            'normalized': normalized,
+            'many': many,
+            'stack': get_call_site(self.stack_depth),
+            'plan': None,
+        }
+        if self.explain and not many:
+            capture['plan'] = self.get_plan(sql, params, connection)
+
+        logger.warning('Slow query', extra={'fields': capture})
+        self.aggregate(capture)
+        return capture
+
+    def get_plan(self, sql: str, params, connection) -> Optional[List[str]]:
+        """Run EXPLAIN for a SELECT, bypassing the execute wrappers"""
+        prefix = EXPLAIN_PREFIXES.get(connection.vendor)
+        if prefix is None or not sql.lstrip().upper().startswith('SELECT'):
+            return None
+
+        # A failed statement would abort an open Postgres transaction
+        use_savepoint = connection.vendor == 'postgresql' and connection.in_atomic_block
+        cursor = connection.create_cursor()
+        try:
+            if use_savepoint:
+                cursor.execute('SAVEPOINT slow_query_explain')
+            try:
+                cursor.execute(prefix + sql, params)
+                rows = cursor.fetchall()
+            except Exception as e:
+                if use_savepoint:
+                    cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+                return [f"EXPLAIN failed: {e}"]
+            if use_savepoint:
+                cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+        finally:
+            cursor.close()
+
+        # Postgres returns one text column; SQLite returns (id, parent, notused, detail)
+        return [str(row[-1]) for row in rows]
+
+    def aggregate(self, capture: Dict[str, Any]) -> None:
+        with self._lock:
+            stats = self._stats.get(capture['fingerprint'])
+            if stats is None:
+                if len(self._stats) >= self.max_fingerprints:
+                    # Make room by dropping the cheapest query shape
+                    cheapest = min(self._stats, key=lambda key: self._stats[key]['total_ms'])
+                    del self._stats[cheapest]
+                stats = self._stats[capture['fingerprint']] = {
+                    'fingerprint': capture['fingerprint'],
+                    'normalized': capture['normalized'],
+                    'count': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'routes': Counter(),
+                    'distinct_params': set(),
+                }
+            stats['count'] += 1
+            stats['total_ms'] += capture['duration_ms']
+            stats['max_ms'] = max(stats['max_ms'], capture['duration_ms'])
+            stats['routes'][capture['route']] += 1
+            if len(stats['distinct_params']) < 100:
+                stats['distinct_params'].add(capture['params_fingerprint'])
+            stats['last_sql'] = capture['sql']
+            stats['last_stack'] = capture['stack']
+            if capture['plan'] is not None:
+                stats['last_plan'] = capture['plan']
+            stats['last_seen'] = capture.get('timestamp') or timezone.now().isoformat()
+
+    def get_report(self, limit: int = 20, order_by: str = 'total_ms') -> List[Dict[str, Any]]:
+        """Return the top query shapes by total, max or mean time, or count"""
+        with self._lock:
+            entries = []
+            for stats in self._stats.values():
+                entry = dict(stats)
+                entry['total_ms'] = round(stats['total_ms'], 2)
+                entry['mean_ms'] = round(stats['total_ms'] / stats['count'], 2)
+                entry['routes'] = dict(stats['routes'].most_common())
+                entry['distinct_params'] = len(stats['distinct_params'])
+                entries.append(entry)
+        entries.sort(key=lambda entry: entry.get(order_by, 0), reverse=True)
+        return entries[:limit]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+
+_recorder: Optional[SlowQueryRecorder] = None
+_recorder_lock = threading.Lock()
+
+
+def get_recorder() -> SlowQueryRecorder:
+    """Return the process-wide recorder configured from settings"""
+    global _recorder
+    if _recorder is None:
+        with _recorder_lock:
+            if _recorder is None:
+                _recorder = SlowQueryRecorder.from_settings()
+    return _recorder
@@ -95,6 +95,33 @@ class APIMiddlewareTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn('X-Response-Time', response.headers)
     
+    def test_server_timing_header(self):
+        """Test per-request DB, cache and serializer timings"""
+        cache.clear()
+        response = self.client.get('/api/v1/products/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        server_timing = response.headers['Server-Timing']
+        for metric in ('db;dur=', 'cache;dur=', 'serialize;dur=', 'total;dur='):
+            self.assertIn(metric, server_timing)
+        self.assertRegex(server_timing, r'desc="[1-9]\d* queries"')
+    
+    def test_query_budget_warning(self):
+        """Test that exceeding a query budget logs a warning"""
+        cache.clear()
+        with self.settings(PERFORMANCE_MONITORING={'QUERY_BUDGETS': {'product-list': 0}}):
+            with self.assertLogs('apps', level='WARNING') as logs:
+                self.client.get('/api/v1/products/')
+        self.assertTrue(any('Query Budget Exceeded' in line for line in logs.output))
+    
+    def test_api_logging_sampling(self):
+        """Test that errors are always logged while successes are sampled"""
+        with self.settings(API_LOGGING={'SUCCESS_SAMPLE_RATE': 0}):
+            with self.assertNoLogs('core.api', level='INFO'):
+                self.client.get('/api/health/live/')
+            with self.assertLogs('core.api', level='WARNING') as logs:
+                self.client.get('/api/nonexistent/')
+        self.assertEqual(logs.records[0].fields['status_code'], 404)
+    
     def test_error_handling_middleware(self):
         """Test error handling middleware"""
         # Test with a non-existent endpoint
@@ -102,6 +129,839 @@ class APIMiddlewareTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
 
+class AsyncLoggingTests(TestCase):
+    """Test the non-blocking JSON-lines log handler"""
+    
+    def test_records_written_as_json_lines(self):
+        """Test records are written by the background thread"""
+        import logging
+        import os
+        import tempfile
+        from core.log_handlers import AsyncJSONLinesHandler
+        
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'api.log')
+            handler = AsyncJSONLinesHandler(filename, batch_size=10)
+            test_logger = logging.getLogger('core.tests.async')
+            test_logger.addHandler(handler)
+            test_logger.propagate = False
+            try:
+                for i in range(25):
+                    test_logger.warning('API Response', extra={'fields': {'status_code': 200, 'seq': i}})
+                handler.flush()
+            finally:
+                test_logger.removeHandler(handler)
+                handler.close()
+            
+            with open(filename) as f:
+                lines = [json.loads(line) for line in f]
+        
+        self.assertEqual([line['seq'] for line in lines], list(range(25)))
+        self.assertEqual(lines[0]['message'], 'API Response')
+        self.assertEqual(lines[0]['level'], 'WARNING')
+
+
+class PrometheusMetricsTests(APITestCase):
+    """Test the Prometheus metrics endpoint"""
+    
+    def setUp(self):
+        self.client = APIClient()
+    
+    def test_request_metrics_exposed(self):
+        """Test per-route counters and histograms are exported"""
+        self.client.get('/api/health/live/')
+        with self.settings(PROMETHEUS_METRICS={'AUTH_TOKEN': 'secret'}):
+            response = self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        
+        body = response.content.decode()
+        self.assertIn('api_requests_total{method="GET",route="health-live",status="200"}', body)
+        self.assertIn('api_request_duration_seconds_bucket{', body)
+        self.assertIn('api_request_db_queries_bucket{', body)
+        self.assertIn('api_requests_in_flight', body)
+    
+    def test_metrics_auth_token(self):
+        """Test scrapes need the bearer token, and are refused without one outside DEBUG"""
+        with self.settings(PROMETHEUS_METRICS={'AUTH_TOKEN': 'secret'}):
+            response = self.client.get('/api/metrics/')
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+            response = self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        
+        with self.settings(PROMETHEUS_METRICS={'AUTH_TOKEN': None}):
+            response = self.client.get('/api/metrics/')
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+            with self.settings(DEBUG=True):
+                response = self.client.get('/api/metrics/')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class ProfilingTests(APITestCase):
+    """Test on-demand request profiling"""
+    
+    def setUp(self):
+        import tempfile
+        from rest_framework_simplejwt.tokens import RefreshToken
+        
+        self.client = APIClient()
+        self.staff = User.objects.create_user(
+            username='staffuser',
+            email='staff@example.com',
+            password='testpass123',
+            is_staff=True
+        )
+        self.token = str(RefreshToken.for_user(self.staff).access_token)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+    
+    def test_staff_profile_saved_and_downloadable(self):
+        """Test a staff request with X-Profile is profiled and listed"""
+        with self.settings(PROFILING={'DIRECTORY': self.tmpdir.name}):
+            response = self.client.get(
+                '/api/v1/products/', HTTP_X_PROFILE='cprofile', HTTP_AUTHORIZATION=f'Bearer {self.token}'
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            profile_id = response['X-Profile-Id']
+            
+            self.client.force_authenticate(user=self.staff)
+            response = self.client.get('/api/admin/profiles/')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            profile = response.data['results'][0]
+            self.assertEqual(profile['id'], profile_id)
+            self.assertEqual(profile['route'], 'product-list')
+            self.assertEqual(profile['mode'], 'cprofile')
+            
+            response = self.client.get(f'/api/admin/profiles/{profile_id}/')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertIn('attachment', response['Content-Disposition'])
+    
+    def test_invalid_profiles_limit_rejected(self):
+        """Test a malformed limit is a 400 and a large one is clamped"""
+        self.client.force_authenticate(user=self.staff)
+        with self.settings(PROFILING={'DIRECTORY': self.tmpdir.name}):
+            for limit in ('abc', '0', '-5'):
+                response = self.client.get(f'/api/admin/profiles/?limit={limit}')
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, limit)
+            response = self.client.get('/api/admin/profiles/?limit=1000000')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+    
+    def test_non_staff_requests_not_profiled(self):
+        """Test the profiling flag is ignored for anonymous users"""
+        with self.settings(PROFILING={'DIRECTORY': self.tmpdir.name}):
+            response = self.client.get('/api/v1/products/?_profile=cprofile')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('X-Profile-Id', response)
+
+
+class SlowQueryTests(TestCase):
+    """Test slow query capture"""
+    
+    def test_normalize_sql(self):
+        """Test queries differing only in values share a fingerprint"""
+        from core.slow_queries import normalize_sql
+        
+        self.assertEqual(
+            normalize_sql("SELECT * FROM t WHERE id IN (%s, %s, %s) AND name = 'x'  AND n > 10"),
+            "SELECT * FROM t WHERE id IN (...) AND name = ? AND n > ?"
+        )
+        self.assertEqual(
+            normalize_sql('SELECT a FROM t WHERE a IN (%s, %s)'),
+            normalize_sql('SELECT a FROM t WHERE a IN (%s, %s, %s)')
+        )
+    
+    def test_slow_query_captured_with_plan(self):
+        """Test queries over the threshold are aggregated with call site and plan"""
+        from core.slow_queries import SlowQueryRecorder
+        
+        recorder = SlowQueryRecorder(threshold_ms=0)
+        with self.assertLogs('core.slow_queries', level='WARNING'):
+            with connection.execute_wrapper(recorder):
+                for username in ('a', 'b'):
+                    list(User.objects.filter(username=username))
+        
+        report = recorder.get_report()
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report[0]['count'], 2)
+        self.assertEqual(report[0]['distinct_params'], 2)
+        self.assertTrue(report[0]['last_plan'])
+        self.assertTrue(any('core/tests.py' in frame for frame in report[0]['last_stack']))
+
+    
+    def test_invalid_slow_queries_limit_rejected(self):
+        """Test the slow query report rejects a malformed limit"""
+        staff = User.objects.create_user(
+            username='staffuser',
+            email='staff@example.com',
+            password='testpass123',
+            is_staff=True
+        )
+        client = APIClient()
+        client.force_authenticate(user=staff)
+        
+        response = client.get('/api/admin/slow-queries/?limit=abc')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = client.get('/api/admin/slow-queries/?limit=1000000')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class AdmissionControlTests(APITestCase):
+    """Test admission control and load shedding"""
+    
+    def get_controller(self, **overrides):
+        from core.admission import AdmissionController, get_config
+        
+        config = get_config()
+        config.update(overrides)
+        return AdmissionController(config)
+    
+    def test_route_classification(self):
+        """Test requests are put in the configured route classes"""
+        from rest_framework.test import APIRequestFactory
+        
+        controller = self.get_controller()
+        factory = APIRequestFactory()
+        cases = [
+            (factory.get('/api/v1/products/'), 'catalog'),
+            (factory.post('/api/v1/cart/'), 'cart_write'),
+            (factory.get('/api/v1/cart/'), 'cart'),
+            (factory.post('/api/v1/orders/checkout/'), 'checkout'),
+            (factory.get('/api/admin/analytics/'), 'admin_analytics'),
+            (factory.get('/api/health/'), 'ops'),
+            (factory.get('/api/v1/auth/profile/'), 'default'),
+        ]
+        for request, expected in cases:
+            self.assertEqual(controller.classify(request).name, expected, request.path)
+    
+    def test_low_priority_shed_first_on_capacity(self):
+        """Test capacity is shed by priority, keeping room for critical classes"""
+        controller = self.get_controller(MAX_IN_FLIGHT=10)
+        classes = controller.classes
+        
+        # Low priority may use half the capacity, normal 80%, critical all of it
+        for _ in range(5):
+            self.assertIsNone(controller.admit(classes['checkout']))
+        self.assertEqual(controller.admit(classes['admin_analytics']), 'capacity')
+        for _ in range(3):
+            self.assertIsNone(controller.admit(classes['catalog']))
+        self.assertEqual(controller.admit(classes['catalog']), 'capacity')
+        for _ in range(2):
+            self.assertIsNone(controller.admit(classes['cart_write']))
+        self.assertEqual(controller.admit(classes['checkout']), 'capacity')
+        self.assertIsNone(controller.admit(classes['ops']))
+        
+        controller.release(classes['catalog'], 0.01)
+        controller.release(classes['ops'], 0.01)
+        self.assertIsNone(controller.admit(classes['checkout']))
+    
+    def test_slow_class_is_shed_between_probes(self):
+        """Test a class over its latency target is shed, but probed periodically"""
+        controller = self.get_controller(PROBE_INTERVAL=0.05)
+        catalog = controller.classes['catalog']
+        
+        self.assertIsNone(controller.admit(catalog))
+        controller.release(catalog, 10.0)
+        self.assertEqual(controller.admit(catalog), 'latency')
+        self.assertIsNone(controller.admit(controller.classes['checkout']))
+        
+        time.sleep(0.06)
+        self.assertIsNone(controller.admit(catalog))
+    
+    def test_queue_delay_sheds_with_retry_after(self):
+        """Test requests queued too long upstream get 503 with Retry-After"""
+        queued = f"t={time.time() - 100:.3f}"
+        self.client.get('/api/v1/sales-analytics/', HTTP_X_REQUEST_START=queued)
+        response = self.client.get('/api/v1/sales-analytics/', HTTP_X_REQUEST_START=queued)
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '5')
+        
+        # Exempt classes are never shed; the liveness probe does not touch Redis
+        response = self.client.get('/api/health/live/', HTTP_X_REQUEST_START=queued)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('Retry-After', response)
+
+
+class NPlusOneTests(APITestCase):
+    """Test N+1 query detection"""
+    
+    def setUp(self):
+        from apps.products.models import Category, Product
+        
+        cache.clear()
+        owner = User.objects.create_user(username='owner', email='owner@example.com', password='pass12345')
+        # bulk_create skips the cache invalidation signals
+        category, = Category.objects.bulk_create([Category(name='Shirts', slug='shirts')])
+        Product.objects.bulk_create([
+            Product(
+                name=f'Shirt {i}', slug=f'shirt-{i}', sku=f'SHIRT-{i}', price='10.00',
+                stock_quantity=5, category=category, created_by=owner,
+            )
+            for i in range(6)
+        ])
+    
+    def test_repeated_queries_reported_with_serializer_field(self):
+        """Test repeated query shapes raise, naming the serializer field"""
+        from apps.products.models import Product
+        from apps.products.serializers import ProductListSerializer
+        from core.n_plus_one import NPlusOneError, detect_n_plus_one
+        
+        products = Product.objects.select_related('category')
+        with self.assertRaises(NPlusOneError) as raised:
+            with detect_n_plus_one(threshold=5):
+                ProductListSerializer(products, many=True).data
+        self.assertIn('6x from ProductListSerializer.primary_image', str(raised.exception))
+        
+        with detect_n_plus_one(threshold=5) as detector:
+            list(Product.objects.all()[:3])
+        self.assertEqual(detector.get_repeated(), [])
+    
+    def test_middleware_warns_in_debug(self):
+        """Test the middleware logs N+1 patterns of an API request"""
+        with self.settings(N_PLUS_ONE={'ENABLED': True, 'ACTION': 'warn', 'IGNORE': ['average_rating']}):
+            with self.assertLogs('core.n_plus_one', level='WARNING') as logs:
+                response = self.client.get('/api/v1/products/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('ProductListSerializer.primary_image', logs.output[0])
+        self.assertNotIn('ProductListSerializer.average_rating', logs.output[0])
+
+
+class CartPricingTests(TestCase):
+    """Test the cart totals engine"""
+    
+    def setUp(self):
+        from apps.cart.models import Cart, CartItem
+        from apps.products.models import Category, Product, ProductVariant
+        
+        user = User.objects.create_user(username='shopper', email='shopper@example.com', password='pass12345')
+        category, = Category.objects.bulk_create([Category(name='Shirts', slug='shirts')])
+        shirt, mug = Product.objects.bulk_create([
+            Product(name='Shirt', slug='shirt', sku='SHIRT', price='20.00', compare_price='25.00',
+                    stock_quantity=5, category=category, created_by=user),
+            Product(name='Mug', slug='mug', sku='MUG', price='7.50', stock_quantity=5,
+                    category=category, created_by=user),
+        ])
+        large = ProductVariant.objects.create(product=shirt, name='Size', value='L', price_adjustment='2.00')
+        self.cart = Cart.objects.create(user=user)
+        CartItem.objects.create(cart=self.cart, product=shirt, variant=large, quantity=2)
+        CartItem.objects.create(cart=self.cart, product=mug, quantity=3)
+    
+    def test_totals_match_aggregate(self):
+        """Test the one-pass totals and the aggregate query agree"""
+        from decimal import Decimal
+        from apps.cart.services import aggregate_cart_totals, calculate_cart_totals
+        
+        with self.assertNumQueries(1):
+            totals = calculate_cart_totals(self.cart)
+        with self.assertNumQueries(1):
+            aggregate = aggregate_cart_totals(self.cart)
+        
+        expected = {
+            'total_items': 5,
+            'total_price': Decimal('66.50'),
+            'total_discount': Decimal('6.00'),
+            'item_count': 2,
+        }
+        self.assertEqual(totals.as_dict(), expected)
+        self.assertEqual(aggregate, expected)
+    
+    def test_cart_properties_share_one_query(self):
+        """Test the cart total properties load the items once"""
+        with self.assertNumQueries(1):
+            self.assertEqual(self.cart.total_items, 5)
+            self.assertEqual(str(self.cart.total_price), '66.50')
+            self.assertEqual(str(self.cart.total_discount), '6.00')
+
+    def test_persist_cart_syncs_items(self):
+        """Test write-behind persistence updates, deletes and creates items"""
+        from apps.cart.models import CartItem
+        from apps.cart.storage import persist_cart
+        
+        shirt_item = self.cart.items.get(variant__isnull=False)
+        mug_item = self.cart.items.get(variant__isnull=True)
+        quantities = {(shirt_item.product_id, shirt_item.variant_id): 4}
+        self.assertTrue(persist_cart(self.cart.id, quantities))
+        self.assertEqual(list(CartItem.objects.values_list('id', 'quantity')), [(shirt_item.id, 4)])
+        
+        self.assertTrue(persist_cart(self.cart.id, {(mug_item.product_id, None): 1}))
+        self.assertEqual(list(CartItem.objects.values_list('product_id', 'variant_id', 'quantity')),
+                         [(mug_item.product_id, None, 1)])
+        
+        self.cart.is_active = False
+        self.cart.save()
+        self.assertFalse(persist_cart(self.cart.id, {}))
+        self.assertEqual(CartItem.objects.count(), 1)
+
+
+class CartWriteTests(APITestCase):
+    """Test cart write endpoints"""
+    
+    def setUp(self):
+        from apps.products.models import Category, Product
+        
+        # Cached active cart ids outlive the rolled back carts of earlier tests
+        cache.clear()
+        self.user = User.objects.create_user(username='batcher', email='batcher@example.com', password='pass12345')
+        category, = Category.objects.bulk_create([Category(name='Mugs', slug='mugs')])
+        self.mug, = Product.objects.bulk_create([
+            Product(name='Mug', slug='mug', sku='MUG', price='7.50', stock_quantity=5, category=category,
+                    created_by=self.user),
+        ])
+        self.client.force_authenticate(self.user)
+    
+    def test_add_item_upserts(self):
+        """Test adding an item twice adds to one cart item in one statement"""
+        from apps.cart.models import Cart, CartItem
+        from apps.cart.storage import upsert_cart_item
+        
+        for quantity in (2, 1):
+            response = self.client.post('/api/v1/cart/1/add_item/', {'product_id': self.mug.id, 'quantity': quantity})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['item']['quantity'], 3)
+        self.assertEqual(list(CartItem.objects.values_list('quantity', flat=True)), [3])
+        
+        cart = Cart.objects.get(user=self.user)
+        with self.assertNumQueries(1):
+            item = upsert_cart_item(cart, (self.mug.id, None), 2)
+        self.assertEqual((item.id, item.quantity), (response.data['item']['id'], 5))
+    
+    def test_cart_reads_served_from_cache(self):
+        """Test cart reads are cached and include the user's own changes"""
+        cache.clear()
+        self.client.get('/api/v1/cart/1/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/v1/cart/1/summary/')
+        self.assertEqual(response.data['total_items'], 0)
+        
+        self.client.post('/api/v1/cart/1/add_item/', {'product_id': self.mug.id, 'quantity': 2})
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/v1/cart/1/')
+        self.assertEqual(response.data['total_items'], 2)
+        self.assertEqual(response.data['total_price'], '15.00')
+    
+    def test_active_cart_resolution_cached(self):
+        """Test the active cart id is cached and dropped when the cart is deactivated"""
+        from django.db import IntegrityError, transaction
+        from apps.cart.models import Cart
+        from apps.cart.storage import get_active_cart_id
+        
+        cart_id = get_active_cart_id(self.user)
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_active_cart_id(user), cart_id)
+        
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Cart.objects.create(user=self.user)
+        
+        cart = Cart.objects.get(pk=cart_id)
+        cart.is_active = False
+        cart.save()
+        user = User.objects.get(pk=self.user.pk)
+        self.assertNotEqual(get_active_cart_id(user), cart_id)
+    
+    def test_stale_active_cart_pointer_not_written(self):
+        """Test items never go into a cart deactivated behind a cached pointer"""
+        from apps.cart.models import Cart, CartItem
+        from apps.cart.storage import DatabaseCartStore, get_active_cart_id
+        
+        stale_id = get_active_cart_id(self.user)
+        # Deactivated without the signals, like a lost pointer delete
+        Cart.objects.filter(pk=stale_id).update(is_active=False)
+        store = DatabaseCartStore()
+        user = User.objects.get(pk=self.user.pk)
+        item = store.add(user, (self.mug.id, None), 2)
+        
+        active = Cart.objects.get(user=self.user, is_active=True)
+        self.assertEqual(item.cart_id, active.id)
+        self.assertEqual(list(CartItem.objects.values_list('cart_id', 'quantity')), [(active.id, 2)])
+        self.assertEqual(get_active_cart_id(User.objects.get(pk=self.user.pk)), active.id)
+    
+    def test_guest_cart_merged_on_login(self):
+        """Test a guest cart is kept under its token and folded into the user's cart at login"""
+        from apps.cart.models import CartItem
+        from apps.cart.storage import get_cart_store
+        
+        self.client.force_authenticate(None)
+        response = self.client.post('/api/v1/cart/1/add_item/', {'product_id': self.mug.id, 'quantity': 2})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        token = response['X-Cart-Token']
+        response = self.client.post(
+            '/api/v1/cart/1/add_item/', {'product_id': self.mug.id, 'quantity': 1}, HTTP_X_CART_TOKEN=token
+        )
+        self.assertFalse(response.has_header('X-Cart-Token'))
+        self.assertEqual(response.data['item']['quantity'], 3)
+        self.assertFalse(CartItem.objects.exists())
+        
+        get_cart_store().add(self.user, (self.mug.id, None), 1)
+        response = self.client.post(
+            '/api/v1/auth/login/', {'email': 'batcher@example.com', 'password': 'pass12345'}, HTTP_X_CART_TOKEN=token
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(CartItem.objects.values_list('quantity', flat=True)), [4])
+        
+        response = self.client.get('/api/v1/cart/1/', HTTP_X_CART_TOKEN=token)
+        self.assertEqual(response.data['items'], [])
+    
+    def test_validate_checks_stock_and_prices(self):
+        """Test cart validation reports stock, warehouse stock and price changes in one query"""
+        from decimal import Decimal
+        from apps.products.models import Product
+        from apps.shipping.models import Inventory, Warehouse
+        
+        self.client.post('/api/v1/cart/1/add_item/', {'product_id': self.mug.id, 'quantity': 4})
+        self.client.get('/api/v1/cart/1/')
+        Product.objects.filter(pk=self.mug.pk).update(price='8.00')
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/v1/cart/1/validate/')
+        line, = response.data['items']
+        self.assertTrue(response.data['is_valid'])
+        self.assertEqual((line['available_quantity'], line['snapshot_price']), (5, Decimal('7.50')))
+        self.assertTrue(line['price_changed'])
+        
+        warehouse, = Warehouse.objects.bulk_create([Warehouse(
+            name='Main', address_line1='1 Dock St', city='Austin', state='TX', postal_code='73301'
+        )])
+        Inventory.objects.create(product=self.mug, warehouse=warehouse, quantity=5, reserved_quantity=2)
+        response = self.client.get('/api/v1/cart/1/validate/')
+        self.assertFalse(response.data['is_valid'])
+        self.assertEqual(response.data['items'][0]['available_quantity'], 3)
+    
+    def test_expire_carts_command(self):
+        """Test idle carts are expired and inactive carts deleted in batches"""
+        from datetime import timedelta
+        from io import StringIO
+        from django.core.management import call_command
+        from django.utils import timezone
+        from apps.cart.models import Cart, CartItem
+        from apps.cart.storage import get_active_cart_id, get_cart_store
+        
+        long_ago = timezone.now() - timedelta(days=60)
+        get_cart_store().add(self.user, (self.mug.id, None), 1)
+        idle_id = get_active_cart_id(self.user)
+        Cart.objects.bulk_create([Cart(user=self.user, is_active=False)])
+        Cart.objects.update(updated_at=long_ago)
+        CartItem.objects.update(updated_at=long_ago)
+        
+        shopper = User.objects.create_user(username='shopper', email='shopper@example.com', password='pass12345')
+        get_cart_store().add(shopper, (self.mug.id, None), 2)
+        
+        call_command('expire_carts', batch_size=1, sleep=0, stdout=StringIO())
+        self.assertEqual(list(Cart.objects.values_list('user_id', 'is_active')), [(shopper.id, True)])
+        self.assertEqual(list(CartItem.objects.values_list('quantity', flat=True)), [2])
+        
+        user = User.objects.get(pk=self.user.pk)
+        self.assertNotEqual(get_active_cart_id(user), idle_id)
+    
+    def test_checkout_query_count_independent_of_cart_size(self):
+        """Test checkout creates order items in bulk and takes the stock of each line"""
+        from django.test.utils import CaptureQueriesContext
+        from apps.cart.models import Cart
+        from apps.cart.storage import get_active_cart_id, get_cart_store
+        from apps.orders.models import Order, ShippingMethod
+        from apps.products.models import Product
+        
+        shipping, = ShippingMethod.objects.bulk_create([ShippingMethod(name='Post', base_price='4.00', estimated_days=3)])
+        extra = Product.objects.bulk_create([
+            Product(name=f'Cup {i}', slug=f'cup-{i}', sku=f'CUP{i}', price='3.00', stock_quantity=5,
+                    category=self.mug.category, created_by=self.user)
+            for i in range(2)
+        ])
+        address = {
+            'customer_email': 'batcher@example.com', 'customer_first_name': 'Bat', 'customer_last_name': 'Cher',
+            'billing_address_line1': '1 Main St', 'billing_city': 'Austin', 'billing_state': 'TX',
+            'billing_postal_code': '73301', 'shipping_address_line1': '1 Main St', 'shipping_city': 'Austin',
+            'shipping_state': 'TX', 'shipping_postal_code': '73301', 'shipping_method_id': shipping.id,
+        }
+        
+        query_counts = []
+        for products in ([self.mug], [self.mug] + extra):
+            for product in products:
+                get_cart_store().add(self.user, (product.id, None), 1)
+            cart_id = get_active_cart_id(self.user)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post('/api/v1/orders/', dict(address, cart_id=cart_id))
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            query_counts.append(len(queries))
+            self.assertFalse(Cart.objects.get(pk=cart_id).is_active)
+            self.assertNotEqual(get_active_cart_id(User.objects.get(pk=self.user.pk)), cart_id)
+        
+        # Only the conditional stock UPDATEs are per line
+        self.assertEqual(query_counts[1] - query_counts[0], 2)
+        order = Order.objects.order_by('-id').first()
+        self.assertEqual(order.items.count(), 3)
+        self.assertEqual(str(order.subtotal), '13.50')
+        self.assertEqual(list(Product.objects.order_by('id').values_list('stock_quantity', flat=True)), [3, 4, 4])
+    
+    def test_reserve_stock_is_conditional(self):
+        """Test stock is taken with conditional updates and short lines are reported"""
+        from apps.cart.models import CartItem
+        from apps.products.stock import reserve_stock
+        from core.exceptions import OutOfStock
+        
+        reserve_stock([CartItem(product=self.mug, quantity=4)])
+        with self.assertRaises(OutOfStock) as raised:
+            reserve_stock([CartItem(product=self.mug, quantity=2)])
+        shortage, = raised.exception.detail['items']
+        self.assertEqual((shortage['requested'], shortage['available']), ('2', '1'))
+        self.mug.refresh_from_db()
+        self.assertEqual(self.mug.stock_quantity, 1)
+    
+    def test_reserve_stock_takes_warehouse_stock(self):
+        """Test SKUs stocked in warehouses are reserved there, as validation checks them"""
+        from django.db import transaction
+        from apps.cart.models import CartItem
+        from apps.cart.services import validate_cart
+        from apps.cart.storage import get_active_cart_id, get_cart_store
+        from apps.products.stock import reserve_stock
+        from apps.shipping.models import Inventory, Warehouse
+        from core.exceptions import OutOfStock
+        
+        warehouses = Warehouse.objects.bulk_create([
+            Warehouse(name=name, address_line1='1 Dock St', city='Austin', state='TX', postal_code='73301')
+            for name in ('East', 'West')
+        ])
+        Inventory.objects.bulk_create([
+            Inventory(product=self.mug, warehouse=warehouse, quantity=quantity)
+            for warehouse, quantity in zip(warehouses, (2, 3))
+        ])
+        get_cart_store().add(self.user, (self.mug.id, None), 5)
+        self.assertTrue(validate_cart(get_active_cart_id(self.user))['is_valid'])
+        
+        with transaction.atomic():
+            reserve_stock([CartItem(product=self.mug, quantity=4)])
+        self.assertEqual(list(Inventory.objects.order_by('id').values_list('reserved_quantity', flat=True)), [2, 2])
+        self.mug.refresh_from_db()
+        self.assertEqual(self.mug.stock_quantity, 5)
+        
+        with self.assertRaises(OutOfStock) as raised, transaction.atomic():
+            reserve_stock([CartItem(product=self.mug, quantity=2)])
+        self.assertEqual(raised.exception.detail['items'][0]['available'], '1')
+        self.assertFalse(validate_cart(get_active_cart_id(self.user))['is_valid'])
+    
+    def test_cancel_releases_stock(self):
+        """Test cancelling an order gives back its product and warehouse stock"""
+        from apps.cart.storage import get_active_cart_id, get_cart_store
+        from apps.orders.models import Order, ShippingMethod
+        from apps.products.models import Product
+        from apps.shipping.models import Inventory, Warehouse
+        
+        shipping, = ShippingMethod.objects.bulk_create([ShippingMethod(name='Post', base_price='4.00', estimated_days=3)])
+        cup, = Product.objects.bulk_create([
+            Product(name='Cup', slug='cup', sku='CUP1', price='3.00', stock_quantity=0,
+                    category=self.mug.category, created_by=self.user)
+        ])
+        warehouses = Warehouse.objects.bulk_create([
+            Warehouse(name=name, address_line1='1 Dock St', city='Austin', state='TX', postal_code='73301')
+            for name in ('East', 'West')
+        ])
+        Inventory.objects.bulk_create([
+            Inventory(product=cup, warehouse=warehouse, quantity=2, reserved_quantity=1)
+            for warehouse in warehouses
+        ])
+        get_cart_store().add(self.user, (self.mug.id, None), 3)
+        get_cart_store().add(self.user, (cup.id, None), 2)
+        
+        response = self.client.post('/api/v1/orders/', {
+            'customer_email': 'batcher@example.com', 'customer_first_name': 'Bat', 'customer_last_name': 'Cher',
+            'billing_address_line1': '1 Main St', 'billing_city': 'Austin', 'billing_state': 'TX',
+            'billing_postal_code': '73301', 'shipping_address_line1': '1 Main St', 'shipping_city': 'Austin',
+            'shipping_state': 'TX', 'shipping_postal_code': '73301', 'shipping_method_id': shipping.id,
+            'cart_id': get_active_cart_id(self.user),
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.mug.refresh_from_db()
+        self.assertEqual(self.mug.stock_quantity, 2)
+        self.assertEqual(list(Inventory.objects.order_by('id').values_list('reserved_quantity', flat=True)), [2, 2])
+        
+        order = Order.objects.get()
+        response = self.client.post(f'/api/v1/orders/{order.id}/cancel/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.mug.refresh_from_db()
+        self.assertEqual(self.mug.stock_quantity, 5)
+        self.assertEqual(list(Inventory.objects.order_by('id').values_list('reserved_quantity', flat=True)), [1, 1])
+        
+        response = self.client.post(f'/api/v1/orders/{order.id}/cancel/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.mug.refresh_from_db()
+        self.assertEqual(self.mug.stock_quantity, 5)
+    
+    def test_cancel_rolled_back_when_email_not_queued(self):
+        """Test a failed outbox INSERT fails the cancel instead of committing it without an email"""
+        from unittest import mock
+        from django.db import DatabaseError
+        from apps.cart.storage import get_active_cart_id, get_cart_store
+        from apps.orders.models import Order, ShippingMethod
+        
+        shipping, = ShippingMethod.objects.bulk_create([ShippingMethod(name='Post', base_price='4.00', estimated_days=3)])
+        get_cart_store().add(self.user, (self.mug.id, None), 3)
+        response = self.client.post('/api/v1/orders/', {
+            'customer_email': 'batcher@example.com', 'customer_first_name': 'Bat', 'customer_last_name': 'Cher',
+            'billing_address_line1': '1 Main St', 'billing_city': 'Austin', 'billing_state': 'TX',
+            'billing_postal_code': '73301', 'shipping_address_line1': '1 Main St', 'shipping_city': 'Austin',
+            'shipping_state': 'TX', 'shipping_postal_code': '73301', 'shipping_method_id': shipping.id,
+            'cart_id': get_active_cart_id(self.user),
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        order = Order.objects.get()
+        
+        with mock.patch('apps.orders.views.queue_email', side_effect=DatabaseError('outbox insert failed')):
+            response = self.client.post(f'/api/v1/orders/{order.id}/cancel/')
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'pending')
+        self.mug.refresh_from_db()
+        self.assertEqual(self.mug.stock_quantity, 2)
+    
+    def test_move_to_cart_validates_quantity(self):
+        """Test moving a wishlist item rejects bad quantities instead of lowering the line"""
+        from apps.cart.models import CartItem, Wishlist
+        from apps.cart.storage import get_cart_store
+        
+        get_cart_store().add(self.user, (self.mug.id, None), 2)
+        Wishlist.objects.create(user=self.user, product=self.mug)
+        for quantity in ('abc', 0, -2):
+            response = self.client.post(
+                '/api/v1/wishlist/move_to_cart/', {'product_id': self.mug.id, 'quantity': quantity}
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, quantity)
+        self.assertEqual(list(CartItem.objects.values_list('quantity', flat=True)), [2])
+        self.assertTrue(Wishlist.objects.exists())
+        
+        response = self.client.post('/api/v1/wishlist/move_to_cart/', {'product_id': self.mug.id, 'quantity': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(CartItem.objects.values_list('quantity', flat=True)), [3])
+    
+    def test_operations_applied_in_order(self):
+        """Test add, set and remove operations are applied at once"""
+        operations = [
+            {'op': 'add', 'product_id': self.mug.id, 'quantity': 2},
+            {'op': 'add', 'product_id': self.mug.id, 'quantity': 1},
+            {'op': 'set', 'product_id': self.mug.id, 'quantity': 4},
+            {'op': 'remove', 'product_id': self.mug.id + 1},
+        ]
+        response = self.client.post('/api/v1/cart/1/batch/', {'operations': operations}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_items'], 4)
+        self.assertEqual(response.data['total_price'], '30.00')
+        self.assertEqual(len(response.data['items']), 1)
+    
+    def test_unknown_product_rejects_batch(self):
+        """Test one invalid product rejects the whole batch"""
+        from apps.cart.models import CartItem
+        
+        operations = [
+            {'op': 'add', 'product_id': self.mug.id, 'quantity': 1},
+            {'op': 'add', 'product_id': self.mug.id + 1, 'quantity': 1},
+        ]
+        response = self.client.post('/api/v1/cart/1/batch/', {'operations': operations}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('product_id', response.data['operations'][1])
+        self.assertFalse(CartItem.objects.exists())
+
+
+class EmailOutboxTests(TestCase):
+    """Test the transactional email outbox"""
+    
+    def test_queued_emails_sent_by_worker(self):
+        """Test queued emails are only sent by the worker, in one batch"""
+        from io import StringIO
+        from django.core import mail
+        from django.core.management import call_command
+        from apps.notifications.models import OutboxEmail
+        from apps.notifications.outbox import queue_email
+        
+        for i in range(3):
+            queue_email(f'Order {i}', 'Thanks', [f'buyer{i}@example.com'])
+        self.assertEqual(len(mail.outbox), 0)
+        
+        call_command('send_outbox_emails', once=True, batch_size=2, stdout=StringIO())
+        self.assertEqual(sorted(message.subject for message in mail.outbox), ['Order 0', 'Order 1', 'Order 2'])
+        self.assertEqual(set(OutboxEmail.objects.values_list('status', flat=True)), {'sent'})
+    
+    def test_failed_emails_retried_with_backoff(self):
+        """Test failed emails are retried later and given up after MAX_ATTEMPTS"""
+        from smtplib import SMTPException
+        from unittest import mock
+        from django.core.mail.backends.locmem import EmailBackend
+        from django.utils import timezone
+        from apps.notifications.models import OutboxEmail
+        from apps.notifications.outbox import get_config, queue_email, send_batch
+        
+        email = queue_email('Order', 'Thanks', ['buyer@example.com'])
+        config = dict(get_config(), MAX_ATTEMPTS=2, RETRY_BACKOFF=60)
+        with mock.patch.object(EmailBackend, 'send_messages', side_effect=SMTPException('421 try later')):
+            self.assertEqual(send_batch(config), 1)
+            email.refresh_from_db()
+            self.assertEqual((email.status, email.attempts, email.last_error), ('pending', 1, '421 try later'))
+            self.assertGreater(email.next_attempt_at, timezone.now())
+            self.assertEqual(send_batch(config), 0)
+        
+            OutboxEmail.objects.update(next_attempt_at=timezone.now())
+            send_batch(config)
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), ('failed', 2))
+    
+    def test_sent_emails_recorded_when_close_fails(self):
+        """Test emails sent before the connection fails to close are not sent again"""
+        from smtplib import SMTPServerDisconnected
+        from unittest import mock
+        from django.core import mail
+        from django.core.mail.backends.locmem import EmailBackend
+        from apps.notifications.outbox import queue_email, send_batch
+        
+        email = queue_email('Order', 'Thanks', ['buyer@example.com'])
+        with mock.patch.object(EmailBackend, 'close', side_effect=SMTPServerDisconnected('gone')):
+            send_batch()
+        email.refresh_from_db()
+        self.assertEqual(email.status, 'sent')
+        self.assertEqual(send_batch(), 0)
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class TracingTests(APITestCase):
+    """Test request tracing"""
+    
+    def setUp(self):
+        self.client = APIClient()
+        cache.clear()
+    
+    def test_sampled_traceparent_traced(self):
+        """Test a sampled traceparent continues the trace with child spans"""
+        trace_id = '4bf92f3577b34da6a3ce929d0e0e4736'
+        with self.assertLogs('core.tracing.export', level='INFO') as logs:
+            response = self.client.get(
+                '/api/v1/products/', HTTP_TRACEPARENT=f'00-{trace_id}-00f067aa0ba902b7-01'
+            )
+        self.assertEqual(response['X-Trace-Id'], trace_id)
+        
+        exported = logs.records[0].fields
+        self.assertEqual(exported['trace_id'], trace_id)
+        self.assertEqual(exported['name'], 'GET product-list')
+        span_names = {span['name'] for span in exported['spans']}
+        self.assertTrue({'view', 'db.query', 'serialize'} <= span_names)
+        root = next(span for span in exported['spans'] if span['name'] == 'GET product-list')
+        self.assertEqual(root['parent_id'], '00f067aa0ba902b7')
+    
+    def test_untrusted_sampled_flag_ignored(self):
+        """Test a sampled traceparent from outside the trusted networks cannot force a trace"""
+        traceparent = '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01'
+        with self.settings(TRACING={'SAMPLE_RATE': 0, 'TRUSTED_NETWORKS': ['10.0.0.0/8']}):
+            with self.assertNoLogs('core.tracing.export', level='INFO'):
+                response = self.client.get('/api/health/', HTTP_TRACEPARENT=traceparent, REMOTE_ADDR='203.0.113.7')
+            self.assertNotIn('X-Trace-Id', response)
+            
+            client = APIClient(REMOTE_ADDR='10.1.2.3')
+            with self.assertLogs('core.tracing.export', level='INFO'):
+                response = client.get('/api/health/', HTTP_TRACEPARENT=traceparent)
+        self.assertEqual(response['X-Trace-Id'], '4bf92f3577b34da6a3ce929d0e0e4736')
+    
+    def test_unsampled_request_not_traced(self):
+        """Test requests outside the sample rate are not traced"""
+        with self.settings(TRACING={'SAMPLE_RATE': 0}):
+            with self.assertNoLogs('core.tracing.export', level='INFO'):
+                response = self.client.get('/api/health/')
+        self.assertNotIn('X-Trace-Id', response)
+
+
 class CacheManagerTests(TestCase):
     """Test cache manager functionality"""
     
@@ -151,6 +1011,265 @@ class CacheManagerTests(TestCase):
         self.assertIsNone(cached_data)
 
 
+class CacheCodecTests(TestCase):
+    """Test cache payload codecs"""
+    
+    def test_msgpack_roundtrip_preserves_types(self):
+        """Test msgpack codec keeps Decimals and datetimes"""
+        from collections import OrderedDict
+        from decimal import Decimal
+        from django.utils import timezone
+        from core.cache_codecs import PayloadSerializer
+        
+        serializer = PayloadSerializer({'PAYLOAD_CODEC': 'msgpack'})
+        now = timezone.now()
+        value = [OrderedDict([('id', 1), ('price', Decimal('19.99')), ('created_at', now)])]
+        
+        decoded = serializer.loads(serializer.dumps(value))
+        self.assertEqual(decoded, [{'id': 1, 'price': Decimal('19.99'), 'created_at': now}])
+    
+    def test_msgpack_roundtrip_preserves_tuples(self):
+        """Test tuples come back as tuples, including as dict keys, not as lists"""
+        from core.cache_codecs import PayloadSerializer
+        
+        serializer = PayloadSerializer({'PAYLOAD_CODEC': 'msgpack'})
+        value = {'pair': (1, ('a', [2])), (3, 4): 'key', 'items': [(5, None)]}
+        
+        encoded = serializer.dumps(value)
+        self.assertEqual(encoded[:1], b'M')
+        decoded = serializer.loads(encoded)
+        self.assertEqual(decoded, value)
+        self.assertIsInstance(decoded['pair'], tuple)
+        self.assertIsInstance(decoded['pair'][1], tuple)
+        self.assertIsInstance(decoded['items'][0], tuple)
+    
+    def test_unsupported_values_fall_back_to_pickle(self):
+        """Test values the codec can't encode are pickled"""
+        import pickle
+        from core.cache_codecs import PayloadSerializer
+        
+        serializer = PayloadSerializer({'PAYLOAD_CODEC': 'msgpack'})
+        value = {'tags': {'a', 'b'}}
+        
+        self.assertEqual(serializer.loads(serializer.dumps(value)), value)
+        # Untagged pickles written before codecs were introduced still decode
+        self.assertEqual(serializer.loads(pickle.dumps(value)), value)
+    
+    def test_compression_threshold(self):
+        """Test only payloads above the threshold are compressed"""
+        from django_redis.exceptions import CompressorError
+        from core.cache_codecs import PayloadCompressor
+        
+        compressor = PayloadCompressor({'COMPRESSION': 'zlib', 'COMPRESS_MIN_LENGTH': 100})
+        small = b'M' + b'x' * 10
+        large = b'M' + b'x' * 1000
+        
+        self.assertEqual(compressor.compress(small), small)
+        compressed = compressor.compress(large)
+        self.assertLess(len(compressed), len(large))
+        self.assertEqual(compressor.decompress(compressed), large)
+        with self.assertRaises(CompressorError):
+            compressor.decompress(small)
+
+
+class CircuitBreakerTests(TestCase):
+    """Test the Redis circuit breaker"""
+    
+    def test_breaker_state_transitions(self):
+        """Test open, half-open and closed transitions"""
+        from core.circuit_breaker import CircuitBreaker
+        
+        breaker = CircuitBreaker('test', failure_threshold=2, recovery_timeout=0.05)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow_request())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow_request())
+        
+        time.sleep(0.06)
+        # One half-open probe is allowed, the rest short-circuit
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+    
+    def test_unreachable_redis_falls_back_to_local_cache(self):
+        """Test cache calls fail fast and use the local fallback once open"""
+        from django_redis.cache import RedisCache
+        from core.circuit_breaker import get_breaker_states
+        
+        server = 'redis://127.0.0.1:1/0'
+        redis_cache = RedisCache(server, {
+            'OPTIONS': {
+                'CLIENT_CLASS': 'core.circuit_breaker.CircuitBreakerClient',
+                'SOCKET_CONNECT_TIMEOUT': 0.1,
+                'CIRCUIT_BREAKER': {'FAILURE_THRESHOLD': 2, 'RECOVERY_TIMEOUT': 60},
+            },
+        })
+        
+        for _ in range(2):
+            redis_cache.set('key', 'value')
+        state = next(b for b in get_breaker_states() if b['name'] == f'redis:{server}')
+        self.assertEqual(state['state'], 'open')
+        
+        start = time.time()
+        redis_cache.set('key', 'value')
+        self.assertEqual(redis_cache.get('key'), 'value')
+        self.assertLess(time.time() - start, 0.05)
+    
+    def test_invalidations_replayed_when_circuit_closes(self):
+        """Test keys written and patterns deleted while open are deleted from Redis on close"""
+        from unittest import mock
+        from django_redis.cache import RedisCache
+        from django_redis.client import DefaultClient
+        
+        redis_cache = RedisCache('redis://127.0.0.1:2/0', {
+            'OPTIONS': {
+                'CLIENT_CLASS': 'core.circuit_breaker.CircuitBreakerClient',
+                'SOCKET_CONNECT_TIMEOUT': 0.1,
+                'CIRCUIT_BREAKER': {'FAILURE_THRESHOLD': 1, 'RECOVERY_TIMEOUT': 60},
+            },
+        })
+        redis_cache.set('key', 'value')
+        redis_cache.delete('product:1')
+        redis_cache.delete_pattern('products:*')
+        client = redis_cache.client
+        self.assertTrue(client.pending)
+        
+        client.breaker.record_success()
+        with mock.patch.object(DefaultClient, 'delete_many') as delete_many, \
+                mock.patch.object(DefaultClient, 'delete_pattern') as delete_pattern, \
+                mock.patch.object(DefaultClient, 'get', return_value=None):
+            redis_cache.get('other')
+        self.assertEqual(sorted(delete_many.call_args.args[0]), ['key', 'product:1'])
+        self.assertEqual(delete_pattern.call_args.args[0], 'products:*')
+        self.assertFalse(client.pending)
+
+    
+    def test_set_many_recorded_once(self):
+        """Test set_many is one guarded, recorded cache call, not one per key on top"""
+        from unittest import mock
+        from django_redis.cache import RedisCache
+        from django_redis.client import DefaultClient
+        from core.instrumentation import end_request, get_current_metrics, start_request
+        
+        redis_cache = RedisCache('redis://127.0.0.1:3/0', {
+            'OPTIONS': {'CLIENT_CLASS': 'core.circuit_breaker.CircuitBreakerClient'},
+        })
+        redis = mock.MagicMock()
+        token = start_request()
+        try:
+            with mock.patch.object(DefaultClient, 'get_client', return_value=redis):
+                redis_cache.set_many({'a': 1, 'b': 2, 'c': 3})
+            self.assertEqual(get_current_metrics().cache_calls, 1)
+        finally:
+            end_request(token)
+        self.assertEqual(redis.pipeline.return_value.set.call_count, 3)
+        redis.pipeline.return_value.execute.assert_called_once()
+
+class RateLimitTests(TestCase):
+    """Test the GCRA rate limiter and throttles"""
+    
+    def test_gcra_allows_burst_then_spaces_requests(self):
+        """Test a limit of N per period allows N at once, then one per interval"""
+        from core.rate_limit import LocalGCRALimiter
+        
+        now = [1000.0]
+        limiter = LocalGCRALimiter(timer=lambda: now[0])
+        results = [limiter.hit('key', 3, 60) for _ in range(4)]
+        self.assertEqual([r.allowed for r in results], [True, True, True, False])
+        self.assertEqual(results[2].remaining, 0)
+        self.assertAlmostEqual(results[3].retry_after, 20)
+        
+        now[0] += 20
+        self.assertTrue(limiter.hit('key', 3, 60).allowed)
+        self.assertFalse(limiter.hit('key', 3, 60).allowed)
+        self.assertTrue(limiter.hit('other', 3, 60).allowed)
+    
+    def test_throttle_uses_scope_rate_and_wait(self):
+        """Test throttles keep DRF's rates and keys and report Retry-After"""
+        from django.contrib.auth.models import AnonymousUser
+        from rest_framework.test import APIRequestFactory
+        from core.rate_limit import get_limiter
+        from core.throttling import AnonRateThrottle
+        
+        get_limiter().reset()
+        
+        class TestThrottle(AnonRateThrottle):
+            rate = '2/minute'
+        
+        request = APIRequestFactory().get('/api/v1/products/', REMOTE_ADDR='10.1.2.3')
+        request.user = AnonymousUser()
+        throttle = TestThrottle()
+        self.assertTrue(throttle.allow_request(request, None))
+        self.assertTrue(throttle.allow_request(request, None))
+        self.assertFalse(throttle.allow_request(request, None))
+        self.assertEqual(throttle.key, 'throttle_anon_10.1.2.3')
+        self.assertAlmostEqual(throttle.wait(), 30, delta=1)
+    
+    def test_composite_throttle_applies_all_rates_at_once(self):
+        """Test the composite throttle refuses on the tightest rate and consumes nothing then"""
+        from django.contrib.auth.models import AnonymousUser
+        from rest_framework.test import APIRequestFactory
+        from core.rate_limit import get_limiter
+        from core.throttling import CompositeRateThrottle
+        
+        limiter = get_limiter()
+        limiter.reset()
+        view = type('View', (), {'throttle_scope': 'auth'})()
+        request = APIRequestFactory().post('/api/v1/auth/login/', REMOTE_ADDR='10.1.2.4')
+        request.user = AnonymousUser()
+        
+        throttle = CompositeRateThrottle()
+        self.assertEqual(
+            sorted(rule.key for rule in throttle.get_rules(request, view)),
+            ['throttle_anon_10.1.2.4', 'throttle_auth_10.1.2.4', 'throttle_cost_10.1.2.4', 'throttle_user_10.1.2.4'],
+        )
+        for _ in range(5):
+            self.assertTrue(throttle.allow_request(request, view))
+        self.assertFalse(throttle.allow_request(request, view))
+        self.assertAlmostEqual(throttle.wait(), 12, delta=1)
+        
+        # The refused request wasn't counted against the anon rate (100/hour)
+        self.assertEqual(limiter.hit('throttle_anon_10.1.2.4', 100, 3600).remaining, 94)
+    
+    def test_throttle_cost_declarations(self):
+        """Test costs declared on actions, @api_view functions and by QueryCost"""
+        from rest_framework.request import Request
+        from rest_framework.test import APIRequestFactory
+        from apps.admin_panel.views import admin_analytics
+        from apps.products.views import ProductViewSet
+        from apps.reviews.views import AnalyticsEventViewSet
+        from core.throttling import get_throttle_cost
+        
+        factory = APIRequestFactory()
+        request = Request(factory.get('/api/v1/products/', {'search': 'blue t shirt'}))
+        # 1 + 0.1 per row of a 20 item page + 2 per term, doubled for "t"
+        self.assertEqual(get_throttle_cost(request, ProductViewSet(action='list', request=request)), 11)
+        self.assertEqual(get_throttle_cost(request, ProductViewSet(action='retrieve', request=request)), 1)
+        self.assertEqual(get_throttle_cost(request, AnalyticsEventViewSet(action='summary')), 10)
+        self.assertEqual(get_throttle_cost(request, admin_analytics.cls()), 20)
+    
+    def test_cost_budget_is_charged_by_cost(self):
+        """Test expensive requests use up the cost budget faster"""
+        from django.contrib.auth.models import AnonymousUser
+        from rest_framework.test import APIRequestFactory
+        from core.rate_limit import get_limiter
+        from core.throttling import CostRateThrottle
+        
+        get_limiter().reset()
+        request = APIRequestFactory().get('/api/v1/products/search/', REMOTE_ADDR='10.1.2.5')
+        request.user = AnonymousUser()
+        expensive = type('View', (), {'throttle_cost': 1000})()
+        cheap = type('View', (), {})()
+        
+        throttle = CostRateThrottle()
+        for _ in range(3):
+            self.assertTrue(throttle.allow_request(request, expensive))
+        self.assertFalse(throttle.allow_request(request, expensive))
+        self.assertFalse(throttle.allow_request(request, cheap))
+
+
 class DatabaseOptimizationTests(APITestCase):
     """Test database optimization features"""
     
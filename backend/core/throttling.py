@@ -1,4 +1,184 @@
-from rest_framework.throttling import UserRateThrottle, AnonRateThrottle, ScopedRateThrottle
+"""
+Throttles backed by the GCRA limiter in ``core.rate_limit``.
+
+DRF's ``SimpleRateThrottle`` keeps the list of every request timestamp per
+key and rewrites it on each request. These classes keep DRF's scopes, rates
+(``DEFAULT_THROTTLE_RATES``) and cache keys but store a single value per key,
+updated atomically in Redis.
+
+``CompositeRateThrottle`` (the default throttle class) evaluates the anon,
+user and scoped rates of a request in one limiter call, i.e. one Redis round
+trip instead of a get and a set per throttle.
+
+It also charges each request against a per-user/IP cost budget (scope
+'cost'). Views declare what a request costs with ``throttle_cost``, either a
+number or a callable such as ``QueryCost``; undeclared views cost 1, so
+expensive endpoints use up the budget faster than cheap ones.
+"""
+import math
+from typing import Optional
+
+from rest_framework import throttling
+from rest_framework.settings import api_settings
+
+from .rate_limit import Rule, get_limiter
+
+
+class GCRARateThrottle(throttling.SimpleRateThrottle):
+    """
+    ``SimpleRateThrottle`` with the timestamp history replaced by a GCRA
+    limiter; the rate is still parsed from ``rate`` or the scope.
+    """
+    result = None
+
+    def get_rule(self, request, view) -> Optional[Rule]:
+        """Return the limiter rule for this request, or None if it isn't throttled"""
+        if self.rate is None:
+            return None
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return None
+        # A cost above the limit could never be allowed
+        cost = min(self.get_cost(request, view), self.num_requests)
+        return Rule(self.key, self.num_requests, self.duration, cost)
+
+    def get_cost(self, request, view) -> int:
+        return 1
+
+    def allow_request(self, request, view):
+        rule = self.get_rule(request, view)
+        if rule is None:
+            return True
+
+        self.result = get_limiter().hit_many([rule])
+        return self.result.allowed
+
+    def wait(self):
+        return self.result.retry_after if self.result is not None else None
+
+
+class AnonRateThrottle(throttling.AnonRateThrottle, GCRARateThrottle):
+    """Limit anonymous users by IP (scope 'anon')"""
+
+
+class UserRateThrottle(throttling.UserRateThrottle, GCRARateThrottle):
+    """Limit authenticated users by id, anonymous users by IP (scope 'user')"""
+
+
+class ScopedRateThrottle(throttling.ScopedRateThrottle, GCRARateThrottle):
+    """Limit by the view's ``throttle_scope``"""
+
+    def get_rule(self, request, view) -> Optional[Rule]:
+        # The scope comes from the view, as in ScopedRateThrottle.allow_request
+        self.scope = getattr(view, self.scope_attr, None)
+        if not self.scope:
+            return None
+
+        self.rate = self.get_rate()
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+        return super().get_rule(request, view)
+
+    def allow_request(self, request, view):
+        return GCRARateThrottle.allow_request(self, request, view)
+
+
+def throttle_cost(cost):
+    """
+    Declare the throttle cost of a view, viewset action or ``@api_view``
+    function; ``cost`` is a number or a callable taking (request, view).
+    """
+
+    def decorator(view):
+        # @api_view functions are wrapped in a generated APIView class
+        target = getattr(view, 'cls', view)
+        if isinstance(target, type) and callable(cost):
+            target.throttle_cost = staticmethod(cost)
+        else:
+            target.throttle_cost = cost
+        return view
+
+    return decorator
+
+
+def get_throttle_cost(request, view) -> int:
+    """Return the cost declared by the view or its current action, default 1"""
+    cost = None
+    action = getattr(view, 'action', None)
+    if action:
+        cost = getattr(getattr(view, action, None), 'throttle_cost', None)
+    if cost is None:
+        cost = getattr(view, 'throttle_cost', 1)
+    if callable(cost):
+        cost = cost(request, view)
+    return max(1, math.ceil(cost))
+
+
+class QueryCost:
+    """
+    Cost of a list or search request: ``base``, plus ``per_item`` for each row
+    of the requested page, plus ``per_term`` for each search term. Terms
+    shorter than ``broad_term_length`` match most rows and count double.
+    """
+
+    def __init__(self, base: float = 1, per_item: float = 0, search_params=('search',), per_term: float = 0,
+                 broad_term_length: int = 3, max_cost: int = 100):
+        self.base = base
+        self.per_item = per_item
+        self.search_params = search_params
+        self.per_term = per_term
+        self.broad_term_length = broad_term_length
+        self.max_cost = max_cost
+
+    def __call__(self, request, view) -> float:
+        cost = self.base
+        if self.per_item:
+            cost += self.per_item * self.get_page_size(request, view)
+        for param in self.search_params:
+            for term in request.query_params.get(param, '').split():
+                cost += self.per_term * (2 if len(term) < self.broad_term_length else 1)
+        return min(cost, self.max_cost)
+
+    def get_page_size(self, request, view) -> int:
+        paginator = getattr(view, 'paginator', None)
+        page_size = paginator.get_page_size(request) if paginator is not None else None
+        return page_size or api_settings.PAGE_SIZE or 0
+
+
+class CostRateThrottle(UserRateThrottle):
+    """Charge the view's ``throttle_cost`` against a per-user/IP budget"""
+    scope = 'cost'
+
+    def get_cost(self, request, view) -> int:
+        return get_throttle_cost(request, view)
+
+
+class CompositeRateThrottle(throttling.BaseThrottle):
+    """
+    Apply the rates of several GCRA throttles in a single limiter call. A
+    request refused by any of them consumes nothing and waits for the longest.
+    """
+    throttle_classes = (AnonRateThrottle, UserRateThrottle, ScopedRateThrottle, CostRateThrottle)
+    result = None
+
+    def get_rules(self, request, view):
+        rules = []
+        for throttle_class in self.throttle_classes:
+            rule = throttle_class().get_rule(request, view)
+            if rule is not None:
+                rules.append(rule)
+        return rules
+
+    def allow_request(self, request, view):
+        rules = self.get_rules(request, view)
+        if not rules:
+            return True
+
+        self.result = get_limiter().hit_many(rules)
+        return self.result.allowed
+
+    def wait(self):
+        return self.result.retry_after if self.result is not None else None
 
 
 class AuthRateThrottle(UserRateThrottle):
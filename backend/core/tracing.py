@@ -0,0 +1,353 @@
+"""
+Lightweight request tracing.
+
+``TracingMiddleware`` starts a trace for a sampled API request (or one whose
+W3C ``traceparent`` header is marked sampled and comes from a trusted network,
+``TRACING['TRUSTED_NETWORKS']``) and opens the root span. Spans
+for the view, DB queries, cache calls, serializers and email sends are
+created as children of the current span, tracked in a context variable.
+When the request is not sampled ``start_span`` returns a shared no-op
+context, so unsampled requests pay almost nothing.
+
+Completed traces are exported as one JSON line per trace to the
+``core.tracing.export`` logger, or posted in OTLP/HTTP JSON format to a collector
+(``TRACING['EXPORTER'] = 'otlp'``) from a background thread.
+"""
+import contextvars
+import ipaddress
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextlib import nullcontext
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar('trace', default=None)
+_current_span: contextvars.ContextVar = contextvars.ContextVar('span', default=None)
+
+_NOOP_SPAN = nullcontext()
+
+# OTLP span kinds
+SPAN_KINDS = {'internal': 1, 'server': 2, 'client': 3}
+
+
+def get_config() -> Dict[str, Any]:
+    """Return the TRACING setting merged over the defaults"""
+    config = {
+        'ENABLED': True,
+        'SAMPLE_RATE': 0.01,
+        'EXPORTER': 'jsonl',
+        'OTLP_ENDPOINT': 'http://localhost:4318/v1/traces',
+        'SERVICE_NAME': 'cartaway-api',
+        'MAX_SPANS': 1000,
+        # Proxies and internal callers whose traceparent sampled flag is honoured
+        'TRUSTED_NETWORKS': [],
+    }
+    config.update(getattr(settings, 'TRACING', {}))
+    return config
+
+
+class Span:
+    """A timed operation within a trace"""
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'kind', 'start_ns', 'end_ns', 'attributes', 'status')
+
+    def __init__(self, trace_id: str, name: str, parent_id: Optional[str] = None, kind: str = 'internal',
+                 attributes: Optional[Dict[str, Any]] = None):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.status = 'ok'
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def finish(self) -> None:
+        self.end_ns = time.time_ns()
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'start_ns': self.start_ns,
+            'duration_ms': round(self.duration_ms, 3),
+            'status': self.status,
+            'attributes': self.attributes,
+        }
+
+
+class Trace:
+    """Spans collected for one sampled request"""
+
+    def __init__(self, trace_id: str, parent_id: Optional[str] = None, max_spans: int = 1000):
+        self.trace_id = trace_id
+        # Span id of the caller, from an incoming traceparent
+        self.parent_id = parent_id
+        self.max_spans = max_spans
+        self.spans: List[Span] = []
+        self.dropped_spans = 0
+
+    def add(self, span: Span) -> None:
+        if len(self.spans) < self.max_spans:
+            self.spans.append(span)
+        else:
+            self.dropped_spans += 1
+
+    @property
+    def root(self) -> Optional[Span]:
+        return next((span for span in self.spans if span.parent_id == self.parent_id), None)
+
+    def as_dict(self) -> Dict[str, Any]:
+        root = self.root
+        spans = sorted(self.spans, key=lambda span: span.start_ns)
+        return {
+            'trace_id': self.trace_id,
+            'name': root.name if root else None,
+            'duration_ms': round(root.duration_ms, 3) if root else None,
+            'span_count': len(spans),
+            'dropped_spans': self.dropped_spans,
+            'spans': [span.as_dict() for span in spans],
+        }
+
+
+class SpanContext:
+    """Context manager making a span current for its duration"""
+    __slots__ = ('trace', 'span', 'token')
+
+    def __init__(self, trace: Trace, name: str, kind: str, attributes: Dict[str, Any]):
+        parent = _current_span.get()
+        self.trace = trace
+        self.span = Span(trace.trace_id, name, parent.span_id if parent else trace.parent_id, kind, attributes)
+        self.token = None
+
+    def __enter__(self) -> Span:
+        self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc is not None:
+            self.span.status = 'error'
+            self.span.set_attribute('exception', f"{exc_type.__name__}: {exc}")
+        self.span.finish()
+        _current_span.reset(self.token)
+        self.trace.add(self.span)
+
+
+def start_span(name: str, kind: str = 'internal', **attributes):
+    """Return a context manager timing ``name`` as a child of the current span"""
+    trace = _current_trace.get()
+    if trace is None:
+        return _NOOP_SPAN
+    return SpanContext(trace, name, kind, attributes)
+
+
+def is_tracing() -> bool:
+    return _current_trace.get() is not None
+
+
+def parse_traceparent(header: Optional[str]):
+    """Return (trace_id, parent_span_id, sampled) from a W3C traceparent header"""
+    if not header:
+        return None, None, False
+    parts = header.strip().split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None, False
+    try:
+        int(parts[1] + parts[2], 16)
+        sampled = bool(int(parts[3], 16) & 1)
+    except ValueError:
+        return None, None, False
+    return parts[1], parts[2], sampled
+
+
+def parse_networks(networks) -> List[Any]:
+    """Parse a list of CIDR strings, skipping invalid ones"""
+    parsed = []
+    for network in networks:
+        try:
+            parsed.append(ipaddress.ip_network(network, strict=False))
+        except ValueError:
+            logger.warning(f"Ignoring invalid trusted tracing network: {network}")
+    return parsed
+
+
+def is_trusted(remote_addr: Optional[str], networks: List[Any]) -> bool:
+    """Whether ``remote_addr`` is in one of the trusted networks"""
+    if not remote_addr or not networks:
+        return False
+    try:
+        address = ipaddress.ip_address(remote_addr)
+    except ValueError:
+        return False
+    return any(address in network for network in networks)
+
+
+def begin_trace(traceparent: Optional[str], sample_rate: float, max_spans: int = 1000, trusted: bool = False):
+    """Start a trace if the request is sampled; returns (trace, token) or (None, None)
+
+    The traceparent sampled flag only forces a trace for ``trusted`` callers;
+    anyone else is sampled at ``sample_rate``, continuing their trace id.
+    """
+    trace_id, parent_id, sampled = parse_traceparent(traceparent)
+    if not (sampled and trusted) and random.random() >= sample_rate:
+        return None, None
+    trace = Trace(trace_id or os.urandom(16).hex(), parent_id, max_spans)
+    return trace, _current_trace.set(trace)
+
+
+def end_trace(trace: Trace, token) -> None:
+    """Close the trace and hand it to the exporter"""
+    _current_trace.reset(token)
+    try:
+        get_exporter().export(trace)
+    except Exception as e:
+        logger.warning(f"Failed to export trace {trace.trace_id}: {e}")
+
+
+def trace_query(execute, sql, params, many, context):
+    """Database execute wrapper creating a span per query"""
+    with start_span('db.query', kind='client', **{
+        'db.system': context['connection'].vendor,
+        'db.statement': sql if len(sql) <= 500 else sql[:500] + '...',
+        'db.many': many,
+    }):
+        return execute(sql, params, many, context)
+
+
+def _traced_send(send):
+    def wrapper(self, fail_silently=False):
+        if not is_tracing():
+            return send(self, fail_silently)
+        with start_span('email.send', kind='client', **{'email.recipients': len(self.recipients())}):
+            return send(self, fail_silently)
+
+    wrapper.__wrapped__ = send
+    wrapper._traced = True
+    return wrapper
+
+
+def install_tracing() -> None:
+    """Trace email sends; safe to call more than once"""
+    from django.core.mail.message import EmailMessage
+
+    if not getattr(EmailMessage.send, '_traced', False):
+        EmailMessage.send = _traced_send(EmailMessage.send)
+
+
+class JSONLinesExporter:
+    """Write each trace as one JSON line through the 'core.tracing.export' logger"""
+
+    def __init__(self, config: Dict[str, Any]):
+        self.export_logger = logging.getLogger('core.tracing.export')
+
+    def export(self, trace: Trace) -> None:
+        self.export_logger.info('Trace', extra={'fields': trace.as_dict()})
+
+
+class OTLPHTTPExporter:
+    """Post traces to an OTLP/HTTP JSON endpoint from a background thread"""
+
+    def __init__(self, config: Dict[str, Any], batch_size: int = 50, queue_size: int = 1000):
+        self.endpoint = config['OTLP_ENDPOINT']
+        self.service_name = config['SERVICE_NAME']
+        self.batch_size = batch_size
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def export(self, trace: Trace) -> None:
+        if self._thread is None or self._pid != os.getpid():
+            with self._lock:
+                if self._thread is None or self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(target=self._run, name='otlp-exporter', daemon=True)
+                    self._thread.start()
+        try:
+            self.queue.put_nowait(trace)
+        except queue.Full:
+            logger.debug(f"Dropped trace {trace.trace_id}, export queue full")
+
+    def _run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.post(batch)
+            except Exception as e:
+                logger.warning(f"Failed to export {len(batch)} traces to {self.endpoint}: {e}")
+
+    def post(self, traces: List[Trace]) -> None:
+        body = json.dumps(self.encode(traces), default=str).encode()
+        request = urllib.request.Request(
+            self.endpoint, data=body, headers={'Content-Type': 'application/json'}, method='POST'
+        )
+        with urllib.request.urlopen(request, timeout=5) as response:
+            response.read()
+
+    def encode(self, traces: List[Trace]) -> Dict[str, Any]:
+        """Encode traces as an OTLP ExportTraceServiceRequest"""
+        spans = []
+        for trace in traces:
+            for span in trace.spans:
+                spans.append({
+                    'traceId': span.trace_id,
+                    'spanId': span.span_id,
+                    'parentSpanId': span.parent_id or '',
+                    'name': span.name,
+                    'kind': SPAN_KINDS.get(span.kind, 1),
+                    'startTimeUnixNano': str(span.start_ns),
+                    'endTimeUnixNano': str(span.end_ns),
+                    'attributes': [
+                        {'key': key, 'value': {'stringValue': str(value)}}
+                        for key, value in span.attributes.items()
+                    ],
+                    'status': {'code': 2 if span.status == 'error' else 1},
+                })
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': [
+                    {'key': 'service.name', 'value': {'stringValue': self.service_name}},
+                ]},
+                'scopeSpans': [{'scope': {'name': 'core.tracing'}, 'spans': spans}],
+            }],
+        }
+
+
+EXPORTERS = {
+    'jsonl': JSONLinesExporter,
+    'otlp': OTLPHTTPExporter,
+}
+
+_exporter = None
+
+
+def get_exporter():
+    """Return the exporter configured by TRACING['EXPORTER']"""
+    global _exporter
+    if _exporter is None:
+        config = get_config()
+        _exporter = EXPORTERS[config['EXPORTER']](config)
+    return _exporter
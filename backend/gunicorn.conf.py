@@ -0,0 +1,24 @@
+"""
+Gunicorn configuration.
+
+Loaded automatically from the working directory. Keeps the Prometheus
+multiprocess directory (PROMETHEUS_MULTIPROC_DIR) consistent across worker
+restarts; see core/metrics.py.
+"""
+import os
+import shutil
+
+
+def on_starting(server):
+    """Remove metric files left over from a previous run"""
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+
+def child_exit(server, worker):
+    """Drop the live gauges of a worker that exited"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)